@@ -1,19 +1,13 @@
-import os, sys, json, re, subprocess, time, difflib, ctypes, binascii
+import os, sys, json, re, subprocess, time, difflib, ctypes, binascii, threading, hashlib, zlib, gzip, struct
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
-from collections import defaultdict
-import math
-
-# GUI Library
-from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-                             QPushButton, QTableWidget, QTableWidgetItem, QTextEdit, 
-                             QHeaderView, QComboBox, QLabel, QCheckBox, QGroupBox, 
-                             QLineEdit, QFileDialog, QInputDialog, QTabWidget, QMessageBox, QScrollArea)
-from PySide6.QtCore import Qt, QThread, Signal, Slot
-from PySide6.QtGui import QTextCursor, QColor, QWheelEvent, QShortcut, QKeySequence, QDesktopServices 
-from PySide6.QtCore import QUrl
-
-import openpyxl
-from netmiko import ConnectHandler
+from collections import defaultdict, deque, OrderedDict
+from itertools import chain
+import math, bisect, random, shutil, csv, heapq, sqlite3, tempfile
+from array import array
+from html import unescape as html_unescape, escape as html_escape
+import importlib.util
 
 # Windows Registry (for TeraTerm detection)
 try:
@@ -21,15 +15,46 @@ try:
 except ImportError:
     winreg = None
 
-# --- Graph Library (for Mode 6 & 8) ---
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-try:
-    import networkx as nx
-    HAS_NETWORKX = True
-except ImportError:
-    HAS_NETWORKX = False
+# --- 実行形態 ---
+# --headless 指定時は Qt / matplotlib / networkx を読み込まずに起動する (cron・タスクスケジューラ用)。
+# openpyxl / netmiko / networkx / matplotlib は使用するモードで初めて import する。
+HEADLESS = "--headless" in sys.argv[1:]
+HAS_NETWORKX = importlib.util.find_spec("networkx") is not None
+
+class _BoundSignal:
+    def __init__(self): self.slots = []
+    def connect(self, slot, *_): self.slots.append(slot)
+    def emit(self, *args):
+        for slot in list(self.slots): slot(*args)
+
+class _HeadlessSignal:
+    """QtCore.Signal 互換の簡易版 (--headless 用)。接続先は発行したスレッドで直接呼ばれる"""
+    def __init__(self, *types): self.attr = None
+    def __set_name__(self, owner, name): self.attr = "_signal_" + name
+    def __get__(self, obj, owner=None):
+        if obj is None: return self
+        return obj.__dict__.setdefault(self.attr, _BoundSignal())
+
+class _HeadlessThread:
+    """QThread 互換の最小実装 (threading.Thread ベース、--headless 用)"""
+    finished = _HeadlessSignal()
+    def __init__(self, *args): self._thread = None
+    def run(self): pass
+    def _main(self):
+        try: self.run()
+        finally: self.finished.emit()
+    def start(self):
+        self._thread = threading.Thread(target=self._main, daemon=True); self._thread.start()
+    def isRunning(self): return bool(self._thread and self._thread.is_alive())
+    def wait(self, msecs=None):
+        if self._thread: self._thread.join(None if msecs is None else msecs / 1000)
+        return not self.isRunning()
+    def terminate(self): pass # Pythonスレッドは強制終了できないため stop() のフラグに任せる
+
+if HEADLESS:
+    QThread, Signal = _HeadlessThread, _HeadlessSignal
+else:
+    from PySide6.QtCore import QThread, Signal
 
 # --- 設定 ---
 if getattr(sys, 'frozen', False):
@@ -38,14 +63,102 @@ else:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 SNAPSHOT_DIR = os.path.join(BASE_DIR, "snapshots")
+SNAPSHOT_LOOKBACK = 20 # 経路診断などで過去のスナップショットからコマンド出力を探すときにさかのぼる回数
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 REPORT_DIR = os.path.join(BASE_DIR, "reports")
 PCAP_DIR = os.path.join(BASE_DIR, "pcaps")
+PCAP_FORMAT = "pcap" # ワイヤータップの保存形式 ("pcap" / "pcapng")
+TS_DIR = os.path.join(BASE_DIR, "timeseries") # 帯域モニターの記録 (機器/IFごと)
 SEARCH_FILE = os.path.join(BASE_DIR, "search.txt")
+INVENTORY_FILE = os.path.join(BASE_DIR, "inventory.xlsx") # 無ければ同じ名前の .csv / .yaml / .yml を読む
+INVENTORY_CACHE_DIR = os.path.join(BASE_DIR, "inventory_cache") # 読み込んだインベントリの索引 (SQLite)。元ファイルが同じ間は再解析しない
+INVENTORY_CACHE_VERSION = 2 # 索引の形式や読み込み規則を変えたら上げる (古い索引は作り直す)
+NOISE_FILTER_FILE = os.path.join(BASE_DIR, "noise_filters.json") # 比較時の除外ルール (任意、既定ルールに追加/上書き)
 
 for d in [SNAPSHOT_DIR, LOG_DIR, REPORT_DIR, PCAP_DIR]:
     os.makedirs(d, exist_ok=True)
 
+# --- 同時実行数 (モード0-5) ---
+MAX_PARALLEL_DEVICES = 16   # 同時にログインする機器数の上限 (画面の「同時接続」で変更可)
+MAX_PARALLEL_PER_SITE = 4   # 同一サイト(インベントリの site 列)あたりの上限 (0 = 無制限)
+
+# --- SSHセッションプール ---
+SESSION_IDLE_TIMEOUT = 300  # 秒。未使用のまま経過したセッションは切断する (機器側 exec-timeout より短く)
+SESSION_POOL_SIZE = 64      # 保持しておくアイドルセッション数の上限 (超過分は最も古いものから切断)
+
+# --- フルメッシュPing (モード5) ---
+MESH_BATCH_SIZE = 16        # 1回のCLIやり取りでまとめて流し込むPing数
+
+# --- 自動診断 (モード6) ---
+DIAG_MAX_HOPS = 15          # 1つの枝でたどるホップ数の上限
+DIAG_MAX_BRANCHES = 8       # ECMP の枝を並行して調べる同時ログイン数
+
+# --- トポロジー自動描画 (モード8) ---
+CRAWL_MAX_DEVICES = 2000    # 探索する機器数の上限
+CRAWL_SCAN_INVENTORY = True # LLDP/CDP で辿れなかったインベントリ機器も ARP/MAC を取得してリンクを推定する
+CRAWL_DISCOVERED_LOGIN = False # インベントリに無い隣接機器へ起点の認証情報でログインして辿る (既定は図に載せるだけ)
+CRAWL_MGMT_SUBNETS = []     # 上記でログインしてよい管理用サブネット (例: ["10.0.0.0/16"])。空なら一切ログインしない
+LAYOUT_CACHE_DIR = os.path.join(BASE_DIR, "layout_cache") # トポロジーごとの配置座標キャッシュ
+TOPO_LAYOUT_VERSION = 1     # 配置アルゴリズムを変えたら上げる (古いキャッシュを使わない)
+TOPO_CLUSTER_MIN = 150      # これを超える台数はクラスタ分割して配置し、縮小表示ではクラスタ単位で描く
+TOPO_NODE_GAP = 60          # 隣接ノード間のおおよその間隔 (描画座標)
+
+# --- 帯域モニター (モード7) ---
+MONITOR_INTERVAL = 3        # ポーリング間隔 (秒)。1機器につき1回のポーリングで全IFをまとめて取得する
+MONITOR_WINDOW = 300        # グラフに表示する範囲 (何秒前まで)
+MONITOR_MAX_DEVICES = 16    # 同時に監視できる機器数
+MONITOR_MAX_SERIES = 64     # 同時に監視できる IF 数 (全機器の合計)
+
+# --- ワイヤータップ (モード9) ---
+WIRETAP_MAX_DEVICES = 8     # 同時にキャプチャできる機器数 (2台以上は時刻順に1つの pcapng へまとめる)
+
+# --- 差分エンジン ---
+DIFF_BACKEND = "fast"       # "fast" (行ハッシュ + patience/Myers) / "ndiff" (従来の difflib.ndiff)
+DIFF_MAX_EDIT = 1000        # Myers で探索する編集距離の上限。超えた区間は「置換」としてまとめて表示する
+
+# --- レポート ---
+REPORT_SPOOL_DIR = os.path.join(REPORT_DIR, ".spool") # 実行中のレポート断片の置き場 (機器ごとのファイル。閉じる時に削除)
+REPORT_PAGE_SIZE = 100      # レポート閲覧ページの一覧で1ページに並べる機器数
+
+# --- ログ ---
+LOG_GZIP = False            # True でモード2/4のログを <機器>_<日付>.log.gz に圧縮保存する
+LOG_BUFFER_SIZE = 1 << 20   # ログ書き込みのバッファサイズ (bytes)
+LOG_BUS_MAX = 200_000       # 画面反映待ちのログ件数の上限 (超えた分は古いものから破棄)
+LOG_FLUSH_MS = 50           # 画面へまとめて反映する間隔 (ms)
+LOG_FLUSH_BATCH = 5000      # 1回の反映で処理する最大件数 (残りは次回)
+CONSOLE_DIR = os.path.join(LOG_DIR, "console") # 画面ログの退避先 (起動ごとのフォルダ、終了時に削除)
+CONSOLE_MAX_RECORDS = 5000  # 1つの画面ログに表示しておく件数の上限 (超えた分はファイルから読み直す)
+CONSOLE_PAGE = 1000         # 上端/下端までスクロールした時に読み込む件数
+SEARCH_DEBOUNCE_MS = 250    # 検索欄の入力が止まってから検索を始めるまでの待ち時間 (ms)
+
+# --- 比較時に無視する行 (ベンダーファミリー別、DIAG_FAMILIES の分類を使用) ---
+# noise_filters.json に同じ形式で書くと追加・上書きできる (値を null にするとそのルールを無効化)
+NOISE_RULES = {
+    "common": {"blank": r"^\s*$"},
+    "cisco": {
+        "cur_config": r"^Current configuration\s*:\s*\d+\s*bytes", "building": r"^Building configuration.*",
+        "last_change": r"^Last configuration change at.*", "nvram_updated": r"^NVRAM config last updated at.*", "comment": r"^!.*",
+        "ntp_clock_period": r"^ntp clock-period \d+",
+    },
+    "juniper": {"last_commit": r"^## Last (?:commit|changed): .*", "version_banner": r"^## (?:Image name|JUNOS|Junos)\b.*"},
+    "huawei": {"separator": r"^#\s*$", "sw_version": r"^!Software Version .*", "last_update": r"^!Last configuration was (?:updated|saved) at .*",
+               "info": r"^\s*Info: .*"},
+    "hp_aruba": {"banner": r"^Running configuration:.*", "created_on": r"^; .*(?:Configuration Editor|Created on release).*", "comment": r"^!.*"},
+    "fortinet": {"config_version": r"^#config-version=.*", "conf_file_ver": r"^#conf_file_ver=.*", "buildno": r"^#buildno=.*",
+                 "global_vdom": r"^#global_vdom=.*", "system_time": r"^System time:.*", "uptime": r"^Uptime:.*"},
+    "yamaha": {"reporting_date": r"^# Reporting Date: .*", "banner": r"^# (?:RTX|NVR|FWX|SWX|Rev\.|MAC Address|Memory|main:).*", "separator": r"^#\s*$"},
+    "allied": {"comment": r"^!.*", "cur_config": r"^Current configuration.*"},
+    "nec": {"comment": r"^!.*", "cur_config": r"^Current configuration.*"},
+    "linux": {},
+}
+
+# === モード ===
+MODES = [
+    "0: Ping", "0t: Trace", "1: Login", "2: ログ取得", "3: 解析・比較", "4: ログ+比較", 
+    "5: フルメッシュPing", "6: 自動診断 (Auto-Tshoot)", "7: 帯域モニター",
+    "8: トポロジー自動描画 (Crawler)", "9: 仮想ワイヤータップ"
+]
+
 # --- モード6(自動診断)用: マルチベンダー対応設定 ---
 DIAG_FAMILIES = {
     "cisco": [
@@ -159,43 +272,6 @@ DIAG_COMMANDS = {
     }
 }
 
-# --- グラフ描画用キャンバス ---
-class MplCanvas(FigureCanvas):
-    def __init__(self, parent=None, width=8, height=5, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi, facecolor='#1E1E1E')
-        self.axes = self.fig.add_subplot(111)
-        self.axes.set_facecolor('#1E1E1E')
-        self.axes.tick_params(colors='white')
-        for spine in self.axes.spines.values():
-            spine.set_edgecolor('#555')
-        self.axes.grid(True, color='#333', linestyle='--')
-        
-        self.current_dpi = dpi
-        super().__init__(self.fig)
-
-    def wheelEvent(self, event: QWheelEvent):
-        if event.modifiers() & Qt.ControlModifier:
-            if event.angleDelta().y() > 0:
-                self.current_dpi += 5
-            else:
-                self.current_dpi = max(50, self.current_dpi - 5)
-            
-            self.fig.set_dpi(self.current_dpi)
-            self.fig.set_size_inches(self.fig.get_size_inches()) 
-            self.draw()
-            event.accept()
-        else:
-            super().wheelEvent(event)
-
-# --- カスタムTextEdit ---
-class ZoomableTextEdit(QTextEdit):
-    def wheelEvent(self, event: QWheelEvent):
-        if event.modifiers() & Qt.ControlModifier:
-            if event.angleDelta().y() > 0: self.zoomIn(1)
-            else: self.zoomOut(1)
-            event.accept()
-        else: super().wheelEvent(event)
-
 # --- 機能関数 ---
 def sanitize_filename(name):
     return re.sub(r'[\\/:*?"<>|]', '_', str(name))
@@ -218,13 +294,417 @@ def find_teraterm(parent_widget=None):
     except: pass
     return None
 
-def clean_text_for_diff(text):
-    if not isinstance(text, str): return []
-    ignore_patterns = [r"^Current configuration\s*:\s*\d+\s*bytes", r"^Building configuration.*", r"^Last configuration change at.*", r"^NVRAM config last updated at.*", r"^!.*", r"^\s*$"]
-    return [l for l in text.splitlines() if not any(re.search(p, l, re.IGNORECASE) for p in ignore_patterns)]
-
-def generate_side_by_side_html(old_lines, new_lines, cmd_name=""):
-    diff = list(difflib.ndiff(old_lines, new_lines))
+# --- インベントリ (xlsx / csv / yaml) の読み込みと索引 ---
+INVENTORY_INDEX_COLS = ("name", "ip", "vendor", "site")
+INVENTORY_SECRET_KEYS = ("pw", "en_pw", "password", "secret") # 索引ファイルには書かない (必要な時に元ファイルから読む)
+
+def _text_encoding(path):
+    # Excel で保存した CSV は cp932 のことが多い。先頭が UTF-8 として読めなければ cp932
+    with open(path, "rb") as f: head = f.read(1 << 16)
+    try: head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.start < len(head) - 3: return "cp932" # 末尾で切れた多バイト文字は除く
+    return "utf-8-sig"
+
+def _inventory_host(headers, row):
+    # 1行分をホスト情報にする。7列目 = Enableパスワード、8列目 = コマンド (改行区切り) は見出しに関係なく位置で読む
+    h = {headers[j]: row[j] for j, n in enumerate(headers) if n and j < len(row)}
+    h['en_pw'] = row[6] if len(row)>6 else ""; h['command_list'] = [c.strip() for c in str(row[7]).split('\n') if c.strip()] if len(row)>7 else []
+    return h
+
+def iter_inventory_file(path):
+    """インベントリのファイルを先頭から1台ずつ読む (xlsx は read_only で行ごと、csv は1行目が見出し、yaml はホストのリスト)"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".yaml", ".yml"):
+        try: import yaml
+        except ImportError: raise RuntimeError("YAML のインベントリには PyYAML が必要です (pip install pyyaml)")
+        with open(path, encoding='utf-8-sig') as f: data = yaml.safe_load(f) or []
+        if isinstance(data, dict): data = data.get('hosts') or [] # "hosts:" の下に並べた形式も可
+        for item in data:
+            if not isinstance(item, dict) or item.get('name') is None: continue
+            h = {str(k).strip().lower(): v for k, v in item.items()}
+            cmds = h.get('command_list', h.pop('commands', None)) or []
+            h['command_list'] = [str(c).strip() for c in (cmds if isinstance(cmds, list) else str(cmds).split('\n')) if str(c).strip()]
+            h.setdefault('en_pw', ""); yield h
+        return
+    if ext == ".csv":
+        with open(path, newline='', encoding=_text_encoding(path)) as f:
+            rows = csv.reader(f); headers = [c.strip().lower() for c in next(rows, [])]
+            for row in rows:
+                if row and row[0].strip(): yield _inventory_host(headers, row)
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True) # 全セルをメモリに展開しない
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        headers = [str(c).strip().lower() if c else "" for c in next(rows, ())]
+        for row in rows:
+            if row and row[0] is not None: yield _inventory_host(headers, row)
+    finally: wb.close()
+
+class InventoryIndex:
+    """インベントリを SQLite の索引 (INVENTORY_CACHE_DIR) に入れて引く。元ファイルの更新日時とサイズが同じならそのまま使い、
+    変わっていてもハッシュが同じなら再解析しない。索引を保存できない場所ではメモリ上に作る
+    パスワード類 (INVENTORY_SECRET_KEYS) は索引に保存せずメモリ上だけに持ち、索引を使った回は最初の検索時に元ファイルから読む"""
+    def __init__(self, path=None, cache_dir=None):
+        self.path = os.path.abspath(path or INVENTORY_FILE); cache_dir = cache_dir or INVENTORY_CACHE_DIR
+        self.db = os.path.join(cache_dir, f"{sanitize_filename(os.path.basename(self.path))}_{hashlib.sha256(self.path.encode('utf-8')).hexdigest()[:12]}.sqlite")
+        self.lock, self.con, self.cached, self.secrets, self.stamp = threading.Lock(), None, False, None, None
+        try: os.makedirs(cache_dir, exist_ok=True); self._open(self.db)
+        except sqlite3.DatabaseError: # 壊れた索引は作り直す
+            try: os.remove(self.db); self._open(self.db)
+            except (sqlite3.Error, OSError): self._open(":memory:")
+        except (sqlite3.Error, OSError): self._open(":memory:")
+
+    def _open(self, db):
+        self.con = sqlite3.connect(db, check_same_thread=False, isolation_level=None)
+        self.con.execute("PRAGMA secure_delete = ON") # 作り直した時に古い行 (旧形式の索引のパスワード等) をファイル上に残さない
+        try: self.cached = self._sync()
+        except BaseException: self.con.close(); raise
+
+    @staticmethod
+    def _key(col, v):
+        v = "" if v is None else str(v).strip()
+        return v.lower() if col == "vendor" else v
+
+    def _sync(self):
+        # 戻り値: 索引をそのまま使えたか
+        con, st = self.con, os.stat(self.path)
+        con.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        meta = dict(con.execute("SELECT k, v FROM meta"))
+        stamp = self.stamp = f"{INVENTORY_CACHE_VERSION}:{st.st_mtime_ns}:{st.st_size}"
+        if meta.get('stamp') == stamp: return True
+        sha = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for blk in iter(lambda: f.read(1 << 20), b""): sha.update(blk)
+        digest = f"{INVENTORY_CACHE_VERSION}:{sha.hexdigest()}"
+        if meta.get('sha256') == digest: # 上書き保存・コピーで日時だけ変わった
+            con.execute("UPDATE meta SET v = ? WHERE k = 'stamp'", (stamp,)); return True
+        rows, secrets = [], {}
+        for k, h in enumerate(iter_inventory_file(self.path)):
+            secrets[k] = {s: h.pop(s) for s in INVENTORY_SECRET_KEYS if s in h}
+            rows.append((k, *(self._key(c, h.get(c)) for c in INVENTORY_INDEX_COLS), json.dumps(h, ensure_ascii=False, default=str)))
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute("DROP TABLE IF EXISTS hosts")
+            con.execute(f"CREATE TABLE hosts (seq INTEGER PRIMARY KEY, {', '.join(c + ' TEXT' for c in INVENTORY_INDEX_COLS)}, data TEXT)")
+            con.executemany(f"INSERT INTO hosts VALUES ({', '.join('?' * (len(INVENTORY_INDEX_COLS) + 2))})", rows)
+            for c in INVENTORY_INDEX_COLS: con.execute(f"CREATE INDEX hosts_{c} ON hosts ({c})")
+            con.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [('stamp', stamp), ('sha256', digest)])
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK"); raise
+        self.secrets = secrets
+        return False
+
+    def _load_secrets(self):
+        # 索引を使った回: 元ファイルからパスワード類だけを拾う。索引を作った後にファイルが変わっていたら作り直す
+        st = os.stat(self.path)
+        if f"{INVENTORY_CACHE_VERSION}:{st.st_mtime_ns}:{st.st_size}" != self.stamp: self._sync()
+        if self.secrets is None:
+            self.secrets = {k: {s: h[s] for s in INVENTORY_SECRET_KEYS if s in h} for k, h in enumerate(iter_inventory_file(self.path))}
+
+    def _query(self, where="", params=(), secrets=True):
+        with self.lock:
+            if secrets and self.secrets is None: self._load_secrets()
+            rows = self.con.execute(f"SELECT seq, data FROM hosts {where} ORDER BY seq", params).fetchall()
+            hosts = json.loads("[" + ",".join(r[1] for r in rows) + "]") # 1回の loads にまとめる
+            if secrets:
+                for (k, _), h in zip(rows, hosts): h.update(self.secrets.get(k, ()))
+        return hosts
+
+    def hosts(self, secrets=True):
+        """全台 (ファイルの並び順)。secrets=False ならパスワード類を付けない (元ファイルを読まずに済む)"""
+        return self._query(secrets=secrets)
+
+    def find(self, secrets=True, **criteria):
+        """find(name=..., ip=..., vendor=..., site=..., host=...)。値は1つまたはリスト (どれかに一致)、複数の項目は AND
+        host は名前または IP のどちらかに一致。vendor は大文字小文字を区別しない"""
+        where, params = [], []
+        for col, val in criteria.items():
+            if col not in INVENTORY_INDEX_COLS + ("host",): raise ValueError(f"索引のない項目です: {col}")
+            vals = [self._key(col, v) for v in (val if isinstance(val, (list, tuple, set, frozenset)) else [val])]
+            if not vals: return []
+            marks = ", ".join("?" * len(vals))
+            if col == "host": where.append(f"(name IN ({marks}) OR ip IN ({marks}))"); params += vals * 2
+            else: where.append(f"{col} IN ({marks})"); params += vals
+        return self._query("WHERE " + " AND ".join(where) if where else "", params, secrets)
+
+    def close(self):
+        with self.lock: self.con.close()
+
+def benchmark_inventory(n_rows=20000, seed=1):
+    """インベントリ読み込みの処理速度 (--headless --bench inventory)。従来の通常モード読み込み、初回 (解析 + 索引作成)、2回目以降 (索引) を比べる"""
+    import openpyxl
+    rnd = random.Random(seed); tmp = tempfile.mkdtemp(); path = os.path.join(tmp, "inventory.xlsx")
+    wb = openpyxl.Workbook(); ws = wb.active # Excel で保存したファイルと同じく共有文字列を使う
+    ws.append(["name", "ip", "user", "pw", "vendor", "site", "en_pw", "commands"])
+    for k in range(n_rows):
+        ws.append([f"sw{k:05d}", f"10.{k >> 16 & 255}.{k >> 8 & 255}.{k & 255}", "admin", "pw", rnd.choice(("cisco_ios", "juniper", "huawei")), f"site{k % 50:02d}", "en", "show version\nshow ip route"])
+    wb.save(path); result = {}
+    try:
+        t0 = time.perf_counter()
+        wb = openpyxl.load_workbook(path, data_only=True); ws = wb.active; headers = [str(c.value).strip().lower() if c.value else "" for c in ws[1]]
+        legacy = [_inventory_host(headers, row) for row in ws.iter_rows(min_row=2, values_only=True) if row and row[0] is not None]
+        result["旧方式 (通常モード)"] = time.perf_counter() - t0
+        for name, secrets in (("初回 (解析 + 索引)", True), ("2回目以降 (索引)", False), ("2回目以降 (+パスワード)", True)):
+            t0 = time.perf_counter(); inv = InventoryIndex(path, cache_dir=tmp); hosts = inv.hosts(secrets); inv.close()
+            result[name] = time.perf_counter() - t0
+        assert hosts == legacy
+        t0 = time.perf_counter(); inv = InventoryIndex(path, cache_dir=tmp)
+        for k in range(0, n_rows, max(1, n_rows // 1000)): inv.find(name=f"sw{k:05d}", secrets=False)
+        inv.close(); result["名前で検索 x1000"] = time.perf_counter() - t0
+    finally: shutil.rmtree(tmp, ignore_errors=True)
+    return n_rows, result
+
+def find_inventory_file():
+    # INVENTORY_FILE が無ければ同じ名前の csv / yaml を探す
+    stem = os.path.splitext(INVENTORY_FILE)[0]
+    return next((p for p in (INVENTORY_FILE, stem + ".csv", stem + ".yaml", stem + ".yml") if os.path.exists(p)), INVENTORY_FILE)
+
+def load_inventory(path=None):
+    """インベントリ (xlsx / csv / yaml) を読み込み、ホスト情報(dict)のリストを返す。2回目以降は索引から読む"""
+    path = path or find_inventory_file()
+    if not os.path.exists(path): return []
+    inv = InventoryIndex(path)
+    try: return inv.hosts()
+    finally: inv.close()
+
+def load_search_keywords():
+    if not os.path.exists(SEARCH_FILE): return []
+    with open(SEARCH_FILE, "r", encoding='utf-8-sig') as f: return [l.strip() for l in f if l.strip()]
+
+def _trie_regex(words):
+    # 文字単位のトライを正規表現に展開する (共通接頭辞をまとめ、長い候補から試す)
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[""] = True
+    def build(node):
+        end = "" in node
+        alts = [re.escape(ch) + build(sub) for ch, sub in sorted(node.items()) if ch]
+        if not alts: return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if end else body
+    return build(trie)
+
+class KeywordScanner:
+    """search.txt のキーワードを1本の照合器にまとめ、出力を1回走査してヒット行を返す
+    通常行は部分一致 (大文字小文字無視)、'word:' で始まる行は単語一致、'regex:' / 're:' で始まる行は正規表現"""
+    def __init__(self, keywords=()):
+        self.keywords, self.regexes = [], []
+        lit, word = {}, {}
+        for raw in keywords or ():
+            kw = raw.strip()
+            if not kw or kw in self.keywords: continue
+            idx = len(self.keywords); self.keywords.append(kw)
+            for pre in ("regex:", "re:"):
+                if kw.lower().startswith(pre):
+                    try: self.regexes.append((idx, re.compile(kw[len(pre):], re.I)))
+                    except re.error: pass # 不正な正規表現は無視
+                    break
+            else:
+                if kw.lower().startswith("word:"):
+                    if kw[5:].strip(): word.setdefault(kw[5:].strip().lower(), []).append(idx)
+                else: lit.setdefault(kw.lower(), []).append(idx)
+        # 各キーワードについて、自身の接頭辞になっている他のキーワードも同じ位置でヒットとして展開する
+        self.lit = {k: sorted(i for p in lit if k.startswith(p) for i in lit[p]) for k in lit}
+        self.word = {k: [(p, idxs) for p, idxs in word.items() if k.startswith(p)] for k in word}
+        # 先読みで全位置から照合するため、重なり合うキーワードも取りこぼさない
+        self.lit_re = re.compile(f"(?=({_trie_regex(self.lit)}))", re.I) if self.lit else None
+        self.word_re = re.compile(rf"(?=\b({_trie_regex(self.word)})\b)", re.I) if self.word else None
+
+    def __len__(self): return len(self.keywords)
+
+    def scan(self, text):
+        """(キーワード, 行番号(1始まり), 行) のリストを行順で返す。1行につき同じキーワードは1回"""
+        if not text or not self.keywords: return []
+        hits = set()
+        if self.lit_re:
+            for m in self.lit_re.finditer(text): hits.update((m.start(), i) for i in self.lit[m.group(1).lower()])
+        if self.word_re:
+            for m in self.word_re.finditer(text):
+                s, g = m.start(), m.group(1).lower()
+                for p, idxs in self.word[g]:
+                    e = s + len(p)
+                    if e == len(text) or not (text[e].isalnum() or text[e] == "_"): hits.update((s, i) for i in idxs)
+        for i, rx in self.regexes: hits.update((m.start(), i) for m in rx.finditer(text))
+        if not hits: return []
+        starts = [0] + [m.end() for m in re.finditer("\n", text)]
+        seen, res = set(), []
+        for pos, i in sorted(hits):
+            ln = bisect.bisect_right(starts, pos) - 1
+            if (ln, i) in seen: continue
+            seen.add((ln, i))
+            end = starts[ln + 1] - 1 if ln + 1 < len(starts) else len(text)
+            res.append((ln + 1, i, text[starts[ln]:end].rstrip("\r")))
+        res.sort()
+        return [(self.keywords[i], ln, line) for ln, i, line in res]
+
+def open_device_log(name, today):
+    """機器ごとのログファイルを追記モードで開く (コマンド出力を受信順にそのまま書き出す)"""
+    f_p = os.path.join(LOG_DIR, f"{sanitize_filename(name)}_{today}.log" + (".gz" if LOG_GZIP else ""))
+    if LOG_GZIP: return gzip.open(f_p, "at", encoding='utf-8') # 追記するとメンバーが増えるが gzip としてはそのまま読める
+    return open(f_p, "a", encoding='utf-8', buffering=LOG_BUFFER_SIZE)
+
+def vendor_family(vendor):
+    v = str(vendor or 'cisco_ios').lower()
+    for fam, drivers in DIAG_FAMILIES.items():
+        if any(d in v for d in drivers): return fam
+    return "cisco"
+
+RE_NOISE_SOLO = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)") # 番号/名前付きの後方参照・全体フラグ: 1本にまとめると意味が変わる
+
+class NoiseFilter:
+    """ファミリーごとの除外ルールを1本の正規表現にまとめ、1行1回の照合で除外する
+    後方参照や (?i) などを含むルールはまとめずに単独で照合し、コンパイルできないルールは読み飛ばす"""
+    def __init__(self, rules=None, path=NOISE_FILTER_FILE):
+        self.path, self.base = path, rules or NOISE_RULES
+        self.mtime, self.rules, self.compiled, self.errors = None, {}, {}, []
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        rules, errors = {fam: dict(r) for fam, r in self.base.items()}, []
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding='utf-8-sig') as f: user = json.load(f)
+            for fam, r in user.items(): rules.setdefault(fam, {}).update(r)
+        except (OSError, ValueError): mtime = None
+        for fam, r in rules.items():
+            for rname, pat in list(r.items()):
+                if not pat: continue
+                try: re.compile(pat, re.I)
+                except (re.error, TypeError) as e: errors.append(f"{fam}.{rname}: {e}"); del r[rname]
+        with self.lock: self.rules, self.compiled, self.mtime, self.errors = rules, {}, mtime, errors
+
+    def take_errors(self):
+        """reload で読み飛ばしたルールを1回だけ返す (比較ログへの警告用)"""
+        with self.lock: errors, self.errors = self.errors, []
+        return errors
+
+    def _check_file(self):
+        try: mtime = os.path.getmtime(self.path)
+        except OSError: mtime = None
+        if mtime != self.mtime: self.reload()
+
+    def _compile(self, fam):
+        # 先頭が ^ のルールは match 用に1本、それ以外は search 用に1本へ結合する。グループ名からルール名を引く
+        anchored, floating, solo, names = [], [], [], {}
+        for src, rules in (("common", self.rules.get("common", {})), (fam, self.rules.get(fam, {}))):
+            for rname, pat in rules.items():
+                if not pat: continue
+                if RE_NOISE_SOLO.search(pat): solo.append((re.compile(pat, re.I).search, f"{src}.{rname}")); continue
+                g = f"r{len(names)}"; names[g] = f"{src}.{rname}"
+                if pat.startswith("^"): anchored.append(f"(?P<{g}>{pat[1:]})")
+                else: floating.append(f"(?P<{g}>{pat})")
+        m = re.compile("|".join(anchored), re.I).match if anchored else None
+        s = re.compile("|".join(floating), re.I).search if floating else None
+        return m, s, names, solo
+
+    def clean(self, text, vendor=None, stats=None):
+        """除外後の行リストを返す。stats (dict) を渡すとルール名ごとの除外行数を加算する"""
+        if not isinstance(text, str): return []
+        self._check_file()
+        fam = vendor_family(vendor)
+        c = self.compiled.get(fam)
+        if c is None:
+            try: c = self._compile(fam)
+            except re.error as e: # 単独では通るが結合すると壊れるルール: 全ルールを単独照合に切り替える
+                with self.lock: self.errors.append(f"{fam}: ルールを結合できないため個別に照合します ({e})")
+                c = (None, None, {}, [(re.compile(p, re.I).search, f"{src}.{n}") for src in ("common", fam) for n, p in self.rules.get(src, {}).items() if p])
+            self.compiled[fam] = c
+        match, search, names, solo = c
+        kept = []
+        for l in text.splitlines():
+            hit = (match and match(l)) or (search and search(l))
+            if hit: k = names[hit.lastgroup]
+            else: k = next((n for f, n in solo if f(l)), None)
+            if k is None: kept.append(l)
+            elif stats is not None: stats[k] = stats.get(k, 0) + 1
+        return kept
+
+NOISE_FILTER = NoiseFilter()
+
+def clean_text_for_diff(text, vendor=None, stats=None):
+    return NOISE_FILTER.clean(text, vendor, stats)
+
+# --- 差分エンジン ---
+# どちらも (' ' | '-' | '+', 行) の列を返す。generate_side_by_side_html はこの列から表を組み立てる
+def diff_ops_ndiff(a, b):
+    """従来方式 (difflib.ndiff)。行内の類似度計算を行うため大きな差分では遅い"""
+    return [(l[0], l[2:]) for l in difflib.ndiff(a, b) if l[:2] in ('  ', '- ', '+ ')]
+
+def _myers(a, b, alo, ahi, blo, bhi, out):
+    n, m = ahi - alo, bhi - blo
+    v, trace = {1: 0}, []
+    for d in range(min(n + m, DIFF_MAX_EDIT) + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            x = v[k + 1] if k == -d or (k != d and v[k - 1] < v[k + 1]) else v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]: x += 1; y += 1
+            v[k] = x
+            if x >= n and y >= m: break
+        else: continue
+        break
+    else:
+        # 編集距離が上限を超えた: 区間全体を削除+追加として扱う
+        out.extend(('-', alo + i) for i in range(n)); out.extend(('+', blo + j) for j in range(m)); return
+    ops, x, y = [], n, m
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]; k = x - y
+        pk = k + 1 if k == -d or (k != d and v[k - 1] < v[k + 1]) else k - 1
+        px = v[pk]; py = px - pk
+        while x > px and y > py: x -= 1; y -= 1; ops.append(('=', alo + x))
+        if x == px: y -= 1; ops.append(('+', blo + y))
+        else: x -= 1; ops.append(('-', alo + x))
+    while x > 0 and y > 0: x -= 1; y -= 1; ops.append(('=', alo + x))
+    out.extend(reversed(ops))
+
+def _patience(a, b, alo, ahi, blo, bhi, out, depth=0):
+    # 先頭・末尾の共通行はそのまま一致として扱う (設定差分の大半はここで終わる)
+    while alo < ahi and blo < bhi and a[alo] == b[blo]: out.append(('=', alo)); alo += 1; blo += 1
+    tail = 0
+    while ahi - tail > alo and bhi - tail > blo and a[ahi - tail - 1] == b[bhi - tail - 1]: tail += 1
+    ahi -= tail; bhi -= tail
+    if alo == ahi: out.extend(('+', j) for j in range(blo, bhi))
+    elif blo == bhi: out.extend(('-', i) for i in range(alo, ahi))
+    elif (ahi - alo) + (bhi - blo) <= 400 or depth > 64: _myers(a, b, alo, ahi, blo, bhi, out) # 小さな区間は Myers (最短編集) で十分速い
+    else:
+        # 両側で1回だけ現れる行をアンカー候補とし、順序の保たれる最長部分列 (LIS) で区切る (patience)
+        cnt_a, cnt_b, pos_b = defaultdict(int), defaultdict(int), {}
+        for i in range(alo, ahi): cnt_a[a[i]] += 1
+        for j in range(blo, bhi): cnt_b[b[j]] += 1; pos_b[b[j]] = j
+        pairs = [(i, pos_b[a[i]]) for i in range(alo, ahi) if cnt_a[a[i]] == 1 and cnt_b.get(a[i]) == 1]
+        tails, tail_idx, prev = [], [], [-1] * len(pairs)
+        for n, (_, j) in enumerate(pairs):
+            p = bisect.bisect_left(tails, j)
+            if p: prev[n] = tail_idx[p - 1]
+            if p == len(tails): tails.append(j); tail_idx.append(n)
+            else: tails[p] = j; tail_idx[p] = n
+        anchors, n = [], tail_idx[-1] if tail_idx else -1
+        while n >= 0: anchors.append(pairs[n]); n = prev[n]
+        if not anchors:
+            _myers(a, b, alo, ahi, blo, bhi, out)
+        else:
+            for i, j in reversed(anchors):
+                _patience(a, b, alo, i, blo, j, out, depth + 1); out.append(('=', i)); alo, blo = i + 1, j + 1
+            _patience(a, b, alo, ahi, blo, bhi, out, depth + 1)
+    out.extend(('=', i) for i in range(ahi, ahi + tail))
+
+def diff_ops_fast(a, b):
+    """行をIDに置き換えてから patience 分割 + Myers で差分を取る (行内の比較はしない)"""
+    ids = {}
+    ia = [ids.setdefault(l, len(ids)) for l in a]; ib = [ids.setdefault(l, len(ids)) for l in b]
+    out = []; _patience(ia, ib, 0, len(ia), 0, len(ib), out)
+    return [(' ', a[i]) if t == '=' else ('-', a[i]) if t == '-' else ('+', b[i]) for t, i in out]
+
+DIFF_BACKENDS = {"fast": diff_ops_fast, "ndiff": diff_ops_ndiff}
+
+def generate_side_by_side_html(old_lines, new_lines, cmd_name="", backend=None):
+    diff = DIFF_BACKENDS[backend or DIFF_BACKEND](old_lines, new_lines)
     rows, p_left, p_right = [], [], []
     def flush():
         for i in range(max(len(p_left), len(p_right))):
@@ -236,16 +716,540 @@ def generate_side_by_side_html(old_lines, new_lines, cmd_name=""):
             else:
                 rows.append(f'<tr><td style="color:#ff5555; background-color:#3a1a1a;">{l_v}</td><td style="color:#5555ff; background-color:#1a1a3a;">{r_v}</td></tr>')
         p_left.clear(); p_right.clear()
-    for line in diff:
-        pre, con = line[:2], line[2:]
-        if pre == '  ': flush(); rows.append(f'<tr><td>{con}</td><td>{con}</td></tr>')
-        elif pre == '- ': p_left.append(con)
-        elif pre == '+ ': p_right.append(con)
+    for pre, con in diff:
+        if pre == ' ': flush(); rows.append(f'<tr><td>{con}</td><td>{con}</td></tr>')
+        elif pre == '-': p_left.append(con)
+        elif pre == '+': p_right.append(con)
     flush()
     title_html = f'<div style="color:#FFFF00; font-weight:bold; margin-top:15px; text-align:left;">[差分あり] {cmd_name}</div>'
     table_html = f'<table border="0" width="100%" style="border-collapse:collapse; font-family:Consolas, monospace; color:#DDD; background:#1E1E1E; margin-left:0;"><tr style="background-color:#004d4d; color:#FFF;"><th>[ 前回 ]</th><th>[ 今回 ]</th></tr>{"".join(rows)}</table>'
     return title_html + table_html
 
+def benchmark_diff(lines=30000, change_ratio=0.01, seed=1):
+    """大きな設定ファイルを模したデータで差分エンジンを比較する (--headless --bench diff)"""
+    rnd = random.Random(seed); old = []
+    for i in range(lines // 6):
+        old += [f"interface GigabitEthernet1/0/{i}", f" description link-{rnd.randrange(10**6)}", " switchport mode access",
+                f" switchport access vlan {rnd.randrange(1, 4000)}", " spanning-tree portfast", "!"]
+    new = list(old)
+    for _ in range(int(len(new) * change_ratio)):
+        i = rnd.randrange(len(new)); op = rnd.random()
+        if op < 0.4: new[i] = f" description changed-{rnd.randrange(10**6)}"
+        elif op < 0.7: new.insert(i, f" ip address 10.{rnd.randrange(256)}.{rnd.randrange(256)}.1 255.255.255.0")
+        else: del new[i]
+    old_c, new_c = clean_text_for_diff("\n".join(old)), clean_text_for_diff("\n".join(new))
+    result, htmls = {}, set()
+    for name in DIFF_BACKENDS:
+        t0 = time.perf_counter(); html = generate_side_by_side_html(old_c, new_c, "bench", backend=name)
+        result[name] = (time.perf_counter() - t0, html.count("<tr>")); htmls.add(html)
+    return len(old_c), len(new_c), result, len(htmls) == 1
+
+def build_mesh_html(matrix):
+    hosts = sorted(matrix.keys())
+    html = f'<div style="text-align: left; margin-left: 0; margin-top: 20px;">'
+    html += f'<div style="color:#FFFF00; font-weight:bold; margin-bottom: 10px; font-family:sans-serif;">疎通マトリックス結果</div>'
+    html += '<table border="1" style="border-collapse:collapse; margin-left:0; color:#eee; background:#222; text-align:center; width: auto; font-family:Consolas, monospace;">'
+    html += '<tr style="background:#444;"><th>FROM \\ TO</th>' + "".join([f'<th style="padding:5px 10px;">{h}</th>' for h in hosts]) + '</tr>'
+    for src in hosts:
+        row = f'<tr><td style="background:#444; padding:5px 10px;"><b>{src}</b></td>'
+        for dst in hosts:
+            st = matrix[src].get(dst, "-"); color = "#00FF00" if st == "OK" else "#FF5555" if st == "NG" else "#888"
+            row += f'<td style="color:{color}; font-weight:bold; padding:5px 10px;">{st}</td>'
+        html += row + '</tr>'
+    html += '</table></div>'
+    return html
+
+# --- レポート (断片はディスクへ逐次書き出し、保存時は閲覧ページ + 機器ごとのデータに分ける) ---
+# <名前>.html              : 閲覧ページ (一覧 = 機器・差分件数をページ内に持ち、各機器の本文は開いた時に読み込む)
+# <名前>_data/index.json   : 一覧 (機器, 断片数, 差分件数, サイズ)
+# <名前>_data/dNNNNN.js    : 機器ごとの本文 NV.section(番号, [HTML断片...]) (file:// でも <script> なら読める)
+class ReportSpool:
+    """レポートの HTML 断片を機器ごとのファイル (1行 = 1断片の JSON) に追記し、メモリには一覧だけを持つ"""
+    def __init__(self, root=REPORT_SPOOL_DIR):
+        self.root, self.dir, self.lock = root, None, threading.Lock()
+        self.devices = OrderedDict() # 機器名 -> {'file', 'sections', 'diffs', 'bytes'} (最初に出てきた順)
+
+    def __bool__(self): return bool(self.devices)
+
+    def add(self, name, html, diff=False):
+        line = json.dumps(html, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.dir is None:
+                os.makedirs(self.root, exist_ok=True); self.dir = tempfile.mkdtemp(prefix=datetime.now().strftime("%Y%m%d_%H%M%S_"), dir=self.root)
+            d = self.devices.get(name)
+            if d is None: d = self.devices[name] = {'file': f"d{len(self.devices):05d}", 'sections': 0, 'diffs': 0, 'bytes': 0}
+            with open(os.path.join(self.dir, d['file'] + ".jsonl"), "a", encoding='utf-8') as f: f.write(line)
+            d['sections'] += 1; d['diffs'] += 1 if diff else 0; d['bytes'] += len(line)
+
+    def export(self, path, title="NetVerify Report"):
+        """閲覧ページ (path) と <名前>_data/ を書き出す。本文は断片ファイルを1行ずつ写すだけで全体は読み込まない"""
+        stem = os.path.splitext(path)[0]; data_dir = stem + "_data"; os.makedirs(data_dir, exist_ok=True)
+        with self.lock: items = [(n, dict(d)) for n, d in self.devices.items()]
+        for k, (name, d) in enumerate(items):
+            with open(os.path.join(data_dir, d['file'] + ".js"), "w", encoding='utf-8') as out:
+                out.write(f"NV.section({k},[")
+                with open(os.path.join(self.dir, d['file'] + ".jsonl"), encoding='utf-8') as src:
+                    for j, line in enumerate(src): out.write(("," if j else "") + line.rstrip("\n"))
+                out.write("]);\n")
+        index = {'title': title, 'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'data': os.path.basename(data_dir),
+                 'devices': [{'name': n, **d} for n, d in items]}
+        with open(os.path.join(data_dir, "index.json"), "w", encoding='utf-8') as f: json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+        page = REPORT_VIEWER_HTML.replace("/*TITLE*/", html_escape(title)).replace("/*PAGE*/", str(REPORT_PAGE_SIZE))
+        with open(path, "w", encoding='utf-8') as f: f.write(page.replace("/*INDEX*/", json.dumps(index, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/")))
+        return path
+
+    def close(self):
+        with self.lock:
+            if self.dir: shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None; self.devices = OrderedDict()
+
+REPORT_VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>/*TITLE*/</title>
+<style>
+  body { background: #111; color: #eee; padding: 20px 30px; font-family: sans-serif; margin: 0; }
+  .summary span { display: inline-block; margin-right: 24px; color: #aaa; } .summary b { color: #fff; font-size: 20px; }
+  .bar { margin: 12px 0; } .bar input, .bar button, .bar label { background: #333; color: #eee; border: 1px solid #555; padding: 4px 10px; margin-right: 6px; }
+  table.idx { border-collapse: collapse; width: 100%; } table.idx th { background: #004d4d; text-align: left; padding: 4px 8px; }
+  table.idx td { padding: 4px 8px; border-bottom: 1px solid #333; } tr.dev { cursor: pointer; } tr.dev:hover { background: #222; }
+  .diff { color: #FFFF00; } .same { color: #00FF00; } .body { padding: 8px 0 16px 0; } .muted { color: #888; }
+</style>
+</head>
+<body>
+<h2>/*TITLE*/</h2>
+<div class="summary" id="summary"></div>
+<div class="bar"><input id="q" placeholder="機器名で絞り込み"><label><input type="checkbox" id="only"> 差分ありのみ</label>
+<button id="prev">&lt;</button><span id="pageinfo" class="muted"></span><button id="next">&gt;</button></div>
+<table class="idx"><thead><tr><th>機器</th><th>差分</th><th>項目</th><th>サイズ</th></tr></thead><tbody id="rows"></tbody></table>
+<script>
+var INDEX = /*INDEX*/, PAGE = /*PAGE*/, page = 0, shown = [], loaded = {}, waiting = {};
+var NV = { section: function (k, frags) { loaded[k] = frags.join(""); (waiting[k] || []).forEach(function (f) { f(); }); delete waiting[k]; } };
+function esc(s) { return String(s).replace(/[&<>"]/g, function (c) { return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c]; }); }
+function size(b) { return b < 1024 ? b + " B" : b < 1048576 ? (b / 1024).toFixed(1) + " KB" : (b / 1048576).toFixed(1) + " MB"; }
+function load(k, done) {  // 機器ごとのデータは script 要素で読み込む (file:// では fetch が使えないため)
+  if (k in loaded) return done();
+  if (waiting[k]) return waiting[k].push(done);
+  waiting[k] = [done]; var s = document.createElement("script");
+  s.src = encodeURIComponent(INDEX.data) + "/" + INDEX.devices[k].file + ".js";
+  s.onerror = function () { loaded[k] = '<div class="muted">読み込めませんでした: ' + esc(s.src) + '</div>'; NV.section(k, [loaded[k]]); };
+  document.head.appendChild(s);
+}
+function toggle(tr, k) {
+  var next = tr.nextSibling;
+  if (next && next.className === "open") { tr.parentNode.removeChild(next); return; }
+  var row = document.createElement("tr"); row.className = "open"; row.innerHTML = '<td colspan="4" class="body muted">読み込み中...</td>';
+  tr.parentNode.insertBefore(row, tr.nextSibling);
+  load(k, function () { row.firstChild.className = "body"; row.firstChild.innerHTML = loaded[k]; });
+}
+function render() {
+  var q = document.getElementById("q").value.toLowerCase(), only = document.getElementById("only").checked;
+  shown = [];
+  INDEX.devices.forEach(function (d, k) { if ((!q || d.name.toLowerCase().indexOf(q) >= 0) && (!only || d.diffs)) shown.push(k); });
+  var pages = Math.max(1, Math.ceil(shown.length / PAGE)); page = Math.min(page, pages - 1);
+  var body = document.getElementById("rows"), html = [];
+  shown.slice(page * PAGE, page * PAGE + PAGE).forEach(function (k) {
+    var d = INDEX.devices[k];
+    html.push('<tr class="dev" data-k="' + k + '"><td>' + esc(d.name) + '</td><td class="' + (d.diffs ? "diff" : "same") + '">' + (d.diffs ? d.diffs + " 件" : "なし") +
+              '</td><td>' + d.sections + '</td><td class="muted">' + size(d.bytes) + '</td></tr>');
+  });
+  body.innerHTML = html.join("") || '<tr><td colspan="4" class="muted">該当なし</td></tr>';
+  document.getElementById("pageinfo").textContent = " " + (page + 1) + " / " + pages + " (" + shown.length + "台) ";
+}
+document.getElementById("rows").onclick = function (e) {
+  var tr = e.target.closest("tr.dev"); if (tr) toggle(tr, +tr.getAttribute("data-k"));
+};
+document.getElementById("q").oninput = function () { page = 0; render(); };
+document.getElementById("only").onchange = function () { page = 0; render(); };
+document.getElementById("prev").onclick = function () { if (page > 0) { page--; render(); } };
+document.getElementById("next").onclick = function () { if ((page + 1) * PAGE < shown.length) { page++; render(); } };
+var n = INDEX.devices.length, nd = 0, td = 0;
+INDEX.devices.forEach(function (d) { if (d.diffs) nd++; td += d.diffs; });
+document.getElementById("summary").innerHTML = '<span>作成 <b>' + esc(INDEX.created) + '</b></span><span>機器 <b>' + n + '</b></span><span>差分あり <b class="diff">' + nd +
+  '</b></span><span>差分なし <b class="same">' + (n - nd) + '</b></span><span>差分件数 <b>' + td + '</b></span>';
+render();
+</script>
+</body>
+</html>
+"""
+
+# --- スナップショット保存 (SnapshotStore) ---
+# snapshots/objects/ab/<sha256>.z    : コマンド出力本体 (zlib圧縮、同一内容は1つだけ保存)
+# snapshots/manifests/<host>/<ts>.json : 実行ごとの {コマンド: ハッシュ} 一覧
+# snapshots/manifests/<host>/index.json: {"latest": ts, "master": ts, "history": [ts, ...]}
+class SnapshotStore:
+    """コマンド出力を内容ハッシュで重複排除・圧縮して保存するスナップショット置き場"""
+    def __init__(self, root=SNAPSHOT_DIR):
+        self.root = root
+        self.obj_dir, self.man_dir = os.path.join(root, "objects"), os.path.join(root, "manifests")
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _blob_path(self, d):
+        return os.path.join(self.obj_dir, d[:2], d[2:] + ".z")
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, path)
+
+    def put(self, text):
+        """出力を保存してハッシュを返す (既に同じ内容があれば書き込まない)"""
+        text = text if isinstance(text, str) else str(text)
+        d = self.digest(text); path = self._blob_path(d)
+        if not os.path.exists(path): self._write_atomic(path, zlib.compress(text.encode('utf-8'), 6))
+        return d
+
+    def get(self, d):
+        with open(self._blob_path(d), "rb") as f: return zlib.decompress(f.read()).decode('utf-8')
+
+    def _host_dir(self, name):
+        return os.path.join(self.man_dir, sanitize_filename(name))
+
+    def _read_index(self, name):
+        try:
+            with open(os.path.join(self._host_dir(name), "index.json"), "r", encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def save(self, name, outputs, master=False, hashes=None):
+        """outputs = {コマンド: 出力} を1回分のスナップショットとして登録し、manifest を返す (hashes は put 済みの値)"""
+        hashes = hashes or {}
+        cmds = dict(hashes)
+        cmds.update((cmd, self.put(out)) for cmd, out in outputs.items() if not cmds.get(cmd))
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        manifest = {"host": name, "time": ts, "master": bool(master), "commands": cmds}
+        self._write_atomic(os.path.join(self._host_dir(name), f"{ts}.json"), json.dumps(manifest, ensure_ascii=False, separators=(",", ":")).encode('utf-8'))
+        with self.lock:
+            idx = self._read_index(name) or {"latest": None, "master": None, "history": []}
+            idx["master" if master else "latest"] = ts
+            idx["history"].append(ts)
+            self._write_atomic(os.path.join(self._host_dir(name), "index.json"), json.dumps(idx, separators=(",", ":")).encode('utf-8'))
+        return manifest
+
+    def load(self, name, ref="latest"):
+        """ref = "latest" / "master" / 実行時刻(ts)。無ければ None"""
+        idx = self._read_index(name)
+        if idx is None:
+            idx = self._migrate_legacy(name)
+            if idx is None: return None
+        ts = idx.get(ref) if ref in ("latest", "master") else ref
+        if not ts: return None
+        try:
+            with open(os.path.join(self._host_dir(name), f"{ts}.json"), "r", encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def latest_outputs(self, name, match, depth=SNAPSHOT_LOOKBACK):
+        """match(コマンド) が真のコマンドについて、新しい順に depth 回分さかのぼった最新の出力を {コマンド: 出力} で返す"""
+        idx = self._read_index(name) or self._migrate_legacy(name) or {}
+        found = {}
+        for ts in list(reversed(idx.get("history", [])))[:depth]:
+            man = self.load(name, ts)
+            for cmd, d in ((man or {}).get("commands") or {}).items():
+                if cmd in found or not d or not match(cmd): continue
+                try: found[cmd] = self.get(d)
+                except (OSError, zlib.error): pass
+        return found
+
+    def previous(self, name):
+        """最新の1つ前の通常スナップショット (履歴参照用)"""
+        idx = self._read_index(name) or {}
+        hist = [t for t in idx.get("history", []) if t != idx.get("master")]
+        return self.load(name, hist[-2]) if len(hist) >= 2 else None
+
+    def _migrate_legacy(self, name):
+        # 旧形式 snapshot_<host>.json / snapshot_<host>_master.json を初回参照時に取り込む
+        h_file = sanitize_filename(name); found = False
+        for master, fname in ((False, f"snapshot_{h_file}.json"), (True, f"snapshot_{h_file}_master.json")):
+            path = os.path.join(self.root, fname)
+            if not os.path.exists(path): continue
+            try:
+                with open(path, "r", encoding='utf-8') as f: self.save(name, json.load(f), master=master)
+                found = True
+            except (OSError, ValueError): pass
+        return self._read_index(name) if found else None
+
+SNAPSHOT_STORE = SnapshotStore()
+
+# --- SSHセッションプール (SessionPool) ---
+class SessionPool:
+    """(host, device_type, 認証情報) をキーに enable 済みの netmiko 接続を再利用する"""
+    def __init__(self, max_idle=SESSION_POOL_SIZE, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.max_idle, self.idle_timeout = max_idle, idle_timeout
+        self.idle = OrderedDict() # key -> [(net, last_used), ...] 。末尾ほど最近使用 (LRU)
+        self.lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "evicted": 0}
+
+    @staticmethod
+    def key(dev):
+        cred = hashlib.sha256(f"{dev.get('username')}\0{dev.get('password')}\0{dev.get('secret')}".encode('utf-8')).hexdigest()
+        return (dev['host'], dev['device_type'], dev.get('port'), cred)
+
+    @staticmethod
+    def _close(net):
+        try: net.disconnect()
+        except: pass
+
+    @staticmethod
+    def _healthy(net):
+        # 切断検知 + プロンプト確認。enable が外れていれば入り直す
+        try:
+            if not net.is_alive(): return False
+            if ">" in net.find_prompt(): net.enable()
+            return True
+        except Exception:
+            return False
+
+    def _pop_expired(self):
+        now, dead = time.monotonic(), []
+        for k in list(self.idle):
+            keep = []
+            for net, ts in self.idle[k]:
+                (dead if now - ts > self.idle_timeout else keep).append((net, ts))
+            if keep: self.idle[k] = keep
+            else: del self.idle[k]
+        while sum(len(v) for v in self.idle.values()) > self.max_idle:
+            k, entries = next(iter(self.idle.items()))
+            dead.append(entries.pop(0))
+            if not entries: del self.idle[k]
+            self.stats["evicted"] += 1
+        return [net for net, _ in dead]
+
+    def acquire(self, dev):
+        k = self.key(dev)
+        while True:
+            with self.lock:
+                dead = self._pop_expired()
+                entries = self.idle.get(k)
+                net = entries.pop()[0] if entries else None
+                if entries is not None and not entries: del self.idle[k]
+            for d in dead: self._close(d)
+            if net is None: break
+            if self._healthy(net):
+                with self.lock: self.stats["hit"] += 1
+                return net
+            self._close(net)
+        with self.lock: self.stats["miss"] += 1
+        from netmiko import ConnectHandler
+        net = ConnectHandler(**dev)
+        if ">" in net.find_prompt(): net.enable()
+        net._pool_key = k
+        return net
+
+    def release(self, net, discard=False):
+        if discard:
+            self._close(net); return
+        with self.lock:
+            self.idle.setdefault(net._pool_key, []).append((net, time.monotonic()))
+            self.idle.move_to_end(net._pool_key)
+            dead = self._pop_expired()
+        for d in dead: self._close(d)
+
+    @staticmethod
+    def discard(net):
+        """途中で打ち切ったコマンドの出力が残っているなど、再利用できないセッションに印を付ける (connection() を抜けた時に切断)"""
+        net._pool_dirty = True
+
+    @contextmanager
+    def connection(self, dev):
+        """with SESSION_POOL.connection(dev) as net: ... 例外時や discard() したセッションは再利用せず切断する"""
+        net = self.acquire(dev); ok = False
+        try:
+            yield net; ok = True
+        finally:
+            self.release(net, discard=not ok or getattr(net, "_pool_dirty", False))
+
+    def reap(self):
+        with self.lock: dead = self._pop_expired()
+        for d in dead: self._close(d)
+
+    def close_all(self):
+        with self.lock:
+            dead = [net for entries in self.idle.values() for net, _ in entries]; self.idle.clear()
+        for d in dead: self._close(d)
+
+SESSION_POOL = SessionPool()
+
+# --- フルメッシュPingエンジン (MeshPingEngine) ---
+# batch: "pipe" = コマンドを先行入力でまとめて送信しプロンプト単位で切り分け / "script" = シェルで一括並列実行 / None = 1件ずつ
+# wait: 1ターゲットあたりの最大所要秒 (バッチ全体のタイムアウト計算用)
+MESH_PING_MAP = {
+    "cisco": {"cmd": "ping {ip} repeat 2 timeout 1", "ok": "Success rate is 100", "batch": "pipe", "wait": 4},
+    "junos": {"cmd": "ping {ip} count 2 wait 1", "ok": "0% packet loss", "batch": None, "wait": 4},
+    "fortinet": {"cmd": "execute ping {ip}", "ok": "0% packet loss", "batch": None, "wait": 8},
+    "fortigate": {"cmd": "execute ping {ip}", "ok": "0% packet loss", "batch": None, "wait": 8},
+    "yamaha": {"cmd": "ping {ip} count 2", "ok": "Received from", "batch": None, "wait": 4},
+    "aruba": {"cmd": "ping {ip} count 2", "ok": "0% packet loss", "batch": "pipe", "wait": 4},
+    "hp": {"cmd": "ping {ip} count 2", "ok": "is alive", "batch": "pipe", "wait": 4},
+    "allied": {"cmd": "ping {ip} count 2", "ok": "received", "batch": "pipe", "wait": 4},
+    "arista": {"cmd": "ping {ip} repeat 2", "ok": "0% packet loss", "batch": "pipe", "wait": 4},
+    "nec": {"cmd": "ping {ip} count 2", "ok": "0% packet loss", "batch": "pipe", "wait": 4},
+    "linux": {"cmd": "ping -c 2 -W 1 {ip}", "ok": "0% packet loss", "batch": "script", "wait": 3},
+}
+RE_NO_LOSS = re.compile(r"(?<![\d.])0(?:\.0+)?% packet loss") # "100% packet loss" に誤マッチしないように
+RE_IPV4 = re.compile(r"\b(\d{1,3}(?:\.\d{1,3}){3})\b")
+
+class MeshPingEngine:
+    """送信元1台ぶんのPingをバッチ化し、結果を {宛先名: OK/NG/SELF} の行列形式で返す"""
+    def __init__(self, targets, batch_size=MESH_BATCH_SIZE, log=None, cancelled=None):
+        self.targets, self.batch_size = targets, max(1, batch_size)
+        self.log = log or (lambda *a: None)
+        self.cancelled = cancelled or (lambda: False)
+
+    @staticmethod
+    def logic_for(vendor):
+        return next((v for k, v in MESH_PING_MAP.items() if k in vendor), MESH_PING_MAP["cisco"])
+
+    @staticmethod
+    def is_ok(logic, res):
+        if "packet loss" in logic["ok"]: return bool(RE_NO_LOSS.search(res))
+        return logic["ok"] in res
+
+    def probe(self, net, h, results=None):
+        """接続済みの net から全ターゲットへPingし、results (dict) を埋めて返す"""
+        results = {} if results is None else results
+        name, vendor = h['name'], str(h.get('vendor') or 'cisco_ios').strip().lower()
+        logic = self.logic_for(vendor)
+        todo = []
+        for t in self.targets:
+            if t['ip'] == h['ip']: results[t['name']] = "SELF"
+            else: todo.append(t)
+        for i in range(0, len(todo), self.batch_size):
+            if self.cancelled(): break
+            chunk = todo[i:i + self.batch_size]
+            self.log(name, f"Ping -> {', '.join(t['name'] for t in chunk)} ({len(chunk)}件)", "#AAAAAA")
+            try:
+                if logic["batch"] == "script": got = self._run_script(net, logic, chunk)
+                elif logic["batch"] == "pipe" and len(chunk) > 1: got = self._run_pipelined(net, logic, chunk)
+                else: got = {}
+            except Exception as e:
+                if getattr(net, "_pool_dirty", False): raise # 先行入力の出力が残ったチャネルでは1件ずつの再試行もしない
+                self.log(name, f"  バッチ実行失敗、1件ずつ再試行します: {e}", "#FFA500"); got = {}
+            dirty = getattr(net, "_pool_dirty", False)
+            for t in chunk:
+                if self.cancelled(): break
+                if t['name'] not in got: # バッチで判定できなかった分は従来どおり1件ずつ (チャネルが汚れていれば未判定のまま)
+                    if dirty: continue
+                    got[t['name']] = "OK" if self.is_ok(logic, net.send_command(logic["cmd"].format(ip=t['ip']))) else "NG"
+                st = results[t['name']] = got[t['name']]
+                self.log(name, f"  {t['name']}({t['ip']}): {st}", "#00FF00" if st == "OK" else "#FF5555")
+            if dirty: raise RuntimeError(f"先行入力の応答が揃わなかったため中断しました (判定済み {len(got)}/{len(chunk)}件)")
+        return results
+
+    def _run_pipelined(self, net, logic, chunk):
+        # 先行入力(typeahead)で全コマンドを一度に送り、プロンプトが件数分返るまで読む
+        prompt = net.find_prompt().strip()
+        net.write_channel("".join(logic["cmd"].format(ip=t['ip']) + net.RETURN for t in chunk))
+        buf, deadline = "", time.monotonic() + logic["wait"] * len(chunk) + 10
+        while buf.count(prompt) < len(chunk) and time.monotonic() < deadline and not self.cancelled():
+            data = net.read_channel()
+            if data: buf += data
+            else: time.sleep(0.1)
+        if buf.count(prompt) < len(chunk):
+            # 未完了のPingが機器側で走り続けているので Ctrl-C で止め、出力が混ざる可能性のあるセッションは捨てる
+            try: net.write_channel("\x03")
+            except Exception: pass
+            SESSION_POOL.discard(net) # probe 側は完了分だけ記録して例外で抜ける
+        by_ip = defaultdict(list)
+        for t in chunk: by_ip[t['ip']].append(t['name'])
+        got = {}
+        for part in buf.split(prompt)[:-1]: # 後ろにプロンプトが続いた区間 = 完了したコマンド
+            m = RE_IPV4.search(part.strip().split("\n", 1)[0]) # 各区間の先頭行 = コマンドのエコー
+            if m and m.group(1) in by_ip:
+                for n in by_ip.pop(m.group(1)): got[n] = "OK" if self.is_ok(logic, part) else "NG"
+        return got
+
+    def _run_script(self, net, logic, chunk):
+        # シェル上で全ターゲットへ並列にPingし、1行ずつ結果を返させる
+        ips = " ".join(sorted({t['ip'] for t in chunk}))
+        ping = logic["cmd"].format(ip="$ip")
+        script = f'for ip in {ips}; do ( {ping} >/dev/null 2>&1 && echo "MESH $ip OK" || echo "MESH $ip NG" ) & done; wait'
+        out = net.send_command(script, read_timeout=logic["wait"] + 30)
+        res = {m.group(1): m.group(2) for m in re.finditer(r"^MESH (\S+) (OK|NG)\s*$", out, re.M)}
+        return {t['name']: res[t['ip']] for t in chunk if t['ip'] in res}
+
+# --- 同時実行制御 (DeviceScheduler) ---
+class DeviceScheduler:
+    """機器ごとの処理をキューに積み、全体/サイト単位の上限内で順次起動する"""
+    def __init__(self, launch, max_workers=MAX_PARALLEL_DEVICES, site_limit=MAX_PARALLEL_PER_SITE, on_progress=None):
+        # launch(host) はワーカーを起動してハンドルを返す。完了時は release(handle) を呼ぶこと
+        self.launch, self.on_progress = launch, on_progress
+        self.max_workers, self.site_limit = max(1, int(max_workers)), max(0, int(site_limit))
+        self.site_queues = OrderedDict()   # site -> deque(host) 。サイト間はラウンドロビンで取り出す
+        self.running = {}                  # handle -> site
+        self.site_running = defaultdict(int)
+        self.total = self.done = self.failed = 0
+        self.cancelled = False
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def site_of(h):
+        return str(h.get('site') or '').strip()
+
+    def submit(self, hosts):
+        with self.lock:
+            for h in hosts: self.site_queues.setdefault(self.site_of(h), deque()).append(h)
+            self.total += len(hosts)
+        self.dispatch()
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self.site_queues.values())
+
+    def pending(self):
+        """待機中または実行中の機器が残っているか"""
+        with self.lock: return bool(self.running) or (not self.cancelled and self.queued > 0)
+
+    def _next_host(self):
+        for site in list(self.site_queues):
+            q = self.site_queues[site]
+            if not q: del self.site_queues[site]; continue
+            if site and self.site_limit and self.site_running[site] >= self.site_limit: continue
+            h = q.popleft()
+            self.site_queues.move_to_end(site) # 次回は別サイトを優先
+            if not q: del self.site_queues[site]
+            return site, h
+        return None, None
+
+    def dispatch(self):
+        with self.lock:
+            while not self.cancelled and len(self.running) < self.max_workers:
+                site, h = self._next_host()
+                if h is None: break
+                self.site_running[site] += 1
+                try:
+                    handle = self.launch(h)
+                except Exception:
+                    self.site_running[site] -= 1; self.done += 1; self.failed += 1; continue
+                self.running[handle] = site
+        self.notify()
+
+    def release(self, handle, failed=False):
+        """完了したワーカーの枠を即座に解放し、次の機器を起動する"""
+        with self.lock:
+            if handle not in self.running: return
+            site = self.running.pop(handle); self.site_running[site] -= 1
+            self.done += 1
+            if failed: self.failed += 1
+        self.dispatch()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True; self.site_queues.clear()
+        self.notify()
+
+    def progress(self):
+        with self.lock:
+            return {"total": self.total, "done": self.done, "failed": self.failed, "running": len(self.running), "queued": self.queued}
+
+    def notify(self):
+        if self.on_progress: self.on_progress(self.progress())
+
 # --- 処理スレッド (NetworkWorker) ---
 class NetworkWorker(QThread):
     log_signal = Signal(str, str, str)
@@ -253,15 +1257,16 @@ class NetworkWorker(QThread):
     finished_signal = Signal(str, list, dict)
     request_teraterm_path = Signal() 
 
-    def __init__(self, mode, host, show_output, scan_keywords, keywords_list, mesh_targets=None, compare_master=False, save_as_master=False, tt_path=None):
+    def __init__(self, mode, host, show_output, scan_keywords, keyword_scanner, mesh_targets=None, compare_master=False, save_as_master=False, tt_path=None, report=None):
         super().__init__()
         self.mode, self.host = mode, host
         self.mesh_targets = mesh_targets or []
         self.compare_master, self.save_as_master = compare_master, save_as_master
-        self.keywords_list, self.tt_path = keywords_list, tt_path
-        self.report_data, self.mesh_results = [], {}
+        self.keyword_scanner, self.tt_path = keyword_scanner, tt_path
+        self.report, self.mesh_results = report, {} # report: ReportSpool (差分の断片をその場でディスクへ)
         self.current_process = None # プロセス制御用
         self._is_cancelled = False # キャンセル制御フラグ
+        self.error = None # 失敗時の例外 (スケジューラの失敗件数集計用)
         if "3:" in mode: self.show_output, self.scan_keywords = False, False
         else: self.show_output, self.scan_keywords = show_output, scan_keywords
 
@@ -284,10 +1289,11 @@ class NetworkWorker(QThread):
             elif "5:" in self.mode: self.do_full_mesh_ping(h)
             else: self.do_netmiko(h, today)
         except Exception as e:
+            self.error = e
             self.log_signal.emit(name, f"[!] エラー: {str(e)}", "#FF5555")
         
         # 完了シグナル
-        self.finished_signal.emit(name, self.report_data, self.mesh_results)
+        self.finished_signal.emit(name, [], self.mesh_results)
 
     def do_ping(self, h, trace):
         if self._is_cancelled: return
@@ -361,29 +1367,31 @@ class NetworkWorker(QThread):
         if self._is_cancelled: return
         name = h['name']; v, p = str(h.get('vendor') or 'cisco_ios').strip().lower(), str(h.get('protocol') or 'ssh').strip().lower()
         dev = {'device_type': v + ('_telnet' if p == 'telnet' else ''), 'host': h['ip'], 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw'], 'global_delay_factor': 2}
-        with ConnectHandler(**dev) as net:
-            if ">" in net.find_prompt(): net.enable()
+        save_log, compare = "2:" in self.mode or "4:" in self.mode, "解析" in self.mode or "比較" in self.mode
+        with SESSION_POOL.connection(dev) as net, (open_device_log(name, today) if save_log else nullcontext()) as log:
             self.check_save_status(net, name, v)
-            outputs, log_body = {}, f"\n! --- Log: {datetime.now()} ---\n"
+            if log: log.write(f"\n! --- Log: {datetime.now()} ---\n")
+            hashes = {} # 出力本体は保持せず、受信した時点でログとスナップショット置き場へ書き出す
             for cmd in h.get('command_list', []):
                 if self._is_cancelled: break # コマンドループもキャンセル可能に
                 self.log_signal.emit(name, f"Command: {cmd}", "#AAAAAA")
                 out = net.send_command(cmd, strip_prompt=True, strip_command=True)
-                if self.scan_keywords and self.keywords_list:
-                    for kw in self.keywords_list:
-                        if kw and kw.lower() in out.lower():
-                            for line in out.splitlines():
-                                if kw.lower() in line.lower():
-                                    self.html_signal.emit(name, f'<div style="color:#FFFF00; white-space:pre-wrap; font-family:Consolas; text-align:left;">    [HIT] \'{kw}\': {line.strip()}</div>')
+                if self.scan_keywords and self.keyword_scanner:
+                    for kw, ln, line in self.keyword_scanner.scan(out):
+                        safe_line = line.strip().replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+                        self.html_signal.emit(name, f'<div style="color:#FFFF00; white-space:pre-wrap; font-family:Consolas; text-align:left;">    [HIT] \'{kw}\' (L{ln}): {safe_line}</div>')
                 if self.show_output: 
                     safe_out = out.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
                     self.html_signal.emit(name, f'<div style="color:#FFFFFF; white-space:pre-wrap; font-family:Consolas; text-align:left;">{safe_out}</div>')
-                outputs[cmd], log_body = out, log_body + f"{out}\n\n"
-            if "解析" in self.mode or "比較" in self.mode: self.do_compare(name, outputs, h.get('command_list', []))
-            if "2:" in self.mode or "4:" in self.mode:
-                f_p = os.path.join(LOG_DIR, f"{sanitize_filename(name)}_{today}.log")
-                with open(f_p, "a", encoding='utf-8') as f: f.write(log_body)
-                self.log_signal.emit(name, f"[Log Saved] {os.path.basename(f_p)}", "#00AAFF")
+                if log: log.write(f"{out}\n\n")
+                if compare: hashes[cmd] = SNAPSHOT_STORE.put(out)
+                del out
+            if log: log.flush(); self.log_signal.emit(name, f"[Log Saved] {os.path.basename(log.name)}", "#00AAFF")
+        if not compare: return
+        if self._is_cancelled or any(c not in hashes for c in h.get('command_list', [])):
+            # 途中で止めた回は比較も保存もしない (一部だけのスナップショットで latest / master を置き換えない)
+            self.log_signal.emit(name, "[Compare] 全コマンドを取得できなかったため、比較とスナップショット保存をスキップしました", "#FFA500"); return
+        self.do_compare(name, hashes, h.get('command_list', []))
 
     def check_save_status(self, net, name, vendor):
         self.log_signal.emit(name, "Running vs Startup 照合中...", "#888888")
@@ -397,183 +1405,462 @@ class NetworkWorker(QThread):
             elif "nec" in vendor: run_cmd, sta_cmd = "show running-config", "show config"
             
             run = net.send_command(run_cmd); sta = net.send_command(sta_cmd)
-            if clean_text_for_diff(run) != clean_text_for_diff(sta): self.log_signal.emit(name, "[!] 警告: 保存されていない設定があります", "#FF5555")
+            if clean_text_for_diff(run, vendor) != clean_text_for_diff(sta, vendor): self.log_signal.emit(name, "[!] 警告: 保存されていない設定があります", "#FF5555")
             else: self.log_signal.emit(name, "[OK] 設定保存済み", "#00FF00")
         except: pass
 
     def do_full_mesh_ping(self, h):
         if self._is_cancelled: return
-        name, vendor = h['name'], str(h.get('vendor') or 'cisco_ios').strip().lower()
+        vendor = str(h.get('vendor') or 'cisco_ios').strip().lower()
         dev = {'device_type': vendor + ('_telnet' if str(h.get('protocol')).lower() == 'telnet' else ''), 'host': h['ip'], 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw']}
-        ping_map = {
-            "cisco": {"cmd": "ping {ip} repeat 2 timeout 1", "ok": "Success rate is 100"},
-            "junos": {"cmd": "ping {ip} count 2 wait 1", "ok": "0% packet loss"},
-            "fortigate": {"cmd": "execute ping {ip}", "ok": "0% packet loss"},
-            "yamaha": {"cmd": "ping {ip} count 2", "ok": "Received from"},
-            "aruba": {"cmd": "ping {ip} count 2", "ok": "0% packet loss"},
-            "hp": {"cmd": "ping {ip} count 2", "ok": "is alive"},
-            "allied": {"cmd": "ping {ip} count 2", "ok": "received"},
-            "arista": {"cmd": "ping {ip} repeat 2", "ok": "100% packet loss"},
-            "nec": {"cmd": "ping {ip} count 2", "ok": "100% packet loss"}
-        }
-        logic = next((v for k, v in ping_map.items() if k in vendor), ping_map["cisco"])
-        with ConnectHandler(**dev) as net:
-            if ">" in net.find_prompt(): net.enable()
-            for t in self.mesh_targets:
-                if self._is_cancelled: break
-                if t['ip'] == h['ip']: self.mesh_results[t['name']] = "SELF"; continue
-                self.log_signal.emit(name, f"Ping -> {t['name']}({t['ip']})", "#AAAAAA")
-                res = net.send_command(logic["cmd"].format(ip=t['ip']))
-                
-                is_ok = False
-                if "packet loss" in logic["ok"]:
-                    if "0% packet loss" in res: is_ok = True
-                elif logic["ok"] in res:
-                    is_ok = True
-                
-                self.mesh_results[t['name']] = "OK" if is_ok else "NG"
-                self.log_signal.emit(name, f"  result: {'OK' if is_ok else 'NG'}", "#00FF00" if is_ok else "#FF5555")
-
-    def do_compare(self, name, current, cmds):
-        h_file = sanitize_filename(name)
-        target = os.path.join(SNAPSHOT_DIR, f"snapshot_{h_file}_master.json") if self.compare_master else os.path.join(SNAPSHOT_DIR, f"snapshot_{h_file}.json")
-        if os.path.exists(target):
-            self.log_signal.emit(name, f"[Compare] 使用ファイル: {os.path.basename(target)}", "#00AAFF")
-            try:
-                with open(target, "r", encoding='utf-8') as f: old = json.load(f)
-            except Exception as e:
-                self.log_signal.emit(name, f"[!] 比較元ファイル読み込み失敗: {e}", "#FF5555"); return
-            self.report_data.append(f'<h2 style="color:#00FFFF; border-bottom:2px solid #00FFFF; text-align:left;">Device: {name} (比較対象: {os.path.basename(target)})</h2>')
-            diff_count = 0
+        # 送信元の並列化は DeviceScheduler が担当。ここでは1台ぶんをバッチ実行する
+        engine = MeshPingEngine(self.mesh_targets, log=self.log_signal.emit, cancelled=lambda: self._is_cancelled)
+        with SESSION_POOL.connection(dev) as net:
+            engine.probe(net, h, self.mesh_results)
+
+    def add_report(self, name, html, diff=False):
+        if self.report is not None: self.report.add(name, html, diff)
+
+    def do_compare(self, name, cur_hash, cmds):
+        try:
+            old = SNAPSHOT_STORE.load(name, "master" if self.compare_master else "latest")
+        except Exception as e:
+            self.log_signal.emit(name, f"[!] 比較元スナップショット読み込み失敗: {e}", "#FF5555"); return
+        # 今回分は受信時に put 済み (cur_hash)。ハッシュが一致したコマンドは本文を読まずに同一と判定し、
+        # 差分がある場合だけ新旧をディスクから1コマンドずつ読み出す
+        if old:
+            label = f"{old['time'][:15]}{' (master)' if old.get('master') else ''}"
+            self.log_signal.emit(name, f"[Compare] 使用スナップショット: {label}", "#00AAFF")
+            self.add_report(name, f'<h2 style="color:#00FFFF; border-bottom:2px solid #00FFFF; text-align:left;">Device: {name} (比較対象: {label})</h2>')
+            diff_count, old_cmds, vendor, dropped = 0, old['commands'], self.host.get('vendor'), {}
             for cmd in cmds:
-                if cmd not in old:
+                if cmd not in cur_hash: continue
+                if cmd not in old_cmds:
                     msg = f'<div style="color:#FFFF00;">[新規取得] {cmd} が比較元に存在しません。</div>'
-                    self.html_signal.emit(name, msg); self.report_data.append(msg); diff_count += 1; continue
-                old_lines = clean_text_for_diff(old[cmd]); new_lines = clean_text_for_diff(current[cmd])
+                    self.html_signal.emit(name, msg); self.add_report(name, msg, True); diff_count += 1; continue
+                if old_cmds[cmd] == cur_hash[cmd]: continue
+                try: old_text, new_text = SNAPSHOT_STORE.get(old_cmds[cmd]), SNAPSHOT_STORE.get(cur_hash[cmd])
+                except Exception as e:
+                    self.log_signal.emit(name, f"[!] 比較元データ読み込み失敗 ({cmd}): {e}", "#FF5555"); continue
+                old_lines = clean_text_for_diff(old_text, vendor, dropped); new_lines = clean_text_for_diff(new_text, vendor, dropped)
+                del old_text, new_text
                 if old_lines != new_lines:
                     h_res = generate_side_by_side_html(old_lines, new_lines, cmd)
-                    self.html_signal.emit(name, h_res); self.report_data.append(h_res); diff_count += 1
+                    self.html_signal.emit(name, h_res); self.add_report(name, h_res, True); diff_count += 1
+                    del h_res
+            if dropped: self.log_signal.emit(name, "[Filter] 除外行数: " + ", ".join(f"{k}={v}" for k, v in sorted(dropped.items())), "#888888")
+            for e in NOISE_FILTER.take_errors(): self.log_signal.emit(name, f"[Filter] 無効な除外ルールを読み飛ばしました: {e}", "#FFA500")
             if diff_count == 0:
                 no_diff_msg = f'<div style="color:#00FF00; margin-top:10px; font-family:Consolas;">    [Result] 差分なし (Config is synced)</div>'
-                self.html_signal.emit(name, no_diff_msg); self.report_data.append(no_diff_msg)
+                self.html_signal.emit(name, no_diff_msg); self.add_report(name, no_diff_msg)
                 self.log_signal.emit(name, "    [Result] 差分なし (前回のスナップショットと同じです)", "#00FF00")
         else: self.log_signal.emit(name, f"[Compare] 比較対象なし (新規スナップショットとして扱います)", "#AAAAAA")
-        if self.save_as_master:
-            snap_path = os.path.join(SNAPSHOT_DIR, f"snapshot_{h_file}_master.json")
-            with open(snap_path, "w", encoding='utf-8') as f: json.dump(current, f, indent=4, ensure_ascii=False)
-            self.log_signal.emit(name, "[OK] Masterファイルとして保存しました。", "#00FF00")
-        else:
-            snap_path = os.path.join(SNAPSHOT_DIR, f"snapshot_{h_file}.json")
-            if os.path.exists(snap_path):
-                ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-                try: os.rename(snap_path, os.path.join(SNAPSHOT_DIR, f"snapshot_{h_file}_{ts}.json"))
-                except: pass
-            with open(snap_path, "w", encoding='utf-8') as f: json.dump(current, f, indent=4, ensure_ascii=False)
-            self.log_signal.emit(name, "[OK] スナップショットを作成（更新）しました。", "#00FF00")
+        SNAPSHOT_STORE.save(name, {}, master=self.save_as_master, hashes=cur_hash)
+        if self.save_as_master: self.log_signal.emit(name, "[OK] Masterとして保存しました。", "#00FF00")
+        else: self.log_signal.emit(name, "[OK] スナップショットを作成（更新）しました。", "#00FF00")
+
+# --- 経路診断用: IP索引 (PrefixTrie / HostIndex) ---
+def ip_to_int(ip):
+    parts = str(ip).strip().split(".")
+    if len(parts) != 4: raise ValueError(f"invalid IPv4 address: {ip}")
+    n = 0
+    for p in parts:
+        b = int(p)
+        if not 0 <= b <= 255: raise ValueError(f"invalid IPv4 address: {ip}")
+        n = (n << 8) | b
+    return n
+
+def mask_len(mask):
+    m = ip_to_int(mask); n = bin(m).count("1")
+    if m != (0xFFFFFFFF << (32 - n)) & 0xFFFFFFFF: raise ValueError(f"invalid netmask: {mask}") # 非連続マスク
+    return n
+
+class PrefixTrie:
+    """IPv4 プレフィックスの最長一致検索 (パス圧縮した2分木)。lookup は最大でもプレフィックス長ぶんの分岐で終わる"""
+    _EMPTY = object() # 分岐専用ノード (値なし) の印
+    # ノード: [プレフィックス(int), 長さ, 値, 子0, 子1]
+
+    def __init__(self): self.root, self.size = None, 0
+
+    def __len__(self): return self.size
+
+    @staticmethod
+    def _bit(key, i): return (key >> (31 - i)) & 1 # 上位から i 番目のビット
+
+    @staticmethod
+    def _mask(length): return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+    def insert(self, prefix, length, value):
+        key = prefix & self._mask(length)
+        leaf = [key, length, value, None, None]
+        parent, side, node = None, 0, self.root
+        while node is not None:
+            # node と共通する先頭ビット数 (どちらかの長さが上限)
+            common = min(length, node[1], 32 - ((key ^ node[0]) & 0xFFFFFFFF).bit_length())
+            if common == node[1]:
+                if common == length: # 同じプレフィックス: 値を置き換える
+                    if node[2] is self._EMPTY: self.size += 1
+                    node[2] = value; return
+                parent, side, node = node, self._bit(key, common), node[3 + self._bit(key, common)]
+                continue
+            # node の途中で分かれる: 新しいノードを間に挟む
+            if common == length: mid = leaf
+            else:
+                mid = [key & self._mask(common), common, self._EMPTY, None, None]
+                mid[3 + self._bit(key, common)] = leaf
+            mid[3 + self._bit(node[0], common)] = node
+            break
+        else: mid = leaf
+        if parent is None: self.root = mid
+        else: parent[3 + side] = mid
+        self.size += 1
+
+    def lookup(self, addr):
+        """addr を含む最長のプレフィックスの (長さ, 値)。無ければ None"""
+        node, best = self.root, None
+        while node is not None and (addr ^ node[0]) >> (32 - node[1]) == 0:
+            if node[2] is not self._EMPTY: best = (node[1], node[2])
+            if node[1] == 32: break
+            node = node[3 + self._bit(addr, node[1])]
+        return best
+
+RE_IP_MASK = re.compile(r"\bip address\s+(\d+\.\d+\.\d+\.\d+)\s+(\d+\.\d+\.\d+\.\d+)", re.I)
+RE_CIDR = re.compile(r"\b(\d+\.\d+\.\d+\.\d+)/(\d{1,2})\b")
+RE_CONNECTED = re.compile(r"directly connected|\bDirect\b|\bLocal\b", re.I)
+
+def parse_if_addresses(cmd, text):
+    """IF一覧 / 設定 / ルーティングテーブルの出力から [(アドレス, 長さ, 機器自身のアドレスか)] を取り出す
+    ルーティングテーブルは接続経路 (C/L, Direct) の行だけを見る"""
+    c, res = cmd.lower(), []
+    if "route" in c:
+        for line in text.splitlines():
+            if RE_CONNECTED.search(line): res.extend((a, int(n), int(n) == 32) for a, n in RE_CIDR.findall(line))
+        return res
+    for a, m in RE_IP_MASK.findall(text):
+        try: res.append((a, mask_len(m), True))
+        except ValueError: pass
+    res.extend((a, int(n), True) for a, n in RE_CIDR.findall(text))
+    if "brief" in c or "terse" in c: # マスクの出ない一覧 (Cisco show ip int brief など) はアドレスのみ
+        seen = {a for a, _, _ in res}
+        for line in text.splitlines():
+            res.extend((a, 32, True) for a in RE_IPV4.findall(line) if a not in seen)
+    return res
+
+def is_address_command(cmd):
+    # 機器のアドレス情報を含むコマンド (IF一覧 / 設定 / ルーティングテーブル)
+    c = " ".join(cmd.lower().split())
+    return any(k in c for k in ("int brief", "interface brief", "interfaces terse", "int br", "running-config", "current-configuration", "configuration", "ip route", "routing-table"))
+
+class HostIndex:
+    """管理IP / IFアドレス / 接続サブネットから機器を引く索引。インベントリとスナップショットの組ごとに1回だけ作る"""
+    _cache = {}; _lock = threading.Lock()
+
+    def __init__(self, hosts, store=None):
+        store = store or SNAPSHOT_STORE
+        self.by_name = {h['name']: h for h in hosts}
+        self.mgmt = {}
+        for h in hosts: self.mgmt.setdefault(str(h.get('ip')), h)
+        owners = {} # (ネットワーク, 長さ) -> [機器名]
+        for h in hosts:
+            for cmd, text in store.latest_outputs(h['name'], is_address_command).items():
+                for a, n, own in parse_if_addresses(cmd, text):
+                    try: addr = ip_to_int(a)
+                    except ValueError: continue
+                    if not 0 < n <= 32 or a.startswith("127.") or addr == 0: continue
+                    keys = [(addr & PrefixTrie._mask(n), n)] + ([(addr, 32)] if own and n < 32 else [])
+                    for k in keys:
+                        names = owners.setdefault(k, [])
+                        if h['name'] not in names: names.append(h['name'])
+        self.trie = PrefixTrie()
+        for (net, n), names in owners.items(): self.trie.insert(net, n, names)
+
+    @classmethod
+    def for_hosts(cls, hosts, store=None):
+        # インベントリの内容と各機器のスナップショット索引の更新時刻が同じなら作り直さない
+        store = store or SNAPSHOT_STORE
+        stamp = []
+        for h in hosts:
+            try: stamp.append(os.stat(os.path.join(store._host_dir(h['name']), "index.json")).st_mtime_ns)
+            except OSError: stamp.append(0)
+        key = (store.root, tuple((h['name'], str(h.get('ip'))) for h in hosts), tuple(stamp))
+        with cls._lock:
+            idx = cls._cache.get(key)
+            if idx is None: cls._cache.clear(); idx = cls._cache[key] = cls(hosts, store)
+        return idx
+
+    def find_host(self, ip, exclude=None):
+        """ip を持つ機器。管理IP → IFアドレス(/32) → 2台だけの接続サブネット(/30, /31)の相手側 の順に探す"""
+        h = self.mgmt.get(str(ip))
+        if h: return h
+        try: m = self.trie.lookup(ip_to_int(ip))
+        except ValueError: return None
+        if not m: return None
+        n, names = m
+        cands = [x for x in names if x != exclude]
+        if len(cands) == 1 and (n == 32 or n >= 30): return self.by_name[cands[0]] # 同じアドレス/サブネットを複数台が持つ場合 (VIP等) は特定しない
+        return None
+
+# --- 経路診断用: 収集済みルーティングテーブルによるオフライン診断 (RouteSimulator) ---
+RE_SUBNETTED = re.compile(r"/(\d{1,2}) is subnetted", re.I)
+RE_BARE_ROUTE = re.compile(r"^[A-Za-z*][A-Za-z0-9* ]{0,8}?\s+(\d+\.\d+\.\d+\.\d+)\s+(?:\[|is directly)") # Cisco のクラスフル表記 (長さは見出し行から)
+
+def parse_route_table(text):
+    """ルーティングテーブル全体の出力を [(ネットワーク(int), 長さ, その経路の行)] にする (Cisco / Juniper / Huawei 形式)
+    ECMP などで次の行に続く経路 (インデントされた via / to の行) は同じエントリに含める"""
+    entries, cur, sub_len = [], None, None
+    for line in text.splitlines():
+        if not line.strip(): continue
+        m = RE_CIDR.search(line)
+        if m and "subnetted" in line:
+            ms = RE_SUBNETTED.search(line); sub_len = int(ms.group(1)) if ms else None; cur = None; continue
+        bare = None if m else RE_BARE_ROUTE.match(line)
+        if m or (bare and sub_len is not None):
+            a, n = (m.group(1), int(m.group(2))) if m else (bare.group(1), sub_len)
+            try: net = ip_to_int(a) & PrefixTrie._mask(n)
+            except ValueError: cur = None; continue
+            cur = [line]; entries.append((net, n, cur))
+        elif cur is not None and line[:1].isspace(): cur.append(line)
+        else: cur = None
+    return [(net, n, "\n".join(lines)) for net, n, lines in entries]
+
+def is_route_table_command(cmd):
+    # 宛先を指定しない経路表示 (show ip route / show route / display ip routing-table)
+    c = " ".join(cmd.lower().split())
+    if not any(k in c for k in ("ip route", "show route", "routing-table")) or "summary" in c: return False
+    return not RE_IPV4.search(c.split()[-1])
+
+class LiveProbe:
+    """DiagnosticWorker から見た機器 (実機に SSH でコマンドを送る)"""
+    def __init__(self, net, cmds, v_fam): self.net, self.cmds, self.fam = net, cmds, v_fam
+
+    def route(self, target):
+        rout = self.net.send_command(self.cmds["route"].format(target=target))
+        if "not in table" in rout and "route_vrf" in self.cmds:
+            try:
+                vrout = self.net.send_command(self.cmds["route_vrf"].format(target=target))
+                if "not in table" not in vrout and vrout.strip(): rout = vrout
+            except: pass
+        return rout
+
+    def interface(self, iface): return self.net.send_command(self.cmds["interface"].format(iface=iface))
+
+    def arp(self, ip):
+        try: return self.net.send_command(self.cmds["arp"].format(next_hop=ip)) if "arp" in self.cmds else ""
+        except: return ""
+
+    def ping(self, ip):
+        res = self.net.send_command(f"ping {ip}" if "cisco" in self.fam else f"ping {ip} count 2")
+        return any(s in res for s in ["!!!!", "100", "0% packet loss", "received", "alive"])
+
+class SnapshotProbe:
+    """DiagnosticWorker から見た機器 (RouteSimulator の FIB と IF 状態を引くだけで、実機には接続しない)"""
+    def __init__(self, sim, h): self.sim, self.name = sim, h['name']
+
+    def route(self, target):
+        try: m = self.sim.fib(self.name).lookup(ip_to_int(target))
+        except ValueError: m = None
+        return m[1] if m else "% Network not in table"
+
+    def interface(self, iface): return self.sim.if_status(self.name).get(iface.lower())
+
+    def arp(self, ip): return ""
+
+    def ping(self, ip): return None # 未確認
+
+class RouteSimulator:
+    """収集済みのルーティングテーブルから機器ごとの FIB を作り、DiagnosticWorker と同じ判定で経路をたどる"""
+    def __init__(self, hosts, store=None):
+        self.hosts, self.store = hosts, store or SNAPSHOT_STORE
+        self._index, self.fibs, self.ifs, self.lock = None, {}, {}, threading.Lock()
+
+    @property
+    def index(self):
+        if self._index is None: self._index = HostIndex.for_hosts(self.hosts, self.store)
+        return self._index
+
+    def fib(self, name):
+        with self.lock:
+            trie = self.fibs.get(name)
+            if trie is None:
+                trie = self.fibs[name] = PrefixTrie()
+                # 同じプレフィックスは先に見つかった (新しい / VRF 指定なしの) 経路を優先する
+                outs = sorted(self.store.latest_outputs(name, is_route_table_command).items(), key=lambda kv: "vrf" in kv[0].lower())
+                for _, text in reversed(outs):
+                    for net, n, entry in reversed(parse_route_table(text)): trie.insert(net, n, entry)
+            return trie
+
+    def if_status(self, name):
+        # IF一覧 (show ip int brief / show interfaces terse など) の行を IF名 (小文字) で引けるようにする
+        with self.lock:
+            st = self.ifs.get(name)
+            if st is None:
+                st = self.ifs[name] = {}
+                for cmd, text in self.store.latest_outputs(name, lambda c: any(k in c.lower() for k in ("brief", "terse"))).items():
+                    for line in text.splitlines():
+                        parts = line.split()
+                        if len(parts) >= 2: st.setdefault(parts[0].lower(), line)
+            return st
+
+    def probe(self, h): return SnapshotProbe(self, h)
+
+    def trace(self, start, target):
+        w = DiagnosticWorker(start, target, self.hosts, simulator=self); w.walk()
+        return w.path_trace
+
+    def batch(self, pairs):
+        """[(出発機器, 宛先IP)] をまとめて診断し、それぞれの path_trace を返す"""
+        return [self.trace(s, t) for s, t in pairs]
+
+def summarize_path(trace):
+    # path_trace を ("OK" / "DEGRADED(理由)" / "LOOP" / "FAIL(理由)", "A > B|C > D") にする (ECMP の枝は同じホップ数ごとに | で並べる)
+    levels = {}
+    for p in trace:
+        if p['node'] != "START_PC": levels.setdefault(p.get('hop', 0), []).append(p['node'])
+    rank = {"OK": 0, "DEGRADED": 1, "LOOP": 2, "FAIL": 3}
+    worst = max(trace, key=lambda p: rank.get(p.get('status'), 3), default=None)
+    if worst is None or worst.get('status') == "OK":
+        note = next((p['reason'] for p in trace if p.get('reason')), "")
+        res = f"OK({note})" if note else "OK"
+    else: res = "LOOP" if worst['status'] == "LOOP" else f"{worst['status']}({worst.get('reason')})"
+    return res, " > ".join("|".join(sorted(levels[k])) for k in sorted(levels))
 
 # --- モード6用: CCIEレベル自動診断ワーカー (DiagnosticWorker) ---
 class DiagnosticWorker(QThread):
     log_signal = Signal(str, str, str); finished_signal = Signal(str, list, dict)
-    path_data_signal = Signal(list) # 経路可視化用データ
+    path_data_signal = Signal(list) # 経路可視化用データ (ECMP で分岐する DAG。各要素の from が手前の機器)
 
-    def __init__(self, start, target, hosts):
+    def __init__(self, start, target, hosts, simulator=None):
         super().__init__(); self.cur, self.tgt, self.hosts = start, target, hosts; self.rep, self.visited = [], set()
         self.path_trace = [] # 経路可視化用
+        self.index = None # HostIndex (run の最初に作る)
+        self.sim = simulator # RouteSimulator を渡すと収集済みのルーティングテーブルでたどる (実機に接続しない)
+        self.lock, self.edges = threading.Lock(), []
+        self.is_running = True
 
-    def run(self):
-        self.log_signal.emit("DIAG", f"=== 自動診断開始: {self.cur['name']} -> {self.tgt} ===", "#00FFFF")
-        hop, found = 0, False
-        self.path_trace.append({"node": "START_PC", "next": self.cur['name'], "iface": "access", "status": "OK", "reason": ""})
-        
-        while hop < 15 and not found:
-            hop += 1; h = self.cur; n, ip = h['name'], h['ip']
-            self.log_signal.emit(n, f"--- Hop {hop}: {n} ({ip}) ---", "#00FF00")
-            
-            try:
-                v = str(h.get('vendor') or 'cisco_ios').lower()
-                v_fam = "cisco"
-                for fam, drivers in DIAG_FAMILIES.items():
-                    if any(d in v for d in drivers): v_fam = fam; break
-                cmds = DIAG_COMMANDS.get(v_fam, DIAG_COMMANDS["cisco"])
-                
-                dev = {'device_type': v, 'host': ip, 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw'], 'global_delay_factor': 2}
-                with ConnectHandler(**dev) as net:
-                    if ">" in net.find_prompt(): net.enable()
-
-                    # L3 Routing
-                    rout = net.send_command(cmds["route"].format(target=self.tgt))
-                    if "not in table" in rout and "route_vrf" in cmds:
-                        try:
-                            vrout = net.send_command(cmds["route_vrf"].format(target=self.tgt))
-                            if "not in table" not in vrout and vrout.strip(): rout = vrout
-                        except: pass
-                    self.rep.append(f"<h3>[{n}] Route ({v_fam})</h3><pre>{rout}</pre>")
-                    
-                    nh_ip = self.get_nh(rout, v_fam); iface = self.get_iface(rout)
-                    
-                    path_node = {"node": n, "next": nh_ip, "iface": iface, "status": "OK", "reason": ""}
-
-                    if not nh_ip and not iface:
-                        self.log_signal.emit(n, "[!] Route Missing (Drop)", "#FF5555")
-                        self.rep.append(f"<div style='color:red'><b>[CAUSE] Routing Missing at {n}</b></div>")
-                        path_node["status"] = "FAIL"
-                        path_node["reason"] = "No Route"
-                        self.path_trace.append(path_node); found = True; break
-                    
-                    if any(x in rout.lower() for x in ["connected", "direct", "via 0.0.0.0", "attached", "is directly"]):
-                        self.log_signal.emit(n, f"[Info] Directly Connected ({iface})", "#FFFF00"); nh_ip = self.tgt
+    def stop(self): self.is_running = False # 調査中のホップは最後まで終え、新しいログイン・分岐はしない
 
-                    if iface:
-                        iout = net.send_command(cmds["interface"].format(iface=iface))
-                        self.rep.append(f"<h3>[{n}] Interface {iface}</h3><pre>{iout}</pre>")
-                        
-                        if "err-disabled" in iout.lower():
-                            self.log_signal.emit(n, f"[Critical] Port {iface} is ERR-DISABLED!", "#FF0000")
-                            path_node["status"] = "FAIL"
-                            path_node["reason"] = "Err-Disabled"
-                            self.path_trace.append(path_node); found = True; break
-                        if "down" in iout.lower():
-                            self.log_signal.emit(n, f"[!] Port {iface} is DOWN", "#FF5555")
-                            path_node["status"] = "FAIL"
-                            path_node["reason"] = "Link Down"
-                            self.path_trace.append(path_node); found = True; break
-                        
-                        self.check_if_quality(n, iout)
-
-                    self.path_trace.append(path_node)
-
-                    if nh_ip == self.tgt:
-                        self.log_signal.emit(n, "[End] 到達しました。端末FW等を確認してください。", "#00FF00"); found = True; break
-
-                    self.log_signal.emit(n, f"[Next] -> {nh_ip} (via {iface})", "#FFFFFF")
-                    next_h = self.find_host(nh_ip)
-                    if not next_h:
-                        if "arp" in cmds:
-                            try:
-                                arp = net.send_command(cmds["arp"].format(next_hop=nh_ip))
-                                if any(m in arp for m in ["0000.0c07.ac", "0000.5e00.01", "0000.0c9f.f"]): self.log_signal.emit(n, f"[Info] {nh_ip} is Virtual IP (VIP).", "#00FFFF")
-                            except: pass
-                        res = net.send_command(f"ping {nh_ip}" if "cisco" in v_fam else f"ping {nh_ip} count 2")
-                        if not any(s in res for s in ["!!!!", "100", "0% packet loss", "received", "alive"]):
-                            self.log_signal.emit(n, f"[!] Ping NG to {nh_ip}. Link broken?", "#FF5555")
-                            self.rep.append(f"<div style='color:red'><b>[CAUSE] Unreachable Next Hop {nh_ip}</b></div>")
-                            self.path_trace[-1]["status"] = "FAIL"
-                            self.path_trace[-1]["reason"] = "Ping NG"
-                        found = True; break
-                    
-                    if next_h['ip'] in self.visited: 
-                        self.log_signal.emit(n, "[!] Routing Loop Detected!", "#FF0000"); 
-                        self.path_trace[-1]["status"] = "LOOP"
-                        self.path_trace[-1]["reason"] = "Loop"
-                        break
-                    self.visited.add(next_h['ip']); self.cur = next_h
-            except Exception as e:
-                self.log_signal.emit(n, f"[Err] {e}", "#FF5555"); found = True; break
-        
+    def run(self):
+        self.log_signal.emit("DIAG", f"=== 自動診断開始{' (オフライン)' if self.sim else ''}: {self.cur['name']} -> {self.tgt} ===", "#00FFFF")
+        self.walk()
+        if not self.is_running: self.log_signal.emit("DIAG", "[!] 自動診断を中止しました (調査済みのホップまでを表示します)", "#FFA500")
         # Ensure completion signal is sent even after break
         self.finished_signal.emit("DIAG", self.rep, {})
         self.path_data_signal.emit(self.path_trace)
 
+    def walk(self):
+        """出発機器から全ての次ホップ (ECMP) をたどる。訪問済みの機器に合流した枝はそこで止め、辺だけ記録する"""
+        self.index = self.sim.index if self.sim else HostIndex.for_hosts(self.hosts)
+        self.path_trace.append({"node": "START_PC", "next": self.cur['name'], "iface": "access", "status": "OK", "reason": "", "from": [], "hop": 0})
+        self.visited.add(self.cur['ip']); self.edges.append(("START_PC", self.cur['name']))
+        first = (self.cur, (), 1)
+        if self.sim: # オフラインは1ホップがマイクロ秒単位なのでスレッドを使わない
+            pending = deque([first])
+            while pending and self.is_running: pending.extend(self.visit(*pending.popleft()))
+        else: # 実機は枝ごとに並行してログインする (最も深い枝の分だけ時間がかかる)
+            with ThreadPoolExecutor(max_workers=DIAG_MAX_BRANCHES) as ex:
+                futs = {ex.submit(self.visit, *first)}
+                while futs:
+                    done, futs = wait(futs, return_when=FIRST_COMPLETED)
+                    for f in done: futs.update(ex.submit(self.visit, *c) for c in f.result() if self.is_running)
+        nodes = {p['node']: p for p in self.path_trace}
+        for u, v in self.edges:
+            if v in nodes and u not in nodes[v]["from"]: nodes[v]["from"].append(u)
+        return self.path_trace
+
+    def visit(self, h, ancestors, hop):
+        # 1台分を調べ、まだ誰も調べていない次の機器を (機器, 経路上の祖先, ホップ数) で返す
+        n, ip = h['name'], h['ip']
+        if not self.is_running: return [] # 中止後はセッションを取りに行かない
+        self.log_signal.emit(n, f"--- Hop {hop}: {n} ({ip}) ---", "#00FF00")
+        rep = []
+        try:
+            if self.sim: node, nexts = self.step(h, self.sim.probe(h), rep)
+            else:
+                v = str(h.get('vendor') or 'cisco_ios').lower()
+                v_fam = vendor_family(v)
+                cmds = DIAG_COMMANDS.get(v_fam, DIAG_COMMANDS["cisco"])
+                dev = {'device_type': v, 'host': ip, 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw'], 'global_delay_factor': 2}
+                with SESSION_POOL.connection(dev) as net: node, nexts = self.step(h, LiveProbe(net, cmds, v_fam), rep)
+        except Exception as e:
+            self.log_signal.emit(n, f"[Err] {e}", "#FF5555")
+            node, nexts = {"node": n, "next": None, "nexts": [], "iface": None, "status": "FAIL", "reason": "Error"}, []
+        node["from"], node["hop"] = [], hop
+        ancestors += (ip,); children = []
+        with self.lock:
+            self.rep.extend(rep); self.path_trace.append(node)
+            for nh in nexts:
+                self.edges.append((n, nh['name']))
+                if nh['ip'] in ancestors:
+                    self.log_signal.emit(n, "[!] Routing Loop Detected!", "#FF0000")
+                    node["status"] = "LOOP"
+                    node["reason"] = "Loop"
+                elif nh['ip'] in self.visited: continue # 別の枝で調査済み (合流)
+                elif hop >= DIAG_MAX_HOPS: self.log_signal.emit(n, f"[!] {DIAG_MAX_HOPS} ホップを超えたため打ち切ります", "#FFA500")
+                else: self.visited.add(nh['ip']); children.append((nh, ancestors, hop + 1))
+        return children if self.is_running else []
+
+    def step(self, h, probe, rep):
+        """1ホップ分の判定 (probe = LiveProbe / SnapshotProbe)。(path_trace の要素, 次の機器のリスト) を返す"""
+        n = h['name']; v_fam = vendor_family(str(h.get('vendor') or 'cisco_ios').lower())
+
+        # L3 Routing
+        rout = probe.route(self.tgt)
+        rep.append(f"<h3>[{n}] Route ({v_fam})</h3><pre>{rout}</pre>")
+
+        nhs = self.get_nhs(rout, v_fam); iface = self.get_iface(rout)
+
+        path_node = {"node": n, "next": nhs[0] if nhs else None, "nexts": nhs, "iface": iface, "status": "OK", "reason": ""}
+
+        if not nhs and not iface:
+            self.log_signal.emit(n, "[!] Route Missing (Drop)", "#FF5555")
+            rep.append(f"<div style='color:red'><b>[CAUSE] Routing Missing at {n}</b></div>")
+            path_node["status"] = "FAIL"
+            path_node["reason"] = "No Route"
+            return path_node, []
+
+        if any(x in rout.lower() for x in ["connected", "direct", "via 0.0.0.0", "attached", "is directly"]):
+            self.log_signal.emit(n, f"[Info] Directly Connected ({iface})", "#FFFF00"); nhs = [self.tgt]
+        if len(nhs) > 1: self.log_signal.emit(n, f"[Info] ECMP: {len(nhs)} 経路 ({', '.join(nhs)})", "#00FFFF")
+        branches = [(nh, self.iface_for(rout, nh) or iface) for nh in nhs]
+
+        # 出力IFの状態 (ECMP で同じIFを使う枝は1回だけ調べる)
+        bad = {}
+        for i in dict.fromkeys(b for _, b in branches if b):
+            iout = probe.interface(i)
+            if iout is None: continue
+            rep.append(f"<h3>[{n}] Interface {i}</h3><pre>{iout}</pre>")
+            if "err-disabled" in iout.lower():
+                self.log_signal.emit(n, f"[Critical] Port {i} is ERR-DISABLED!", "#FF0000"); bad[i] = "Err-Disabled"
+            elif "down" in iout.lower():
+                self.log_signal.emit(n, f"[!] Port {i} is DOWN", "#FF5555"); bad[i] = "Link Down"
+            else: self.check_if_quality(n, iout)
+        live = [(nh, i) for nh, i in branches if i not in bad]
+        fails = list(dict.fromkeys(bad.values())); n_ng = len(branches) - len(live)
+
+        nexts = []
+        for nh, i in live:
+            if nh == self.tgt:
+                self.log_signal.emit(n, "[End] 到達しました。端末FW等を確認してください。", "#00FF00"); continue
+            self.log_signal.emit(n, f"[Next] -> {nh} (via {i})", "#FFFFFF")
+            next_h = self.find_host(nh, exclude=n)
+            if next_h: nexts.append(next_h); continue
+            arp = probe.arp(nh)
+            if any(m in arp for m in ["0000.0c07.ac", "0000.5e00.01", "0000.0c9f.f"]): self.log_signal.emit(n, f"[Info] {nh} is Virtual IP (VIP).", "#00FFFF")
+            ok = probe.ping(nh)
+            if ok is None: # オフライン: 疎通は確かめられない
+                self.log_signal.emit(n, f"[Info] {nh} はインベントリ外の機器です (オフラインのため疎通未確認)", "#FFFF00")
+                if not path_node["reason"]: path_node["reason"] = "Unverified"
+            elif not ok:
+                self.log_signal.emit(n, f"[!] Ping NG to {nh}. Link broken?", "#FF5555")
+                rep.append(f"<div style='color:red'><b>[CAUSE] Unreachable Next Hop {nh}</b></div>")
+                fails.append("Ping NG"); n_ng += 1
+
+        # 全ての枝が NG なら FAIL、一部の枝だけなら DEGRADED (残りの枝は調査を続ける)
+        if n_ng:
+            path_node["status"] = "FAIL" if n_ng >= len(branches) else "DEGRADED"
+            path_node["reason"] = ", ".join(dict.fromkeys(fails))
+        return path_node, nexts
+
     def check_if_quality(self, n, out):
         if re.search(r"drops?[:\s]+(\d+)", out, re.I):
              d = re.findall(r"drops?[:\s]+(\d+)", out, re.I)
@@ -582,11 +1869,22 @@ class DiagnosticWorker(QThread):
              if int(re.search(r"(\d+)\s+CRC", out).group(1)) > 0: self.log_signal.emit(n, "[Alert] CRC Errors detected!", "#FF0000")
         if "Half-duplex" in out: self.log_signal.emit(n, "[Alert] Half-Duplex detected!", "#FF0000")
 
-    def get_nh(self, txt, fam):
-        if fam in ["cisco", "aruba_procurve", "hp_aruba", "arista", "allied", "nec"]: m=re.search(r"via\s+(\d{1,3}(?:\.\d{1,3}){3})", txt); return m.group(1) if m else None
-        if fam == "juniper": m=re.search(r"to\s+(\d{1,3}(?:\.\d{1,3}){3})", txt); return m.group(1) if m else None
-        if fam == "huawei": m=re.search(r"RelayNextHop\s*:\s*(\d{1,3}(?:\.\d{1,3}){3})", txt); return m.group(1) if m else None
-        m=re.search(r"(\d{1,3}(?:\.\d{1,3}){3})", txt); return m.group(1) if m else None
+    def get_nhs(self, txt, fam):
+        """経路の出力から次ホップを全て取り出す (ECMP)。重複を除いて出現順"""
+        ip = r"(\d{1,3}(?:\.\d{1,3}){3})"
+        if fam in ["cisco", "aruba_procurve", "hp_aruba", "arista", "allied", "nec"]: found = re.findall(r"via\s+" + ip, txt)
+        elif fam == "juniper": found = re.findall(r"to\s+" + ip, txt)
+        elif fam == "huawei": found = re.findall(r"RelayNextHop\s*:\s*" + ip, txt) or re.findall(r"^\s*(?:[\d.]+/\d+)?\s+\S+\s+\d+\s+\d+\s+\S+\s+" + ip, txt, re.M) # 詳細表示 / 経路表の行 (ECMP の2行目以降は宛先が空欄)
+        else: m = re.search(ip, txt); found = [m.group(1)] if m else []
+        return list(dict.fromkeys(found))
+
+    def iface_for(self, txt, nh):
+        # 次ホップと同じ行に書かれた出力IF (ECMP では枝ごとにIFが異なる)
+        for line in txt.splitlines():
+            if re.search(r"(?<![\d.])" + re.escape(nh) + r"(?![\d.])", line):
+                i = self.get_iface(line)
+                if i: return i
+        return None
 
     def get_iface(self, txt):
         for p in [r"(GigabitEthernet[\d/]+)", r"(TenGigabitEthernet[\d/]+)", r"(FastEthernet[\d/]+)", r"(Eth[\d/]+)", 
@@ -596,76 +1894,400 @@ class DiagnosticWorker(QThread):
             if m: return m.group(1)
         return None
     
-    def find_host(self, ip):
-        for h in self.hosts:
-            if h['ip'] == ip: return h
-        return None
+    def find_host(self, ip, exclude=None):
+        if self.index is None: self.index = HostIndex.for_hosts(self.hosts)
+        return self.index.find_host(ip, exclude)
+
+# --- 帯域モニターの時系列保存 (TimeSeriesStore) ---
+class TimeSeriesStore:
+    """機器/IFごとのカウンタを固定長バイナリで追記し、1分/1時間の集約も併せて書き出す
+    raw: (時刻, 受信bytes, 送信bytes) / 1m・1h: (区間開始, 平均IN, 平均OUT, 最大IN, 最大OUT) [Mbps]"""
+    RAW, ROLL = struct.Struct('<dQQ'), struct.Struct('<dffff')
+    LEVELS = (("1m", 60), ("1h", 3600))
+    GAP = max(60, 10 * MONITOR_INTERVAL) # これより間隔が空いた2点からはレートを計算しない (監視停止中の区間)
+
+    def __init__(self, root=TS_DIR):
+        self.root, self.lock, self.state = root, threading.Lock(), {}
+
+    def _path(self, dev, iface, kind):
+        return os.path.join(self.root, sanitize_filename(dev), f"{sanitize_filename(iface)}.{kind}")
+
+    def _tail(self, path, rec):
+        # ファイル末尾のレコード (再起動後もレート計算を続けるため)
+        try:
+            with open(path, "rb") as f:
+                f.seek(0, 2); size = f.tell() - f.tell() % rec.size
+                if size < rec.size: return None
+                f.seek(size - rec.size); return rec.unpack(f.read(rec.size))
+        except OSError: return None
+
+    def append(self, dev, ts, counters):
+        """counters = {IF: (受信bytes, 送信bytes)} を記録し、前回値からのレート {IF: (IN Mbps, OUT Mbps)} を返す"""
+        rates = {}
+        with self.lock:
+            for iface, (c_in, c_out) in counters.items():
+                key, raw = (dev, iface), self._path(dev, iface, "raw")
+                st = self.state.get(key)
+                if st is None:
+                    os.makedirs(os.path.dirname(raw), exist_ok=True)
+                    st = self.state[key] = {"last": self._tail(raw, self.RAW), "acc": {lv: None for lv, _ in self.LEVELS}}
+                with open(raw, "ab") as f: f.write(self.RAW.pack(ts, c_in, c_out))
+                last, st["last"] = st["last"], (ts, c_in, c_out)
+                if not last or not 0 < ts - last[0] <= self.GAP: continue
+                dt = ts - last[0]
+                r = rates[iface] = (max(0, (c_in - last[1]) * 8 / dt / 1_000_000), max(0, (c_out - last[2]) * 8 / dt / 1_000_000))
+                for lv, sec in self.LEVELS: self._roll(dev, iface, st["acc"], lv, sec, ts, r)
+        return rates
+
+    def _roll(self, dev, iface, acc, lv, sec, ts, r):
+        b = ts - ts % sec; a = acc[lv]
+        if a and a[0] != b: self._write_roll(dev, iface, lv, a); a = None
+        if a is None: a = acc[lv] = [b, 0, 0.0, 0.0, 0.0, 0.0]
+        a[1] += 1; a[2] += r[0]; a[3] += r[1]; a[4] = max(a[4], r[0]); a[5] = max(a[5], r[1])
+
+    def _write_roll(self, dev, iface, lv, a):
+        with open(self._path(dev, iface, lv), "ab") as f: f.write(self.ROLL.pack(a[0], a[2] / a[1], a[3] / a[1], a[4], a[5]))
+
+    def flush(self, dev=None):
+        """集約途中の区間を書き出す (監視終了時)"""
+        with self.lock:
+            for (d, iface), st in list(self.state.items()):
+                if dev is not None and d != dev: continue
+                for lv, a in st["acc"].items():
+                    if a: self._write_roll(d, iface, lv, a)
+                del self.state[(d, iface)]
+
+    def series(self):
+        """保存済みの {機器: [IF...]}"""
+        res = {}
+        if not os.path.isdir(self.root): return res
+        for d in sorted(os.listdir(self.root)):
+            p = os.path.join(self.root, d)
+            if os.path.isdir(p): res[d] = sorted(f[:-4] for f in os.listdir(p) if f.endswith(".raw"))
+        return {d: i for d, i in res.items() if i}
+
+    @staticmethod
+    def _bisect(f, n, rec, ts):
+        # 時刻順に並んだ固定長レコードを二分探索 (ts 以上の最初の位置)
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2; f.seek(mid * rec.size)
+            if rec.unpack(f.read(rec.size))[0] < ts: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def _read(self, path, rec, t0, t1):
+        try:
+            with open(path, "rb") as f:
+                f.seek(0, 2); n = f.tell() // rec.size
+                i = self._bisect(f, n, rec, t0); j = self._bisect(f, n, rec, t1)
+                f.seek(i * rec.size); return list(rec.iter_unpack(f.read((j - i) * rec.size)))
+        except OSError: return []
+
+    def read(self, dev, iface, t0, t1, level=None):
+        """t0..t1 の (時刻リスト, IN Mbps, OUT Mbps, 使用した粒度) を返す。level 省略時は期間から自動選択"""
+        if level is None: level = "raw" if t1 - t0 <= 6 * 3600 else "1m" if t1 - t0 <= 7 * 86400 else "1h"
+        if level != "raw":
+            rows = self._read(self._path(dev, iface, level), self.ROLL, t0, t1)
+            return [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], level
+        rows = self._read(self._path(dev, iface, "raw"), self.RAW, t0, t1)
+        ts, m_in, m_out = [], [], []
+        for a, b in zip(rows, rows[1:]):
+            dt = b[0] - a[0]
+            if not 0 < dt <= self.GAP: continue
+            ts.append(b[0]); m_in.append(max(0, (b[1] - a[1]) * 8 / dt / 1_000_000)); m_out.append(max(0, (b[2] - a[2]) * 8 / dt / 1_000_000))
+        return ts, m_in, m_out, level
+
+TS_STORE = TimeSeriesStore()
 
 # --- モード7用: 帯域モニターワーカー (TrafficGhostWorker) ---
+RE_IF_HEADER = re.compile(r"^(?:Physical interface:\s*(\S+?),|Interface\s+(\S+)\s*$|(\S+) (?:is (?:administratively )?(?:up|down)|current state))", re.M | re.I)
+RE_IF_IN = re.compile(r"input,?\s+(\d+)\s+bytes|Input bytes\s*:\s*(\d+)|Rx\s+bytes:(\d+)", re.I | re.S)
+RE_IF_OUT = re.compile(r"output,?\s+(\d+)\s+bytes|Output bytes\s*:\s*(\d+)|Tx\s+bytes:(\d+)", re.I | re.S)
+
+def if_key(name):
+    # "GigabitEthernet0/1" と "Gi0/1" を同一視するためのキー (英字の先頭2文字 + 番号部分)
+    m = re.match(r"([a-z]+)[^\d]*(\d.*)", str(name).lower())
+    return (m.group(1)[:2], m.group(2)) if m else (str(name).lower(), "")
+
+def parse_if_counters(output):
+    """全IF分の出力を IF ごとに区切り、{IF名: (受信bytes, 送信bytes)} を返す"""
+    heads = [(m.start(), next(g for g in m.groups() if g)) for m in RE_IF_HEADER.finditer(output)]
+    res = {}
+    for k, (pos, name) in enumerate(heads):
+        sec = output[pos:heads[k + 1][0] if k + 1 < len(heads) else len(output)]
+        mi, mo = RE_IF_IN.search(sec), RE_IF_OUT.search(sec)
+        if mi and mo: res[name] = (int(next(g for g in mi.groups() if g)), int(next(g for g in mo.groups() if g)))
+    return res
+
+def if_command(vendor, iface=None):
+    # iface=None: 全IFをまとめて取得するコマンド (対応しない機種は None)
+    v = vendor
+    if iface is None:
+        if "fortinet" in v or "yamaha" in v or "linux" in v: return None
+        if "juniper" in v: return "show interfaces detail"
+        if "huawei" in v: return "display interface"
+        return "show interfaces"
+    cmd = f"show interface {iface}"
+    if "juniper" in v: cmd = f"show interfaces {iface} detail"
+    elif "huawei" in v: cmd = f"display interface {iface}"
+    elif "fortinet" in v: cmd = f"diagnose hardware deviceinfo nic {iface}"
+    return cmd
+
+def list_interfaces(h):
+    """IF選択用の一覧 (show ip int brief 等の1列目)"""
+    dev = {'device_type': str(h.get('vendor') or 'cisco_ios').strip().lower(), 'host': h['ip'], 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw']}
+    with SESSION_POOL.connection(dev) as net:
+        cmd = "show ip int brief"
+        if "juniper" in dev['device_type']: cmd = "show interfaces terse"
+        elif "huawei" in dev['device_type']: cmd = "display interface brief"
+        elif "hp" in dev['device_type'] or "aruba" in dev['device_type']: cmd = "show ip interface brief"
+        elif "arista" in dev['device_type']: cmd = "show ip interface brief"
+        elif "nec" in dev['device_type']: cmd = "show ip interface brief"
+        elif "allied" in dev['device_type']: cmd = "show ip interface brief"
+        elif "linux" in dev['device_type']: cmd = "ip link show"
+        res = net.send_command(cmd)
+    if "linux" in dev['device_type']: return [m.group(1) for m in re.finditer(r"(?m)^\d+: ([^:@]+)", res)]
+    return [l.split()[0] for l in res.splitlines() if l and not l.startswith(('Int', 'Name', ' ', 'PHY', 'Interface'))]
+
 class TrafficGhostWorker(QThread):
     log_signal = Signal(str, str, str)
-    update_signal = Signal(str, float, float)
+    update_signal = Signal(str, float, object) # (機器名, 時刻(epoch秒), {IF: (IN Mbps, OUT Mbps)})
     finished_signal = Signal(str, list, dict)
 
-    def __init__(self, host, interface):
+    def __init__(self, host, interfaces, interval=MONITOR_INTERVAL):
         super().__init__()
         self.host = host
-        self.interface = interface
+        self.interfaces = [interfaces] if isinstance(interfaces, str) else list(interfaces)
+        self.interval = interval
         self.is_running = True
 
+    def poll(self, net, v, bulk_cmd, warned):
+        # 1回のポーリング: まとめて取得できる機種は1コマンド、取れなかった IF だけ個別に取得する
+        got = {}
+        if bulk_cmd:
+            parsed = parse_if_counters(net.send_command(bulk_cmd))
+            by_key = {if_key(n): c for n, c in parsed.items()}
+            for i in self.interfaces:
+                c = parsed.get(i) or by_key.get(if_key(i))
+                if c: got[i] = c
+        for i in self.interfaces:
+            if i in got or not self.is_running: continue
+            out = net.send_command(if_command(v, i))
+            mi, mo = RE_IF_IN.search(out), RE_IF_OUT.search(out)
+            if mi and mo: got[i] = (int(next(g for g in mi.groups() if g)), int(next(g for g in mo.groups() if g)))
+            elif i not in warned: warned.add(i); self.log_signal.emit(self.host['name'], f"[!] データ抽出失敗 (Regex Unmatched): {i}", "#FF5555")
+        return got
+
     def run(self):
         h = self.host; name = h['name']
         v = str(h.get('vendor') or 'cisco_ios').strip().lower()
         dev = {'device_type': v, 'host': h['ip'], 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw']}
-        
-        # Command Selection based on vendor
-        cmd = f"show interface {self.interface}"
-        if "juniper" in v: cmd = f"show interfaces {self.interface} detail"
-        elif "huawei" in v: cmd = f"display interface {self.interface}"
-        elif "fortinet" in v: cmd = f"diagnose hardware deviceinfo nic {self.interface}"
-        elif "hp" in v or "aruba" in v: cmd = f"show interface {self.interface}"
-        elif "allied" in v: cmd = f"show interface {self.interface}"
-        elif "nec" in v: cmd = f"show interface {self.interface}"
-        elif "arista" in v: cmd = f"show interface {self.interface}"
-        
-        last_in, last_out, last_time = None, None, None
+        bulk_cmd, warned = if_command(v), set()
         try:
-            with ConnectHandler(**dev) as net:
-                if ">" in net.find_prompt(): net.enable()
-                self.log_signal.emit(name, f"--- [Ghost Mode] 監視開始: {self.interface} ---", "#00FFFF")
+            with SESSION_POOL.connection(dev) as net:
+                self.log_signal.emit(name, f"--- [Ghost Mode] 監視開始: {', '.join(self.interfaces)} ---", "#00FFFF")
                 while self.is_running:
-                    now_time = datetime.now()
-                    output = net.send_command(cmd)
-                    mi=re.search(r"input,?\s+(\d+)\s+bytes|Input bytes\s*:\s*(\d+)|Rx\s+bytes:(\d+)", output, re.I|re.S)
-                    mo=re.search(r"output,?\s+(\d+)\s+bytes|Output bytes\s*:\s*(\d+)|Tx\s+bytes:(\d+)", output, re.I|re.S)
-                    if mi and mo:
-                        curr_in = int(next(g for g in mi.groups() if g))
-                        curr_out = int(next(g for g in mo.groups() if g))
-                        if last_in is not None:
-                            diff_time = (now_time - last_time).total_seconds()
-                            if diff_time > 0:
-                                mbps_in = ((curr_in - last_in) * 8 / diff_time) / 1_000_000
-                                mbps_out = ((curr_out - last_out) * 8 / diff_time) / 1_000_000
-                                self.update_signal.emit(now_time.strftime("%H:%M:%S"), max(0, mbps_in), max(0, mbps_out))
-                        last_in, last_out, last_time = curr_in, curr_out, now_time
-                    else: self.log_signal.emit(name, "[!] データ抽出失敗 (Regex Unmatched)", "#FF5555")
-                    time.sleep(3)
+                    t0 = time.time()
+                    rates = TS_STORE.append(name, t0, self.poll(net, v, bulk_cmd, warned)) # カウンタを記録し、前回値からのレートを得る
+                    if rates: self.update_signal.emit(name, t0, rates)
+                    while self.is_running and time.time() - t0 < self.interval: time.sleep(0.2) # 停止要求にすぐ反応できるよう細切れに待つ
         except Exception as e: self.log_signal.emit(name, f"[!] 接続エラー: {str(e)}", "#FF5555")
+        TS_STORE.flush(name)
         self.finished_signal.emit(name, [], {})
 
     def stop(self): self.is_running = False
 
+# --- トポロジー配置 (モード8) ---
+# ブラウザ側で物理演算をさせると 1000 台規模で固まるため、座標は Python 側で1回だけ計算しトポロジーごとにキャッシュする
+def topology_hash(G):
+    nodes = sorted(map(str, G.nodes()))
+    edges = sorted(tuple(sorted((str(u), str(v)))) for u, v in G.edges())
+    return hashlib.sha256(json.dumps([TOPO_LAYOUT_VERSION, nodes, edges]).encode('utf-8')).hexdigest()
+
+def _spring(G):
+    # networkx は 500 ノード以上の spring_layout に scipy を要するため、その場合はさらにクラスタへ分けて配置する
+    import networkx as nx
+    if len(G) <= 1: return {n: (0.0, 0.0) for n in G}
+    try: pos = nx.spring_layout(G, seed=1, iterations=50)
+    except ImportError:
+        parts = nx.community.louvain_communities(G, seed=1) if G.number_of_edges() else []
+        if len(parts) <= 1: pos = nx.circular_layout(G)
+        else: pos, _ = _cluster_layout(G, parts)
+    # 隣接ノード間隔がおよそ TOPO_NODE_GAP になるよう規模に合わせて広げる
+    xs = [p[0] for p in pos.values()]; ys = [p[1] for p in pos.values()]
+    cx, cy = (max(xs) + min(xs)) / 2, (max(ys) + min(ys)) / 2
+    span = max(max(xs) - min(xs), max(ys) - min(ys)) or 1.0
+    k = TOPO_NODE_GAP * math.sqrt(len(G)) / span
+    return {n: ((p[0] - cx) * k, (p[1] - cy) * k) for n, p in pos.items()}
+
+def _cluster_layout(G, parts):
+    # クラスタ内を個別に配置し、クラスタ間のつながり (縮約グラフ) で各クラスタの中心を決める
+    import networkx as nx
+    cluster = {n: i for i, part in enumerate(parts) for n in part}
+    Q = nx.Graph(); Q.add_nodes_from(range(len(parts)))
+    Q.add_edges_from((cluster[u], cluster[v]) for u, v in G.edges() if cluster[u] != cluster[v])
+    centers = _spring(Q)
+    # クラスタの半径は sqrt(台数) に比例するため、中心間隔もその分だけ広げる
+    grow = 1.6 * math.sqrt(len(G) / len(parts))
+    pos = {}
+    for i, part in enumerate(parts):
+        sub = _spring(G.subgraph(part)); cx, cy = centers[i]
+        for n, (x, y) in sub.items(): pos[n] = (cx * grow + x, cy * grow + y)
+    return pos, cluster
+
+def topology_layout(G):
+    """ノード座標とクラスタ番号を返す。同じトポロジーなら LAYOUT_CACHE_DIR のキャッシュを使う"""
+    import networkx as nx
+    path = os.path.join(LAYOUT_CACHE_DIR, topology_hash(G) + ".json")
+    try:
+        with open(path, encoding='utf-8') as f: d = json.load(f)
+        return {n: tuple(p) for n, p in d['pos'].items()}, d['cluster']
+    except (OSError, ValueError, KeyError): pass
+    if len(G) > TOPO_CLUSTER_MIN and G.number_of_edges():
+        parts = sorted(nx.community.louvain_communities(G, seed=1), key=lambda p: (-len(p), min(map(str, p))))
+        pos, cluster = _cluster_layout(G, parts) if len(parts) > 1 else (_spring(G), {n: 0 for n in G})
+    else: pos, cluster = _spring(G), {n: 0 for n in G}
+    pos = {str(n): (round(x, 1), round(y, 1)) for n, (x, y) in pos.items()}; cluster = {str(n): c for n, c in cluster.items()}
+    try:
+        os.makedirs(LAYOUT_CACHE_DIR, exist_ok=True); tmp = path + ".tmp"
+        with open(tmp, "w", encoding='utf-8') as f: json.dump({'pos': pos, 'cluster': cluster}, f)
+        os.replace(tmp, path)
+    except OSError: pass # キャッシュは無くても描画はできる
+    return pos, cluster
+
 # --- モード8用: ネットワーククローラー (CrawlerWorker) ---
+# 0011.2233.4455 / 0011-2233-4455 / 00:11:22:33:44:55 / 00-11-22-33-44-55 / 001122-334455
+RE_MAC = re.compile(r"\b(?:[0-9a-fA-F]{4}([.:-])[0-9a-fA-F]{4}\1[0-9a-fA-F]{4}|[0-9a-fA-F]{2}([:-])(?:[0-9a-fA-F]{2}\2){4}[0-9a-fA-F]{2}|[0-9a-fA-F]{6}-[0-9a-fA-F]{6})\b")
+
+# LLDP/CDP 詳細表示の1隣接分の開始行 (CDP: Device ID / LLDP: Local Intf・Local Interface・Local Port / Huawei: "<IF> has 1 neighbor(s)")
+RE_NB_START = re.compile(r"^\s*(?:Device ID\s*:|Local Intf\s*:|Local Interface\s*:|Local Port\s*:|\S+ has \d+ neighbors?)", re.M | re.I)
+RE_NB_FIELDS = {
+    'name': re.compile(r"^\s*(?:Device ID|System Name|SysName)\s*:\s*(\S+)", re.M | re.I),
+    'local_port': re.compile(r"^\s*(?:Local Intf|Local Interface|Local Port(?: id)?|Interface)\s*:\s*([^,\s]+)|^(\S+) has \d+ neighbors?", re.M | re.I),
+    'remote_port': re.compile(r"Port ID(?: \(outgoing port\))?\s*:\s*(\S+)", re.I),
+    'ip': re.compile(r"^\s*(?:IP address|IPv4 Address|Management address(?:es)?(?: \(v4\))?|IP|Address)\s*:\s*(\d+\.\d+\.\d+\.\d+)", re.M | re.I),
+    'platform': re.compile(r"^\s*(?:Platform|System Description)\s*:\s*(.+)", re.M | re.I),
+}
+
+def parse_neighbors(output):
+    """CDP/LLDP の詳細表示を [{'name', 'local_port', 'remote_port', 'ip', 'platform'}] にする"""
+    starts = [m.start() for m in RE_NB_START.finditer(output)]
+    res = []
+    for k, pos in enumerate(starts):
+        block = output[pos:starts[k + 1] if k + 1 < len(starts) else len(output)]
+        nb = {}
+        for key, rx in RE_NB_FIELDS.items():
+            m = rx.search(block)
+            if m: nb[key] = next((g for g in m.groups() if g), "").strip()
+        if nb.get('name') or nb.get('ip'): res.append(nb)
+    return res
+
+def short_hostname(name):
+    # CDP の "sw01.example.com" や "sw01(FOC1234)" をインベントリ名と照合できる形にする
+    if not name: return ""
+    name = str(name).strip()
+    return name.lower() if RE_IPV4.fullmatch(name) else re.split(r"[.(]", name)[0].lower()
+
+def mac_to_int(s):
+    """表記の違う MAC アドレスを同じ整数に揃える (不正な値は None)"""
+    h = re.sub(r"[^0-9a-fA-F]", "", str(s))
+    return int(h, 16) if len(h) == 12 else None
+
 class CrawlerWorker(QThread):
     log_signal = Signal(str, str, str); finished_signal = Signal(str, list, dict)
     html_ready_signal = Signal(str) # HTML file path
+    edge_signal = Signal(str, str, str) # 発見したリンク (機器A, 機器B, ラベル) を都度通知
 
-    def __init__(self, start_host, hosts_data):
+    def __init__(self, start_host, hosts_data, max_workers=MAX_PARALLEL_DEVICES):
         super().__init__()
         self.start_host = start_host
         self.hosts_data = hosts_data
-        self.visited = set()
-        self.G = nx.Graph() if HAS_NETWORKX else None
+        self.max_workers = max_workers
+        self.visited, self.skipped = set(), set() # skipped: ログインしなかった未登録の隣接機器 (IP)
+        self.is_running = True
+        self.links = {} # (機器A, 機器B) (名前順) -> {機器名: ポート}
+        if HAS_NETWORKX:
+            import networkx as nx
+            self.G = nx.Graph()
+        else: self.G = None
+
+    def stop(self): self.is_running = False
+
+    def collect(self, h, neighbors=False):
+        """1台分の ARP / MACテーブル (neighbors=True なら LLDP/CDP 隣接も) を1セッションで取得する
+        戻り値 ({IP: MAC(int)}, [(ポート, MAC(int))], [隣接...])"""
+        v = str(h.get('vendor') or 'cisco_ios').lower()
+        dev = {'device_type': v, 'host': h['ip'], 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw']}
+        arp, macs, nbrs = {}, [], []
+        with SESSION_POOL.connection(dev) as net:
+            if neighbors:
+                # Cisco は "show cdp ... && show lldp ..." の2コマンド。1つずつ送って結果をまとめる
+                for cmd in DIAG_COMMANDS.get(vendor_family(v), DIAG_COMMANDS["cisco"])["neighbor"].split("&&"):
+                    try: nbrs.extend(parse_neighbors(net.send_command(cmd.strip())))
+                    except Exception: pass # CDP/LLDP 無効など。取れた分だけ使う
+
+            # Get ARP
+            arp_cmd = "show ip arp" 
+            if "junos" in v: arp_cmd = "show arp"
+            elif "huawei" in v: arp_cmd = "display arp"
+            elif "hp" in v or "aruba" in v: arp_cmd = "show arp"
+            elif "yamaha" in v: arp_cmd = "show arp"
+            elif "fortinet" in v: arp_cmd = "get system arp"
+            for line in net.send_command(arp_cmd).splitlines():
+                mi, mm = RE_IPV4.search(line), RE_MAC.search(line)
+                if mi and mm: arp[mi.group(0)] = mac_to_int(mm.group(0))
+
+            # Get MAC Table
+            mac_cmd = "show mac address-table" 
+            if "junos" in v: mac_cmd = "show ethernet-switching table"
+            elif "huawei" in v: mac_cmd = "display mac-address"
+            elif "yamaha" in v: mac_cmd = "show switch mac address-table"
+            elif "hp" in v: mac_cmd = "show mac-address"
+            elif "allied" in v: mac_cmd = "show mac address-table"
+            for line in net.send_command(mac_cmd).splitlines():
+                parts = line.split()
+                m_obj = RE_MAC.search(line) if len(parts) >= 4 else None
+                if m_obj: macs.append((parts[-1], mac_to_int(m_obj.group(0)))) # 最後の列をポートとみなす (多くの機種で該当)
+        return arp, macs, nbrs
+
+    def add_link(self, u, port_u, v, port_v=None):
+        # 片側ずつ判明したポートを1本のリンクにまとめ、初出/更新時にグラフへ反映して通知する
+        if u == v: return
+        ports = self.links.setdefault(tuple(sorted((u, v))), {})
+        before = dict(ports)
+        if port_u and ports.get(u) in (None, "?"): ports[u] = port_u
+        if port_v and ports.get(v) in (None, "?"): ports[v] = port_v
+        if before == ports and before: return
+        a, b = sorted((u, v)); pa, pb = ports.get(a, "?"), ports.get(b, "?")
+        self.G.add_edge(a, b, label=f"{pa} <--> {pb}")
+        self.edge_signal.emit(a, b, f"{pa} <--> {pb}")
+        if not before: self.log_signal.emit("Crawler", f"Link: {a}[{pa}] -- {b}[{pb}]", "#00FF00")
+
+    @staticmethod
+    def may_login(ip):
+        # 未登録の機器へ起点の認証情報を送ってよいか (CRAWL_DISCOVERED_LOGIN が有効で、CRAWL_MGMT_SUBNETS のどれかに含まれる)
+        if not CRAWL_DISCOVERED_LOGIN or not ip: return False
+        try: a = ip_to_int(ip)
+        except ValueError: return False
+        for net in CRAWL_MGMT_SUBNETS:
+            base, _, n = str(net).partition("/"); n = int(n or 32)
+            if (a ^ ip_to_int(base)) >> (32 - n) == 0: return True
+        return False
+
+    def resolve(self, nb, by_name, by_ip):
+        # 隣接情報をインベントリの機器に対応付ける。載っていない機器は図に載せるだけで、認証情報は may_login を満たす場合だけ付ける
+        h = by_ip.get(nb.get('ip')) or by_name.get(short_hostname(nb.get('name')))
+        if h: return h
+        name = short_hostname(nb.get('name')) or nb.get('ip')
+        if not name: return None
+        desc = (nb.get('platform') or "").lower()
+        vendor = next((drv for key, drv in (("nx-os", "cisco_nxos"), ("cisco", "cisco_ios"), ("arista", "arista_eos"), ("junos", "juniper_junos"), ("juniper", "juniper_junos"), ("huawei", "huawei"), ("aruba", "aruba_os"), ("procurve", "hp_procurve")) if key in desc), self.start_host.get('vendor'))
+        peer = {'name': name, 'ip': nb.get('ip'), 'vendor': vendor, 'discovered': True}
+        if self.may_login(peer['ip']):
+            s = self.start_host
+            peer.update(protocol=s.get('protocol'), user=s.get('user'), pw=s.get('pw'), en_pw=s.get('en_pw'))
+        return peer
 
     def run(self):
         if not HAS_NETWORKX:
@@ -674,102 +2296,64 @@ class CrawlerWorker(QThread):
             return
 
         self.log_signal.emit("Crawler", f"Crawler Start from: {self.start_host['name']}", "#00FFFF")
-        queue = [self.start_host]
-        self.visited.add(self.start_host['ip'])
-        
-        # Data structures
-        mac_db = {}
-        arp_db = {} 
-        host_mac_map = {} 
-        
-        host_ip_map = {h['ip']: h['name'] for h in self.hosts_data}
-
-        # 1. データ収集フェーズ
-        total = len(self.hosts_data)
-        for idx, h in enumerate(self.hosts_data):
-            self.log_signal.emit("Crawler", f"Scanning {h['name']} ({idx+1}/{total})...", "#AAAAAA")
-            try:
-                v = str(h.get('vendor') or 'cisco_ios').lower()
-                dev = {'device_type': v, 'host': h['ip'], 'username': h['user'], 'password': h['pw'], 'secret': h['en_pw']}
-                with ConnectHandler(**dev) as net:
-                    if ">" in net.find_prompt(): net.enable()
-                    
-                    # Get ARP
-                    arp_cmd = "show ip arp" 
-                    if "junos" in v: arp_cmd = "show arp"
-                    elif "huawei" in v: arp_cmd = "display arp"
-                    elif "hp" in v or "aruba" in v: arp_cmd = "show arp"
-                    elif "yamaha" in v: arp_cmd = "show arp"
-                    elif "fortinet" in v: arp_cmd = "get system arp"
-
-                    arp_out = net.send_command(arp_cmd)
-                    for line in arp_out.splitlines():
-                        m = re.search(r"(\d+\.\d+\.\d+\.\d+)\s+.*([0-9a-fA-F]{4}\.[0-9a-fA-F]{4}\.[0-9a-fA-F]{4})", line)
-                        # MAC format variations (colon, dash) can be handled here if needed
-                        if m: arp_db[m.group(1)] = m.group(2)
-                    
-                    # Get MAC Table
-                    mac_cmd = "show mac address-table" 
-                    if "junos" in v: mac_cmd = "show ethernet-switching table"
-                    elif "huawei" in v: mac_cmd = "display mac-address"
-                    elif "yamaha" in v: mac_cmd = "show switch mac address-table"
-                    elif "hp" in v: mac_cmd = "show mac-address"
-                    elif "allied" in v: mac_cmd = "show mac address-table"
-
-                    mac_out = net.send_command(mac_cmd)
-                    
-                    # Identify Self MAC
-                    if h['ip'] in arp_db:
-                        host_mac_map[arp_db[h['ip']]] = h['name']
-                    
-                    h_macs = defaultdict(set)
-                    for line in mac_out.splitlines():
-                        parts = line.split()
-                        if len(parts) >= 4:
-                            # Basic heuristic for MAC and Port. Might need vendor-specific regex for robustness
-                            mac_cand = parts[1]
-                            port_cand = parts[-1]
-                            # Attempt to find MAC in line
-                            m_obj = re.search(r"([0-9a-fA-F]{4}[\.:-][0-9a-fA-F]{4}[\.:-][0-9a-fA-F]{4})", line)
-                            if m_obj:
-                                mac_cand = m_obj.group(1)
-                                # Last word often port, but not always.
-                                h_macs[parts[-1]].add(mac_cand)
-                    mac_db[h['name']] = h_macs
+        by_name = {short_hostname(h['name']): h for h in self.hosts_data}
+        by_ip = {h['ip']: h for h in self.hosts_data if h.get('ip')}
+        arp_all, mac_db = {}, {} # arp_all: {IP: MAC}, mac_db: {機器名: [(ポート, MAC)]}
+        ex = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+        pending = {}
+
+        def submit(h, neighbors):
+            key = h.get('ip') or h['name']
+            if key in self.visited or len(self.visited) >= CRAWL_MAX_DEVICES: return
+            self.visited.add(key); self.G.add_node(h['name'], ip=h.get('ip') or "", discovered=bool(h.get('discovered')))
+            pending[ex.submit(self.collect, h, neighbors)] = (h, neighbors)
 
-            except Exception as e:
-                self.log_signal.emit(h['name'], f"Scan Failed: {e}", "#FF5555")
+        try:
+            # 1. LLDP/CDP による幅優先探索 (起点から隣接をたどり、見つかった機器を順次プールへ投入)
+            submit(self.start_host, True)
+            while pending and self.is_running:
+                done, _ = wait(list(pending), timeout=0.5, return_when=FIRST_COMPLETED)
+                for f in done:
+                    h, with_nb = pending.pop(f)
+                    try: arp, macs, nbrs = f.result()
+                    except Exception as e:
+                        self.log_signal.emit(h['name'], f"Scan Failed: {e}", "#FF5555"); continue
+                    arp_all.update(arp); mac_db[h['name']] = macs
+                    self.log_signal.emit("Crawler", f"Scanned {h['name']} ARP:{len(arp)} MAC:{len(macs)} 隣接:{len(nbrs)} (完了 {len(mac_db)} / 発見 {len(self.visited)})", "#AAAAAA")
+                    for nb in nbrs:
+                        peer = self.resolve(nb, by_name, by_ip)
+                        if not peer: continue
+                        self.G.add_node(peer['name'], ip=peer.get('ip') or "", discovered=bool(peer.get('discovered')))
+                        self.add_link(h['name'], nb.get('local_port'), peer['name'], nb.get('remote_port'))
+                        if not peer.get('ip'): continue
+                        if not peer.get('discovered'): submit(peer, True); continue
+                        if 'pw' not in peer: # 未登録で許可されていない機器にはログインしない (1台につき1回だけ通知)
+                            if peer['ip'] not in self.skipped:
+                                self.skipped.add(peer['ip']); self.log_signal.emit("Crawler", f"未登録の隣接機器 {peer['name']} ({peer['ip']}) にはログインしません", "#AAAAAA")
+                            continue
+                        if peer['ip'] not in self.visited:
+                            self.log_signal.emit("Crawler", f"[!] 未登録の隣接機器 {peer['name']} ({peer['ip']}) へ起点の認証情報でログインします", "#FFA500")
+                        submit(peer, True)
+                # 隣接から辿れなかったインベントリ機器も MAC による推定のため取得する
+                if not pending and CRAWL_SCAN_INVENTORY:
+                    for h in self.hosts_data: submit(h, False)
+        finally: ex.shutdown(wait=False, cancel_futures=True)
+        if not self.is_running:
+            self.log_signal.emit("Crawler", "中断しました。", "#FF5555"); self.finished_signal.emit("Crawler", [], {}); return
 
         # 2. グラフ構築フェーズ (保護)
         try:
-            self.G.add_nodes_from([h['name'] for h in self.hosts_data])
             self.log_signal.emit("Crawler", "Calculating Topology...", "#00AAFF")
-            
-            raw_links = []
-            
-            for h_a in self.hosts_data:
-                name_a = h_a['name']
-                if name_a not in mac_db: continue
-                
-                for port, macs in mac_db[name_a].items():
-                    for mac in macs:
-                        if mac in host_mac_map:
-                            name_b = host_mac_map[mac]
-                            if name_a != name_b:
-                                raw_links.append((name_a, name_b, port))
-            
-            # Consolidate bi-directional links
-            link_map = defaultdict(dict)
-            for u, v, p in raw_links:
-                key = tuple(sorted((u, v)))
-                link_map[key][u] = p
-                
-            for (u, v), ports in link_map.items():
-                port_u = ports.get(u, "?")
-                port_v = ports.get(v, "?")
-                label = f"{port_u} <--> {port_v}"
-                self.G.add_edge(u, v, label=label)
-                self.log_signal.emit("Crawler", f"Link: {u}[{port_u}] -- {v}[{port_v}]", "#00FF00")
+
+            # 機器自身のMAC (各機器のARPに載った管理IPのMAC) -> 機器名 の索引を作り、MACテーブルを1回なめるだけでリンクを得る
+            # LLDP/CDP で判明済みの機器ペアはそちらを優先する
+            names = {n: d.get('ip') for n, d in self.G.nodes(data=True)}
+            owner = {arp_all[ip]: n for n, ip in names.items() if ip in arp_all}
+            known = set(self.links)
+            for name_a, entries in mac_db.items():
+                for port, mac in entries:
+                    name_b = owner.get(mac)
+                    if name_b and name_b != name_a and tuple(sorted((name_a, name_b))) not in known: self.add_link(name_a, port, name_b)
 
             # HTML生成
             html_path = self.generate_html(self.G)
@@ -782,246 +2366,1284 @@ class CrawlerWorker(QThread):
             self.finished_signal.emit("Crawler", [], {})
 
     def generate_html(self, G):
-        nodes = []
-        edges = []
-        for n in G.nodes():
-            nodes.append({'id': n, 'label': n})
-        for u, v, data in G.edges(data=True):
-            edges.append({'from': u, 'to': v, 'label': data.get('label', ''), 'arrows': 'to;from'})
-        
-        html_content = """
-<!DOCTYPE html>
+        # 座標は topology_layout で計算済み。ページ側は描画 (パン/ズーム/クラスタ表示) だけを行うので外部ライブラリは不要
+        pos, cluster = topology_layout(G)
+        names = [str(n) for n in G.nodes()]
+        idx = {n: i for i, n in enumerate(names)}
+        nodes = [[str(n), *pos[str(n)], cluster[str(n)], 1 if d.get('discovered') else 0, d.get('ip') or ""] for n, d in G.nodes(data=True)]
+        edges = [[idx[str(u)], idx[str(v)], data.get('label', '')] for u, v, data in G.edges(data=True)]
+
+        # クラスタ (縮小表示用): 重心・半径・台数・代表名 と クラスタ間のリンク本数
+        members = {}
+        for n in names: members.setdefault(cluster[n], []).append(n)
+        clusters = []
+        for c in range(max(members) + 1 if members else 0):
+            ms = members.get(c, [])
+            if not ms: clusters.append([0, 0, 0, 0, ""]); continue
+            cx = sum(pos[n][0] for n in ms) / len(ms); cy = sum(pos[n][1] for n in ms) / len(ms)
+            r = max(math.hypot(pos[n][0] - cx, pos[n][1] - cy) for n in ms) + TOPO_NODE_GAP / 2
+            hub = max(ms, key=lambda n: (G.degree(n), n))
+            clusters.append([round(cx, 1), round(cy, 1), round(r, 1), len(ms), hub])
+        links = {}
+        for u, v in G.edges():
+            cu, cv = sorted((cluster[str(u)], cluster[str(v)]))
+            if cu != cv: links[(cu, cv)] = links.get((cu, cv), 0) + 1
+        cedges = [[a, b, k] for (a, b), k in links.items()]
+        data = json.dumps({'nodes': nodes, 'edges': edges, 'clusters': clusters if len(clusters) > 1 else [], 'cedges': cedges, 'gap': TOPO_NODE_GAP}, ensure_ascii=False).replace("</", "<\\/")
+
+        html_content = """<!DOCTYPE html>
 <html>
 <head>
   <meta charset="utf-8">
   <title>Network Topology</title>
-  <script type="text/javascript" src="https://unpkg.com/vis-network/standalone/umd/vis-network.min.js"></script>
   <style type="text/css">
-    #mynetwork { width: 100%%; height: 90vh; border: 1px solid lightgray; background-color: #222; }
-    body { margin: 0; background-color: #111; color: #eee; font-family: sans-serif; }
-    h2 { padding: 10px; margin: 0; display:inline-block; }
-    .controls { padding: 10px; border-bottom: 1px solid #444; }
-    button { background: #444; color: white; border: 1px solid #666; padding: 5px 10px; cursor: pointer; }
-    button:hover { background: #555; }
+    body { margin: 0; background-color: #111; color: #eee; font-family: sans-serif; overflow: hidden; }
+    h2 { padding: 0 10px 0 0; margin: 0; display: inline-block; font-size: 18px; }
+    .controls { padding: 8px 10px; border-bottom: 1px solid #444; height: 28px; }
+    button, input { background: #444; color: white; border: 1px solid #666; padding: 4px 10px; }
+    button { cursor: pointer; } button:hover { background: #555; }
+    #stat { color: #999; margin-left: 10px; font-size: 13px; }
+    #net { display: block; background-color: #222; cursor: grab; }
+    #info { position: absolute; right: 10px; top: 54px; background: rgba(0,0,0,0.8); border: 1px solid #555; padding: 8px; font-size: 13px; max-width: 360px; max-height: 70vh; overflow: auto; display: none; white-space: pre; }
   </style>
 </head>
 <body>
   <div class="controls">
     <h2>Network Topology</h2>
-    <button onclick="togglePhysics()">Toggle Physics (Freeze/Unfreeze)</button>
+    <button onclick="fit(null)">Fit</button>
+    <input id="q" placeholder="Search name / IP" onkeydown="if(event.key==='Enter')search(this.value)">
+    <span id="stat"></span>
   </div>
-  <div id="mynetwork"></div>
+  <canvas id="net"></canvas>
+  <div id="info"></div>
   <script type="text/javascript">
-    var nodes = new vis.DataSet(%s);
-    var edges = new vis.DataSet(%s);
-    var container = document.getElementById('mynetwork');
-    var data = { nodes: nodes, edges: edges };
-    var options = {
-      nodes: { 
-        shape: 'dot', size: 25, 
-        font: { color: '#ffffff', size: 16 },
-        borderWidth: 2, color: { background: '#008080', border: '#ffffff' }
-      },
-      edges: { 
-        width: 2, 
-        color: { color: '#aaaaaa', highlight: '#00FFFF' }, 
-        font: { color: '#ffffff', size: 12, strokeWidth: 2, strokeColor: '#000000', align: 'top' },
-        smooth: { type: 'continuous' }
-      },
-      physics: { 
-        enabled: true,
-        stabilization: { iterations: 1000 },
-        barnesHut: { 
-            gravitationalConstant: -3000, 
-            centralGravity: 0.0,  
-            springLength: 200, 
-            springConstant: 0.01, 
-            damping: 0.5          
-        }
-      },
-      interaction: { hover: true, navigationButtons: true, keyboard: true }
-    };
-    var network = new vis.Network(container, data, options);
-    network.on("dragStart", function (params) {
-        if (params.nodes.length > 0) {
-            var nodeId = params.nodes[0];
-            nodes.update({id: nodeId, fixed: false});
-        }
+    var D = /*DATA*/;
+    var N = D.nodes, E = D.edges, C = D.clusters, CE = D.cedges;
+    var cv = document.getElementById('net'), ctx = cv.getContext('2d'), info = document.getElementById('info');
+    var s = 1, ox = 0, oy = 0, sel = -1, adj = [], pending = false;
+    N.forEach(function () { adj.push([]); });
+    E.forEach(function (e, k) { adj[e[0]].push(k); adj[e[1]].push(k); });
+    function coarse() { return C.length && s * D.gap < 16; } // 隣接ノードの画面上の間隔が詰まったらクラスタ表示
+    document.getElementById('stat').textContent = N.length + ' nodes / ' + E.length + ' links' + (C.length ? ' / ' + C.length + ' clusters' : '');
+
+    function resize() { cv.width = window.innerWidth; cv.height = window.innerHeight - 45; draw(); }
+    function fit(list) {
+      var x0 = 1e18, y0 = 1e18, x1 = -1e18, y1 = -1e18;
+      (list || N.map(function (n, i) { return i; })).forEach(function (i) { var n = N[i]; x0 = Math.min(x0, n[1]); y0 = Math.min(y0, n[2]); x1 = Math.max(x1, n[1]); y1 = Math.max(y1, n[2]); });
+      if (x0 > x1) { x0 = y0 = -1; x1 = y1 = 1; }
+      s = Math.min(cv.width / (x1 - x0 + 120), cv.height / (y1 - y0 + 120), 2);
+      ox = cv.width / 2 - s * (x0 + x1) / 2; oy = cv.height / 2 - s * (y0 + y1) / 2; draw();
+    }
+    function draw() { if (!pending) { pending = true; requestAnimationFrame(render); } }
+    function render() {
+      pending = false;
+      var W = cv.width, H = cv.height;
+      ctx.setTransform(1, 0, 0, 1, 0, 0); ctx.clearRect(0, 0, W, H);
+      ctx.setTransform(s, 0, 0, s, ox, oy);
+      var vx0 = -ox / s, vy0 = -oy / s, vx1 = (W - ox) / s, vy1 = (H - oy) / s, m = 40;
+      function inView(x, y, r) { return x + r > vx0 - m && x - r < vx1 + m && y + r > vy0 - m && y - r < vy1 + m; }
+      ctx.lineWidth = 1.5 / s;
+      // 縮小時はクラスタ単位 (詳細度を下げる)
+      if (coarse()) {
+        ctx.strokeStyle = '#777'; ctx.beginPath();
+        CE.forEach(function (e) { var a = C[e[0]], b = C[e[1]]; ctx.moveTo(a[0], a[1]); ctx.lineTo(b[0], b[1]); });
+        ctx.stroke();
+        ctx.font = (12 / s) + 'px sans-serif'; ctx.textAlign = 'center';
+        C.forEach(function (c) {
+          if (!c[3] || !inView(c[0], c[1], c[2])) return;
+          ctx.fillStyle = 'rgba(0,128,128,0.55)'; ctx.strokeStyle = '#fff';
+          ctx.beginPath(); ctx.arc(c[0], c[1], c[2], 0, 2 * Math.PI); ctx.fill(); ctx.stroke();
+          ctx.fillStyle = '#fff'; ctx.fillText(c[4] + ' (' + c[3] + ')', c[0], c[1]);
+        });
+        return;
+      }
+      var hl = {};
+      if (sel >= 0) { hl[sel] = 1; adj[sel].forEach(function (k) { hl[E[k][0]] = 1; hl[E[k][1]] = 1; }); }
+      ctx.strokeStyle = sel >= 0 ? '#555' : '#aaa'; ctx.beginPath();
+      E.forEach(function (e) {
+        var a = N[e[0]], b = N[e[1]];
+        if (!inView(Math.min(a[1], b[1]), Math.min(a[2], b[2]), 0) && !inView(Math.max(a[1], b[1]), Math.max(a[2], b[2]), 0) && !inView(a[1], a[2], 0) && !inView(b[1], b[2], 0)) return;
+        ctx.moveTo(a[1], a[2]); ctx.lineTo(b[1], b[2]);
+      });
+      ctx.stroke();
+      if (sel >= 0) {
+        ctx.strokeStyle = '#00FFFF'; ctx.lineWidth = 3 / s; ctx.beginPath();
+        adj[sel].forEach(function (k) { var a = N[E[k][0]], b = N[E[k][1]]; ctx.moveTo(a[1], a[2]); ctx.lineTo(b[1], b[2]); });
+        ctx.stroke();
+      }
+      var r = Math.max(8, 3 / s);
+      [['#008080', 0], ['#B8860B', 1]].forEach(function (c) {
+        ctx.fillStyle = c[0]; ctx.beginPath();
+        N.forEach(function (n) { if (n[4] === c[1] && inView(n[1], n[2], r)) { ctx.moveTo(n[1] + r, n[2]); ctx.arc(n[1], n[2], r, 0, 2 * Math.PI); } });
+        ctx.fill();
+      });
+      if (sel >= 0) { ctx.strokeStyle = '#00FFFF'; ctx.lineWidth = 3 / s; ctx.beginPath(); ctx.arc(N[sel][1], N[sel][2], r + 3 / s, 0, 2 * Math.PI); ctx.stroke(); }
+      // 文字は拡大時のみ (ポート名はさらに拡大したとき)
+      ctx.textAlign = 'center'; ctx.fillStyle = '#fff';
+      if (s > 0.45) {
+        ctx.font = (12 / s) + 'px sans-serif';
+        N.forEach(function (n, i) { if ((s > 0.7 || hl[i]) && inView(n[1], n[2], 0)) ctx.fillText(n[0], n[1], n[2] - r - 4 / s); });
+      }
+      if (s > 1.2) {
+        ctx.font = (10 / s) + 'px sans-serif'; ctx.fillStyle = '#ccc';
+        E.forEach(function (e) { var a = N[e[0]], b = N[e[1]], x = (a[1] + b[1]) / 2, y = (a[2] + b[2]) / 2; if (e[2] && inView(x, y, 0)) ctx.fillText(e[2], x, y); });
+      }
+    }
+    function pick(px, py) {
+      var x = (px - ox) / s, y = (py - oy) / s;
+      if (coarse()) {
+        for (var c = 0; c < C.length; c++) if (C[c][3] && Math.hypot(C[c][0] - x, C[c][1] - y) <= C[c][2]) return { cluster: c };
+        return null;
+      }
+      var best = -1, bd = Math.max(12, 6 / s);
+      N.forEach(function (n, i) { var d = Math.hypot(n[1] - x, n[2] - y); if (d < bd) { bd = d; best = i; } });
+      return best >= 0 ? { node: best } : null;
+    }
+    function select(i) {
+      sel = i;
+      if (i < 0) { info.style.display = 'none'; draw(); return; }
+      var n = N[i], lines = [n[0] + (n[5] ? '  ' + n[5] : '') + (n[4] ? '  (discovered)' : ''), ''];
+      adj[i].forEach(function (k) { var e = E[k], o = N[e[0] === i ? e[1] : e[0]]; lines.push(o[0] + '   ' + e[2]); });
+      info.textContent = lines.join('\\n'); info.style.display = 'block'; draw();
+    }
+    function search(q) {
+      q = q.toLowerCase(); if (!q) return;
+      for (var i = 0; i < N.length; i++) if (N[i][0].toLowerCase().indexOf(q) >= 0 || N[i][5].indexOf(q) >= 0) {
+        var k = Math.max(s, 1); s = k; ox = cv.width / 2 - s * N[i][1]; oy = cv.height / 2 - s * N[i][2]; select(i); return;
+      }
+    }
+    var drag = null, moved = false;
+    cv.addEventListener('mousedown', function (ev) { drag = [ev.clientX, ev.clientY, ox, oy]; moved = false; cv.style.cursor = 'grabbing'; });
+    window.addEventListener('mousemove', function (ev) {
+      if (!drag) return;
+      if (Math.abs(ev.clientX - drag[0]) + Math.abs(ev.clientY - drag[1]) > 3) moved = true;
+      ox = drag[2] + ev.clientX - drag[0]; oy = drag[3] + ev.clientY - drag[1]; draw();
     });
-    network.on("dragEnd", function (params) {
-        if (params.nodes.length > 0) {
-            var nodeId = params.nodes[0];
-            nodes.update({id: nodeId, fixed: {x: false, y: false}});
-        }
+    window.addEventListener('mouseup', function (ev) {
+      if (!drag) return; drag = null; cv.style.cursor = 'grab';
+      if (moved) return;
+      var rc = cv.getBoundingClientRect(), p = pick(ev.clientX - rc.left, ev.clientY - rc.top);
+      if (!p) return select(-1);
+      if (p.cluster !== undefined) return fit(N.map(function (n, i) { return i; }).filter(function (i) { return N[i][3] === p.cluster; }));
+      select(p.node);
     });
-    function togglePhysics() {
-        options.physics.enabled = !options.physics.enabled;
-        network.setOptions(options);
-    }
+    cv.addEventListener('wheel', function (ev) {
+      ev.preventDefault();
+      var rc = cv.getBoundingClientRect(), px = ev.clientX - rc.left, py = ev.clientY - rc.top, k = Math.min(Math.max(Math.exp(-ev.deltaY * 0.0015), 0.005 / s), 8 / s);
+      ox = px - (px - ox) * k; oy = py - (py - oy) * k; s *= k; draw();
+    }, { passive: false });
+    window.addEventListener('resize', resize);
+    cv.width = window.innerWidth; cv.height = window.innerHeight - 45; fit(null);
   </script>
 </body>
 </html>
-""" % (json.dumps(nodes), json.dumps(edges))
-        
+""".replace("/*DATA*/", data)
+
         path = os.path.join(REPORT_DIR, f"topology_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html")
         with open(path, "w", encoding='utf-8') as f:
             f.write(html_content)
         return path
 
+# --- モード9用: HEXダンプの解析と pcap/pcapng 書き出し ---
+LINKTYPE_ETHERNET, LINKTYPE_RAW = 1, 101
+# データ行: "3E3F1E20: ..." (EPC) / "  0000:  ..." (IOS-XE) / "\t0x0000:  ..." (tcpdump)。HEX列は空白1つ区切りで、ASCII列の前は空白2つ以上
+# 各パターンは改行から始めて正規表現エンジンの先頭文字探索を効かせる (塊の先頭には改行を補う)
+RE_HEX_ROW = re.compile(r"\n[ \t]*(?:0x)?[0-9A-Fa-f]{4,8}:[ \t]+([0-9A-Fa-f]+(?: [0-9A-Fa-f]+)*)")
+RE_HEX_HEADER = re.compile(r"\n((?![ \t]*(?:0x)?[0-9A-Fa-f]{4,8}:[ \t])[ \t]*\S[^\n]*)(?=\n)") # データ行以外 (時刻などの見出し) = パケットの区切り
+RE_HEX_OFFSET0 = re.compile(r"(?=\n[ \t]*(?:0x)?0000:[ \t])") # 見出しの無い形式はオフセット 0 の行で区切る
+RE_EPC_TS = re.compile(r"^\s*(\d{1,2}:\d{2}:\d{2}(?:\.\d+)?)\s+\S+\s+([A-Z][a-z]{2})\s+(\d{1,2})\s+(\d{4})\s*:") # "11:12:49.519 JST Mar 4 2013 : ..."
+RE_TOD = re.compile(r"^(\d{1,2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?\s") # tcpdump の行頭時刻
+
+def guess_linktype(pkt):
+    # IPv4/IPv6 ヘッダから始まり長さも一致すれば RAW (tcpdump -x はリンク層を出さない)、それ以外は Ethernet
+    if len(pkt) >= 20 and pkt[0] >> 4 == 4 and int.from_bytes(pkt[2:4], "big") == len(pkt): return LINKTYPE_RAW
+    if len(pkt) >= 40 and pkt[0] >> 4 == 6 and int.from_bytes(pkt[4:6], "big") + 40 == len(pkt): return LINKTYPE_RAW
+    return LINKTYPE_ETHERNET
+
+class HexDumpParser:
+    """機器の HEXダンプ (Cisco EPC / IOS-XE / tcpdump -x) を1パケットずつ (時刻, bytes) に分ける
+    feed() には出力を任意の位置で区切って渡してよい (行の途中は次回に持ち越す)。時刻の無い形式は base_time からの連番"""
+    def __init__(self, base_time=None):
+        self.base = time.time() if base_time is None else base_time
+        self.rest, self.hexs, self.ts, self.last_ts, self.seq, self.bad = "", [], None, None, 0, 0
+
+    def feed(self, chunk):
+        text = self.rest + chunk; cut = text.rfind("\n") + 1
+        self.rest = text[cut:]; out = []
+        self._block(text[:cut], out)
+        return out
+
+    def close(self):
+        out = []
+        if self.rest: self._block(self.rest + "\n", out); self.rest = ""
+        self._flush(out)
+        return out
+
+    def _block(self, text, out):
+        # 行ごとではなく、見出し行で区切った塊ごとに HEX 列をまとめて取り出す (1パケット = fromhex 1回)
+        for k, part in enumerate(RE_HEX_HEADER.split("\n" + text)):
+            if k % 2: self._flush(out); self.ts = self._parse_ts(part)
+            else:
+                for j, seg in enumerate(RE_HEX_OFFSET0.split(part)):
+                    if j: self._flush(out)
+                    self.hexs.extend(RE_HEX_ROW.findall(seg))
+
+    def _flush(self, out):
+        if not self.hexs: return
+        try: data = bytes.fromhex("".join(self.hexs))
+        except ValueError: data = None; self.bad += 1 # 欠けた行があるパケットは捨てる
+        if data:
+            ts = self.ts if self.ts is not None else self.base + self.seq * 1e-6
+            out.append((ts, data)); self.seq += 1; self.last_ts = ts
+        self.hexs, self.ts = [], None
+
+    def _parse_ts(self, line):
+        m = RE_EPC_TS.match(line)
+        if m:
+            hms = m.group(1) if "." in m.group(1) else m.group(1) + ".0"
+            try: return datetime.strptime(f"{m.group(2)} {m.group(3)} {m.group(4)} {hms}", "%b %d %Y %H:%M:%S.%f").timestamp()
+            except ValueError: return None
+        m = RE_TOD.match(line)
+        if m: # 時刻のみ: 取得開始日の時刻とし、日付をまたいだら翌日にする
+            d = datetime.fromtimestamp(self.base).replace(hour=int(m.group(1)), minute=int(m.group(2)), second=int(m.group(3)), microsecond=int((m.group(4) or "0").ljust(6, "0")))
+            ts = d.timestamp()
+            if self.last_ts is not None and ts < self.last_ts - 43200: ts += 86400
+            return ts
+        return None
+
+class PcapWriter:
+    """pcap (マイクロ秒) / pcapng をパケット単位で追記する。ヘッダや IF 定義は最初のパケットで書く (リンク種別をそこで判定)"""
+    def __init__(self, path, fmt=None):
+        self.path, self.fmt = path, (fmt or PCAP_FORMAT)
+        self.f = open(path, "wb", buffering=1 << 20)
+        self.ifaces, self.count = [], 0 # ifaces: [名前, リンク種別, IDB出力済みか]
+        if self.fmt == "pcapng": # SHB (セクションヘッダ)
+            self.f.write(struct.pack("<IIIHHqI", 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+    def add_interface(self, name, linktype=None):
+        """IF (pcapng では機器/IF ごとの IDB) を登録して番号を返す。pcap は1つだけ"""
+        if self.fmt != "pcapng" and self.ifaces: return 0
+        self.ifaces.append([name, linktype, False]); return len(self.ifaces) - 1
+
+    def _open_iface(self, i, pkt):
+        info = self.ifaces[i]; info[1] = info[1] or guess_linktype(pkt); info[2] = True
+        if self.fmt != "pcapng":
+            self.f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, info[1])); return
+        name = str(info[0]).encode('utf-8')[:255]
+        opt = struct.pack("<HH", 2, len(name)) + name + b"\0" * (-len(name) % 4) + struct.pack("<HH", 0, 0) # if_name + opt_endofopt
+        n = 20 + len(opt)
+        self.f.write(struct.pack("<IIHHI", 1, n, info[1], 0, 65535) + opt + struct.pack("<I", n))
+
+    def write(self, ts, pkt, iface=0):
+        if not self.ifaces: self.add_interface("capture")
+        if not self.ifaces[iface][2]: # IDB は IF 番号順に並べる必要があるので、前の番号で未出力のものも先に書く
+            for j in range(iface + 1):
+                if not self.ifaces[j][2]: self._open_iface(j, pkt if j == iface else b"")
+        us = int(round(ts * 1e6))
+        if self.fmt == "pcapng":
+            pad = -len(pkt) % 4; n = 32 + len(pkt) + pad
+            self.f.write(struct.pack("<IIIIIII", 6, n, iface, us >> 32, us & 0xFFFFFFFF, len(pkt), len(pkt)))
+            self.f.write(pkt); self.f.write(b"\0" * pad + struct.pack("<I", n))
+        else:
+            self.f.write(struct.pack("<IIII", us // 1000000, us % 1000000, len(pkt), len(pkt))); self.f.write(pkt)
+        self.count += 1
+
+    def close(self):
+        if self.f: self.f.close(); self.f = None
+
+def stream_command(net, cmd, on_chunk, timeout=60, cancelled=lambda: False):
+    """コマンドを送り、プロンプトが戻るまでの出力を受信した分ずつ on_chunk に渡す (数MBのダンプを1つの文字列にしない)
+    戻り値: プロンプトまで受け取れたか"""
+    prompt = net.find_prompt().strip()
+    net.write_channel(cmd + net.RETURN)
+    head, tail, deadline = "", "", time.monotonic() + timeout
+    while time.monotonic() < deadline and not cancelled():
+        data = net.read_channel()
+        if not data: time.sleep(0.1); continue
+        on_chunk(data)
+        if len(head) < 4096: head += data # コマンドのエコーより前のプロンプトで止まらないように
+        tail = (tail + data)[-(len(prompt) + 64):]
+        if cmd[:40] in head and tail.rstrip().endswith(prompt): return True
+    return False
+
+def _if_tsresol(opts, en):
+    # IDB のオプションから if_tsresol (1秒あたりの刻み数) を取り出す。無ければマイクロ秒
+    k = 0
+    while k + 4 <= len(opts):
+        code, ln = struct.unpack_from(en + "HH", opts, k)
+        if code == 0: break
+        if code == 9 and ln >= 1: v = opts[k + 4]; return 2 ** (v & 0x7F) if v & 0x80 else 10 ** v
+        k += 4 + ln + (-ln % 4)
+    return 1000000
+
+def iter_pcap(path):
+    """pcap / pcapng を先頭から1パケットずつ (時刻, リンク種別, bytes) で返す (ファイル全体は読み込まない)"""
+    with open(path, "rb") as f:
+        head = f.read(4)
+        if head == b"\x0a\x0d\x0d\x0a": # pcapng: IF ごとのリンク種別と時刻の刻みは IDB から
+            f.seek(0); en, ifs = "<", []
+            while True:
+                h = f.read(12)
+                if len(h) < 12: return
+                if h[:4] == b"\x0a\x0d\x0d\x0a": en, ifs = ("<" if h[8:12] == b"\x4d\x3c\x2b\x1a" else ">"), [] # セクションごとに IF 番号は振り直し
+                btype, n = struct.unpack(en + "II", h[:8]); body = h[8:] + f.read(n - 12)
+                if len(body) < n - 8: return # 書きかけの末尾
+                if btype == 1: ifs.append((struct.unpack_from(en + "H", body)[0], _if_tsresol(body[8:-4], en)))
+                elif btype == 6:
+                    iid, hi, lo, cap = struct.unpack_from(en + "IIII", body); lt, res = ifs[iid]
+                    yield ((hi << 32) | lo) / res, lt, body[20:20 + cap]
+            return
+        magic = {b"\xd4\xc3\xb2\xa1": ("<", 1e6), b"\xa1\xb2\xc3\xd4": (">", 1e6), b"\x4d\x3c\xb2\xa1": ("<", 1e9), b"\xa1\xb2\x3c\x4d": (">", 1e9)}.get(head)
+        if not magic: raise ValueError(f"pcap / pcapng ではありません: {path}")
+        en, res = magic; lt = struct.unpack(en + "I", f.read(20)[16:20])[0]
+        while True:
+            h = f.read(16)
+            if len(h) < 16: return
+            sec, frac, cap, _ = struct.unpack(en + "IIII", h); pkt = f.read(cap)
+            if len(pkt) < cap: return
+            yield sec + frac / res, lt, pkt
+
+def merge_pcaps(sources, out_path):
+    """[(IF名, pcap/pcapng のパス)] を時刻順に1つの pcapng へまとめる (k-way マージ。各ファイルは1パケットずつ読むだけ)
+    IF名ごとに1つの IF (IDB) を作る。機器の時計がずれているとその分だけ前後する (NTP 同期が前提)。戻り値: パケット数"""
+    def tagged(i, it):
+        for ts, _, pkt in it: yield ts, i, pkt
+    with PcapWriter(out_path, "pcapng") as pw:
+        streams = []
+        for label, path in sources:
+            it = iter_pcap(path); first = next(it, None)
+            if first is None: continue
+            streams.append(tagged(pw.add_interface(label, first[1]), chain([first], it)))
+        for ts, i, pkt in heapq.merge(*streams, key=lambda r: r[0]): pw.write(ts, pkt, i)
+        return pw.count
+
+def synthetic_hex_dump(packets, fmt="epc", base=0.0):
+    # ベンチマーク用: パケット列を機器の HEXダンプ形式の文字列にする
+    out = []
+    for k, p in enumerate(packets):
+        t = base + k * 0.001
+        if fmt == "epc":
+            out.append(datetime.fromtimestamp(t).strftime("%H:%M:%S.%f")[:-3] + datetime.fromtimestamp(t).strftime(" JST %b %d %Y : IPv4 LES CEF    : Gi0/1 None\n"))
+            for off in range(0, len(p), 16):
+                row = p[off:off + 16].hex().upper(); words = " ".join(row[i:i + 8] for i in range(0, len(row), 8))
+                out.append(f"{0x3E3F1E20 + off:08X}: {words:<35}  {''.join(chr(b) if 32 <= b < 127 else '.' for b in p[off:off + 16])}\n")
+        else:
+            out.append(datetime.fromtimestamp(t).strftime("%H:%M:%S.%f") + f" IP 10.0.0.1 > 10.0.0.2: length {len(p)}\n")
+            for off in range(0, len(p), 16):
+                row = p[off:off + 16].hex(); out.append(f"\t0x{off:04x}:  " + " ".join(row[i:i + 4] for i in range(0, len(row), 4)) + "\n")
+        out.append("\n")
+    return "".join(out)
+
+def benchmark_pcap(n_packets=20000, seed=1):
+    """HEXダンプ解析 + pcap 書き出しの処理速度 (--headless --bench pcap)。旧方式 (トークンごとの正規表現) とも比べる"""
+    rnd = random.Random(seed); base = time.time() - 60
+    pkts = [bytes(rnd.getrandbits(8) for _ in range(rnd.choice((64, 128, 576, 1500)))) for _ in range(n_packets)]
+    result = {}
+    for fmt in ("epc", "tcpdump"):
+        text = synthetic_hex_dump(pkts, fmt, base); mb = len(text) / 1e6
+        t0 = time.perf_counter(); legacy = bytearray()
+        for line in text.splitlines():
+            for p in line.split():
+                if re.match(r"^[0-9A-Fa-f]{4}$", p): legacy.extend(binascii.unhexlify(p))
+        t_legacy = time.perf_counter() - t0
+        fd, path = tempfile.mkstemp(suffix=".pcap"); os.close(fd)
+        t0 = time.perf_counter(); parser = HexDumpParser(base); got = []
+        with PcapWriter(path, "pcap") as pw:
+            for k in range(0, len(text), 1 << 16): # 受信したチャンクを想定して 64KB ずつ渡す
+                for ts, pkt in parser.feed(text[k:k + (1 << 16)]): pw.write(ts, pkt); got.append(pkt)
+            for ts, pkt in parser.close(): pw.write(ts, pkt); got.append(pkt)
+        t_new = time.perf_counter() - t0; size = os.path.getsize(path); os.remove(path)
+        result[fmt] = (mb, t_legacy, t_new, got == pkts, size)
+    return n_packets, result
+
 # --- モード9用: 仮想ワイヤータップ (WiretapWorker) ---
 class WiretapWorker(QThread):
     log_signal = Signal(str, str, str); finished_signal = Signal(str, list, dict)
 
-    def __init__(self, host, interface, pcap_filter, duration):
+    def __init__(self, targets, pcap_filter, duration):
+        """targets = [(ホスト, IF)]。全機器で同じ時間帯を並行してキャプチャし、機器ごとの pcap と2台以上ならまとめた pcapng を残す"""
         super().__init__()
-        self.host, self.iface, self.filter, self.duration = host, interface, pcap_filter, duration
+        self.targets, self.filter, self.duration = list(targets), pcap_filter, duration
+        self.is_running = True
+
+    def stop(self): self.is_running = False
 
     def run(self):
-        name = self.host['name']
-        v = str(self.host.get('vendor') or 'cisco_ios').lower()
-        self.log_signal.emit(name, f"--- Virtual Wiretap Start ({self.duration}s) ---", "#FF00FF")
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        with ThreadPoolExecutor(max_workers=max(1, len(self.targets))) as ex:
+            files = list(ex.map(lambda t: self.capture(t[0], t[1], ts), self.targets))
+        got = [(f"{h['name']}:{i}", f) for (h, i), f in zip(self.targets, files) if f]
+        if len(got) > 1 and self.is_running:
+            out = os.path.join(PCAP_DIR, f"wiretap_merged_{ts}.pcapng")
+            try:
+                n = merge_pcaps(got, out)
+                self.log_signal.emit("GLOBAL", f"[Success] {len(got)}台分 {n} packets を時刻順にまとめました: {out}", "#00FF00")
+            except Exception as e: self.log_signal.emit("GLOBAL", f"Wiretap Merge Error: {str(e)}", "#FF5555")
+        self.finished_signal.emit("GLOBAL", [], {})
+
+    def wait_running(self, sec):
+        end = time.monotonic() + sec
+        while self.is_running and time.monotonic() < end: time.sleep(0.2)
+
+    def cut_short(self, net, name):
+        # ダンプを途中で打ち切った: 機器側のコマンド (dump 表示 / tcpdump) を Ctrl-C で止め、出力が残っている可能性のあるセッションは再利用しない
+        try: net.write_channel("\x03")
+        except Exception: pass
+        SESSION_POOL.discard(net)
+        self.log_signal.emit(name, f"[!] ダンプの受信を途中で打ち切りました ({'キャンセル' if not self.is_running else 'タイムアウト'})。受信済みの分だけ保存します", "#FFA500")
+
+    def remove_epc(self, dev, name):
+        # 打ち切った後の EPC 設定は新しいセッションで消す (残っても次回の開始時に消す)
+        try:
+            with SESSION_POOL.connection(dev) as net:
+                net.send_command("no monitor capture point ip cef CAPPOINT", expect_string=r"#")
+                net.send_command("no monitor capture buffer CAPBUF", expect_string=r"#")
+        except Exception as e: self.log_signal.emit(name, f"[!] EPC の設定を削除できませんでした: {e}", "#FF5555")
+
+    def capture(self, host, iface, ts):
+        # 1台分のキャプチャ。保存したファイルのパスを返す (パケットが無ければ None)
+        name = host['name']
+        v = str(host.get('vendor') or 'cisco_ios').lower()
+        self.log_signal.emit(name, f"--- Virtual Wiretap Start ({self.duration}s) {iface} ---", "#FF00FF")
         
-        pcap_data = b""
+        fname = os.path.join(PCAP_DIR, f"wiretap_{sanitize_filename(name)}_{ts}.{PCAP_FORMAT}")
+        count, epc_left = 0, False; cancelled = lambda: not self.is_running
         try:
-            dev = {'device_type': v, 'host': self.host['ip'], 'username': self.host['user'], 'password': self.host['pw'], 'secret': self.host['en_pw']}
-            with ConnectHandler(**dev) as net:
-                if ">" in net.find_prompt(): net.enable()
+            dev = {'device_type': v, 'host': host['ip'], 'username': host['user'], 'password': host['pw'], 'secret': host['en_pw']}
+            # ダンプは受信した分ずつ解析し、パケット単位でファイルへ書き出す
+            with SESSION_POOL.connection(dev) as net, PcapWriter(fname) as pw:
+                pw.add_interface(f"{name}:{iface}")
+                parser = HexDumpParser(time.time())
+                def sink(chunk):
+                    for t, pkt in parser.feed(chunk): pw.write(t, pkt)
                 if "cisco" in v or "arista" in v or "allied" in v:
                     try:
                         net.send_command("no monitor capture point ip cef CAPPOINT", expect_string=r"#")
                         net.send_command("no monitor capture buffer CAPBUF", expect_string=r"#")
                         self.log_signal.emit(name, "Configuring EPC...", "#888")
                         net.send_command(f"monitor capture buffer CAPBUF size 2048 max-size 1518 linear")
-                        filter_cmd = f"monitor capture point ip cef CAPPOINT {self.iface} both"
+                        filter_cmd = f"monitor capture point ip cef CAPPOINT {iface} both"
                         net.send_command(filter_cmd)
                         net.send_command("monitor capture point associate CAPPOINT CAPBUF")
                         net.send_command("monitor capture point start CAPPOINT")
                         self.log_signal.emit(name, f"Capturing for {self.duration} sec...", "#00FFFF")
-                        time.sleep(self.duration)
+                        self.wait_running(self.duration)
                         net.send_command("monitor capture point stop CAPPOINT")
                         self.log_signal.emit(name, "Downloading Buffer...", "#00AAFF")
-                        out = net.send_command("show monitor capture buffer CAPBUF dump")
-                        pcap_data = self.parse_cisco_hex_dump(out)
-                        net.send_command("no monitor capture point ip cef CAPPOINT")
-                        net.send_command("no monitor capture buffer CAPBUF")
+                        if stream_command(net, "show monitor capture buffer CAPBUF dump", sink, timeout=120, cancelled=cancelled):
+                            net.send_command("no monitor capture point ip cef CAPPOINT")
+                            net.send_command("no monitor capture buffer CAPBUF")
+                        else: self.cut_short(net, name); epc_left = True # ダンプの残りが届くチャネルでは後片付けしない
                     except Exception:
                         self.log_signal.emit(name, "[!] Capture command not supported on this device/version", "#FF5555")
 
                 elif "linux" in v or "aruba_aoscx" in v or "vyos" in v:
                     self.log_signal.emit(name, "Running tcpdump...", "#00FFFF")
-                    cmd_hex = f"timeout {self.duration} tcpdump -i {self.iface} -s 0 -x {self.filter}"
+                    cmd_hex = f"timeout {self.duration} tcpdump -i {iface} -s 0 -x {self.filter}"
                     if "aruba" in v:
                         self.log_signal.emit(name, "[!] Aruba CX capture via CLI text dump is experimental", "#FFA500")
-                        cmd_hex = f"diag utilities tcpdump -i {self.iface} -w -" 
-                    
-                    out = net.send_command(cmd_hex, read_timeout=self.duration + 10)
-                    pcap_data = self.parse_tcpdump_hex(out)
+                        cmd_hex = f"diag utilities tcpdump -i {iface} -w -" 
+
+                    if not stream_command(net, cmd_hex, sink, timeout=self.duration + 30, cancelled=cancelled): self.cut_short(net, name)
                 else:
                     self.log_signal.emit(name, f"[!] Wiretap not implemented for vendor: {v}", "#FF5555")
+                for t, pkt in parser.close(): pw.write(t, pkt)
+                count = pw.count
+                if parser.bad: self.log_signal.emit(name, f"[!] 解析できないパケットを {parser.bad} 件読み飛ばしました", "#FFA500")
+            if epc_left: self.remove_epc(dev, name)
 
-            if pcap_data:
-                ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-                fname = os.path.join(PCAP_DIR, f"wiretap_{name}_{ts}.pcap")
-                with open(fname, "wb") as f: f.write(pcap_data)
-                self.log_signal.emit(name, f"[Success] Saved to {fname}", "#00FF00")
-            elif "implemented" not in str(pcap_data):
+            if count:
+                self.log_signal.emit(name, f"[Success] {count} packets saved to {fname}", "#00FF00")
+            else:
                 self.log_signal.emit(name, "[!] No packets captured or parsing failed", "#FFA500")
 
         except Exception as e:
             self.log_signal.emit(name, f"Wiretap Error: {str(e)}", "#FF5555")
+        if not count and os.path.exists(fname): os.remove(fname) # 空のファイルは残さない
+        return fname if count else None
+
+
+# --- ヘッドレス実行 (GUIなし) ---
+def run_headless(argv):
+    """例: python NetVerify.py --headless --mode 2 --hosts sw01,sw02
+        python NetVerify.py --headless --mode 6 --offline --pairs pairs.csv"""
+    import argparse
+    if sys.stdout is None: # --noconsole でビルドしたEXEには標準出力がないためファイルへ
+        sys.stdout = sys.stderr = open(os.path.join(LOG_DIR, f"headless_{datetime.now().strftime('%Y%m%d')}.log"), "a", encoding='utf-8')
+    ap = argparse.ArgumentParser(prog="NetVerify --headless", description="NetVerify をGUIなしで実行する (モード 0/0t/2/3/4/5/6)")
+    ap.add_argument("--headless", action="store_true")
+    ap.add_argument("--mode", choices=["0", "0t", "2", "3", "4", "5", "6"])
+    ap.add_argument("--bench", choices=["diff", "pcap", "inventory"], help="性能測定のみ行う (diff = 差分エンジン比較 / pcap = HEXダンプ解析と pcap 書き出し / inventory = インベントリ読み込み)")
+    ap.add_argument("--hosts", default="", help="対象のホスト名またはIP (カンマ区切り、省略時は全台)")
+    ap.add_argument("--vendor", default="", help="対象のベンダー (カンマ区切り、--hosts とは AND)")
+    ap.add_argument("--site", default="", help="対象のサイト (カンマ区切り、--hosts とは AND)")
+    ap.add_argument("--inventory", default="", help="インベントリ (xlsx / csv / yaml)。省略時は inventory.xlsx (無ければ inventory.csv / .yaml)")
+    ap.add_argument("--parallel", type=int, default=MAX_PARALLEL_DEVICES, help="同時接続数の上限")
+    ap.add_argument("--site-limit", type=int, default=MAX_PARALLEL_PER_SITE, help="サイトあたりの同時接続数の上限 (0 = 無制限)")
+    ap.add_argument("--master", action="store_true", help="Masterと比較する")
+    ap.add_argument("--save-master", action="store_true", help="Masterとして保存（更新）する")
+    ap.add_argument("--show-output", action="store_true", help="取得内容を標準出力に表示する")
+    ap.add_argument("--no-scan", action="store_true", help="search.txt のキーワード検知を行わない")
+    ap.add_argument("--report", default="", help="レポート(HTML)の保存先")
+    ap.add_argument("--target", default="", help="モード6: 宛先IP (--hosts の各機器から診断する)")
+    ap.add_argument("--pairs", default="", help="モード6: 出発機器,宛先IP を1行ずつ書いたファイル (--offline 時のみ)")
+    ap.add_argument("--offline", action="store_true", help="モード6: 収集済みのルーティングテーブルで診断する (実機に接続しない)")
+    args = ap.parse_args(argv)
+    if args.bench == "diff":
+        n_old, n_new, result, same = benchmark_diff()
+        print(f"diff benchmark: {n_old} -> {n_new} lines (出力HTML {'一致' if same else '不一致'})")
+        for name, (sec, rows) in result.items(): print(f"  {name:6s}: {sec * 1000:9.1f} ms  ({rows} rows)")
+        return 0
+    if args.bench == "pcap":
+        n, result = benchmark_pcap()
+        print(f"pcap benchmark: {n} packets")
+        for fmt, (mb, t_old, t_new, ok, size) in result.items():
+            print(f"  {fmt:8s}: dump {mb:6.1f} MB  旧方式 {t_old * 1000:8.1f} ms  新方式 {t_new * 1000:8.1f} ms ({mb / t_new:6.1f} MB/s, {n / t_new:9.0f} pkt/s)  pcap {size / 1e6:.1f} MB  {'一致' if ok else '不一致'}")
+        return 0
+    if args.bench == "inventory":
+        n, result = benchmark_inventory()
+        print(f"inventory benchmark: {n} rows")
+        for name, sec in result.items(): print(f"  {name:20s}: {sec * 1000:9.1f} ms")
+        return 0
+    if not args.mode: ap.error("--mode を指定してください")
+
+    path = args.inventory or find_inventory_file()
+    inv = InventoryIndex(path) if os.path.exists(path) else None
+    hosts = inv.hosts() if inv else []
+    if args.mode == "6": return run_headless_diag(args, hosts)
+    split = lambda v: [x.strip() for x in v.split(",") if x.strip()]
+    if inv and (args.hosts or args.vendor or args.site): # 索引で絞り込む
+        crit = {k: split(v) for k, v in (("host", args.hosts), ("vendor", args.vendor), ("site", args.site)) if v}
+        selected = inv.find(**crit)
+        if args.hosts:
+            known = inv.find(host=crit['host'], secrets=False)
+            missing = set(crit['host']) - {str(h.get('name')) for h in known} - {str(h.get('ip')) for h in known}
+            if missing: print(f"[!] インベントリに存在しません: {', '.join(sorted(missing))}", file=sys.stderr)
+    else: selected = hosts
+    if not selected:
+        print("[!] 対象機器がありません", file=sys.stderr); return 2
+
+    mode = next(m for m in MODES if m.startswith(args.mode + ":"))
+    scanner = KeywordScanner(load_search_keywords())
+    lock, done = threading.Lock(), threading.Event()
+    report, matrix = ReportSpool(), {}
+
+    def out(name, text):
+        with lock: print(f"[{name}] {text}", flush=True)
+    def on_html(name, html):
+        text = re.sub(r"</td>", "  |  ", re.sub(r"</(tr|div|h\d)>|<br>", "\n", html))
+        text = re.sub(r"<[^>]+>", "", text).strip()
+        out(name, text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&"))
+    def on_finished(name, rep, mesh):
+        with lock:
+            for html in rep: report.add(name, html)
+            if mesh: matrix[name] = mesh
+    def launch(host):
+        worker = NetworkWorker(mode, host, args.show_output, not args.no_scan, scanner, selected, args.master, args.save_master, report=report)
+        worker.log_signal.connect(lambda n, t, c: out(n, t)); worker.html_signal.connect(on_html)
+        worker.finished_signal.connect(on_finished)
+        worker.finished.connect(lambda w=worker: sched.release(w, w.error is not None))
+        worker.start()
+        return worker
+    def on_progress(p):
+        if p['done'] == p['total'] or (sched.cancelled and not p['running']): done.set()
+    sched = DeviceScheduler(launch, args.parallel, args.site_limit, on_progress)
+    try:
+        sched.submit(selected)
+        while not done.wait(0.5): pass
+    except KeyboardInterrupt:
+        sched.cancel(); report.close(); print("[!] 中断しました", file=sys.stderr); return 130
+    finally:
+        SESSION_POOL.close_all()
+
+    if "5:" in mode: report.add("疎通マトリックス", build_mesh_html(matrix))
+    if report:
+        f_p = args.report or os.path.join(REPORT_DIR, f"Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html")
+        report.export(f_p); out("GLOBAL", f"[Report Saved] {f_p} (+ {os.path.basename(os.path.splitext(f_p)[0])}_data)")
+    report.close()
+    p = sched.progress()
+    out("GLOBAL", f"完了: {p['done']}/{p['total']} (失敗 {p['failed']})")
+    return 1 if p['failed'] else 0
+
+def run_headless_diag(args, hosts):
+    # モード6: --target なら --hosts の各機器から、--pairs なら1行ずつ診断し、結果を CSV に書き出す
+    by_key = {str(h.get('name')): h for h in hosts}; by_key.update((str(h.get('ip')), h) for h in hosts if str(h.get('ip')) not in by_key)
+    pairs = []
+    if args.pairs:
+        if not args.offline: print("[!] --pairs は --offline と併用してください (実機への一括ログインは行わない)", file=sys.stderr); return 2
+        with open(args.pairs, encoding='utf-8-sig') as f:
+            for k, line in enumerate(f, 1):
+                src, _, dst = line.strip().partition(",")
+                if not src or src.startswith("#"): continue
+                if src.strip() not in by_key or not RE_IPV4.fullmatch(dst.strip()): print(f"[!] {args.pairs}:{k} を読み飛ばします: {line.strip()}", file=sys.stderr); continue
+                pairs.append((by_key[src.strip()], dst.strip()))
+    elif args.target:
+        srcs = [by_key[x.strip()] for x in args.hosts.split(",") if x.strip() in by_key] if args.hosts else []
+        pairs = [(h, args.target) for h in srcs]
+    if not pairs: print("[!] 診断対象がありません (--hosts と --target、または --pairs を指定)", file=sys.stderr); return 2
+
+    t0 = time.time()
+    if args.offline: traces = RouteSimulator(hosts).batch(pairs)
+    else:
+        traces = []
+        try:
+            for src, dst in pairs:
+                w = DiagnosticWorker(src, dst, hosts); w.log_signal.connect(lambda n, t, c: print(f"[{n}] {t}", flush=True))
+                traces.append(w.walk())
+        finally: SESSION_POOL.close_all()
+    sec = time.time() - t0
+
+    f_p = args.report or os.path.join(REPORT_DIR, f"PathDiag_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    ng = 0
+    with open(f_p, "w", encoding='utf-8-sig', newline='') as f:
+        wr = csv.writer(f); wr.writerow(["source", "target", "result", "hops", "path"])
+        for (src, dst), tr in zip(pairs, traces):
+            res, path = summarize_path(tr); ng += not res.startswith("OK")
+            wr.writerow([src['name'], dst, res, len(tr) - 1, path])
+            if len(pairs) <= 50: print(f"{src['name']} -> {dst}: {res}  [{path}]")
+    print(f"[GLOBAL] {len(pairs)} 件 ({sec * 1000:.1f} ms, NG {ng}) -> {f_p}")
+    return 1 if ng else 0
+
+if HEADLESS and __name__ == "__main__":
+    sys.exit(run_headless(sys.argv[1:]))
+
+# GUI Library (ここから下はGUI起動時のみ読み込まれる)
+from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
+                             QPushButton, QTableView, QTextEdit, 
+                             QHeaderView, QComboBox, QLabel, QCheckBox, QGroupBox, 
+                             QLineEdit, QFileDialog, QInputDialog, QTabWidget, QMessageBox, QScrollArea, QSpinBox,
+                             QDialog, QDialogButtonBox, QListWidget, QListWidgetItem, QAbstractItemView)
+from PySide6.QtCore import Qt, Slot, QTimer, QUrl, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
+from PySide6.QtGui import QTextCursor, QTextBlockFormat, QTextCharFormat, QColor, QWheelEvent, QShortcut, QKeySequence, QDesktopServices, QAction
+
+# --- グラフ描画用キャンバス ---
+# matplotlib (QtAggバックエンド) はグラフを使うモード(6/7)で初めて読み込む
+MplCanvas = None
+def make_canvas(parent=None, width=8, height=5, dpi=100):
+    global MplCanvas
+    if MplCanvas is None:
+        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.figure import Figure
+
+        class MplCanvas(FigureCanvas):
+            def __init__(self, parent=None, width=8, height=5, dpi=100):
+                self.fig = Figure(figsize=(width, height), dpi=dpi, facecolor='#1E1E1E')
+                self.axes = self.fig.add_subplot(111)
+                self.axes.set_facecolor('#1E1E1E')
+                self.axes.tick_params(colors='white')
+                for spine in self.axes.spines.values():
+                    spine.set_edgecolor('#555')
+                self.axes.grid(True, color='#333', linestyle='--')
         
-        self.finished_signal.emit(name, [], {})
+                self.current_dpi = dpi
+                super().__init__(self.fig)
+
+            def wheelEvent(self, event: QWheelEvent):
+                if event.modifiers() & Qt.ControlModifier:
+                    if event.angleDelta().y() > 0:
+                        self.current_dpi += 5
+                    else:
+                        self.current_dpi = max(50, self.current_dpi - 5)
+            
+                    self.fig.set_dpi(self.current_dpi)
+                    self.fig.set_size_inches(self.fig.get_size_inches()) 
+                    self.draw()
+                    event.accept()
+                else:
+                    super().wheelEvent(event)
+    return MplCanvas(parent, width, height, dpi)
+
+class RingBuffer:
+    """固定長の NumPy リングバッファ (1行 = 1サンプル、満杯になると古い行から上書き)"""
+    def __init__(self, capacity, width=1):
+        import numpy as np
+        self.np, self.buf = np, np.zeros((capacity, width))
+        self.cap, self.n, self.i = capacity, 0, 0
+
+    def __len__(self): return self.n
+
+    def append(self, row):
+        self.buf[self.i] = row; self.i = (self.i + 1) % self.cap; self.n = min(self.n + 1, self.cap)
+
+    def last(self): return self.buf[self.i - 1] if self.n else None
+
+    def view(self):
+        """古い順に並べた配列を返す"""
+        if self.n < self.cap: return self.buf[:self.n]
+        return self.np.concatenate((self.buf[self.i:], self.buf[:self.i]))
+
+class TrafficMonitorPlot:
+    """帯域モニターのグラフ。X軸は「何秒前」で固定し、目盛りが変わらない間は線だけを blit で描き直す
+    現在値の一覧は描画コストの大きい matplotlib のテキストではなく横の QLabel に出す"""
+    COLORS = ['#00FF00', '#5599FF', '#FF5555', '#FFFF55', '#FF55FF', '#55FFFF', '#FFAA00', '#AAAAFF', '#AAFFAA', '#FF99CC']
+
+    def __init__(self, parent, window=MONITOR_WINDOW, interval=MONITOR_INTERVAL):
+        self.canvas = make_canvas(parent, width=12, height=7, dpi=100); ax = self.ax = self.canvas.axes
+        self.window, self.cap = window, int(window / max(interval, 0.5)) + 8
+        self.series, self.bg, self.ymax = {}, None, 1.0 # series: (機器, IF) -> (RingBuffer[t, in, out], IN線, OUT線)
+        ax.set_facecolor('#181818'); ax.grid(True, color='#333', linestyle='--', lw=0.5)
+        ax.set_xlim(-window, 0); ax.set_ylim(0, self.ymax); ax.set_xlabel("seconds ago", color='#AAA'); ax.set_ylabel("Mbps (solid: IN / dashed: OUT)", color='#AAA')
+        ax.tick_params(axis='both', colors='#AAA', labelsize=9)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.widget = QWidget(); lay = QHBoxLayout(self.widget); lay.setContentsMargins(0, 0, 0, 0); lay.addWidget(self.canvas, 1)
+        self.label = QLabel(""); self.label.setAlignment(Qt.AlignTop); self.label.setStyleSheet("color:white; background:#111; font-family:Consolas, monospace; padding:6px;"); lay.addWidget(self.label)
+
+    def add_series(self, dev, iface):
+        if (dev, iface) in self.series: return
+        c = self.COLORS[len(self.series) % len(self.COLORS)]
+        li, = self.ax.plot([], [], color=c, lw=1.8, animated=True, label=f"{dev} {iface}")
+        lo, = self.ax.plot([], [], color=c, lw=1.2, ls='--', animated=True)
+        self.series[(dev, iface)] = (RingBuffer(self.cap, 3), li, lo)
+        self.ax.legend(loc='upper left', facecolor='#222', labelcolor='white', fontsize=8, ncol=max(1, len(self.series) // 12 + 1))
+        self.canvas.fig.tight_layout(); self.canvas.draw_idle()
+
+    def add_samples(self, dev, ts, rates):
+        for iface, (m_in, m_out) in rates.items():
+            s = self.series.get((dev, iface))
+            if s: s[0].append((ts, m_in, m_out))
+
+    def refresh(self, now=None):
+        now, peak, rows = now or time.time(), 0.0, []
+        for (dev, iface), (rb, li, lo) in self.series.items():
+            if not len(rb): continue
+            d = rb.view(); x = d[:, 0] - now
+            li.set_data(x, d[:, 1]); lo.set_data(x, d[:, 2])
+            vis = x >= -self.window
+            if vis.any(): peak = max(peak, float(d[vis, 1:].max()))
+            rows.append((-(d[-1, 1] + d[-1, 2]), f"{dev[:12]:<12} {iface[:20]:<20} {d[-1, 1]:>8.2f} {d[-1, 2]:>8.2f}"))
+        rows.sort()
+        text = f"{'NOW (Mbps)':<33} {'IN':>8} {'OUT':>8}\n" + "\n".join(r for _, r in rows) if rows else ""
+        if text != self.label.text(): self.label.setText(text)
+        # 目盛りを変える必要がある時だけ全体を描き直す (それ以外は背景を戻して線だけ描く)
+        top = self.nice(peak * 1.15)
+        if top > self.ymax or top < self.ymax / 4:
+            self.ymax = top; self.ax.set_ylim(0, top); self.canvas.draw_idle(); return
+        self._blit()
+
+    @staticmethod
+    def nice(v):
+        if v <= 0: return 1.0
+        e = 10 ** math.floor(math.log10(v))
+        return next(m * e for m in (1, 2, 5, 10) if m * e >= v)
+
+    def _on_draw(self, event):
+        self.bg = self.canvas.copy_from_bbox(self.ax.bbox); self._draw_artists()
+
+    def _draw_artists(self):
+        for _, li, lo in self.series.values(): self.ax.draw_artist(li); self.ax.draw_artist(lo)
+
+    def _blit(self):
+        if self.bg is None: self.canvas.draw_idle(); return
+        self.canvas.restore_region(self.bg); self._draw_artists(); self.canvas.blit(self.ax.bbox)
+
+# --- ログバス (ワーカー → 画面) ---
+class LogBus:
+    """ワーカーのスレッドから直接積み、GUI側がタイマーでまとめて取り出すキュー
+    件数の集計 (pushed/dropped) は複数スレッドから更新するのでロックの中で行う"""
+    def __init__(self, maxlen=LOG_BUS_MAX):
+        self.q = deque(maxlen=maxlen)
+        self.pushed = self.dropped = self.peak = 0
+        self.lock = threading.Lock()
+
+    def push(self, name, html):
+        with self.lock:
+            if len(self.q) == self.q.maxlen: self.dropped += 1 # 最古の1件が押し出される
+            self.q.append((name, html)); self.pushed += 1
+
+    def push_log(self, name, text, color):
+        self.push(name, f'<span style="color:{color}; white-space:pre-wrap;">{text}</span>')
+
+    def drain(self, limit=LOG_FLUSH_BATCH):
+        with self.lock:
+            n = len(self.q); self.peak = max(self.peak, n)
+            out, pop = [], self.q.popleft
+            for _ in range(min(n, limit)): out.append(pop())
+        return out
+
+    def stats(self):
+        with self.lock: return {'depth': len(self.q), 'peak': self.peak, 'pushed': self.pushed, 'dropped': self.dropped}
+
+def bulk_insert(con, frags, at_start=False):
+    # append() を件数分呼ぶ代わりに、1回の編集ブロックでまとめて挿入する (再レイアウトは1回)。各断片のブロック数を返す
+    doc = con.document(); cur = QTextCursor(doc); cur.movePosition(QTextCursor.Start if at_start else QTextCursor.End); cur.beginEditBlock()
+    counts, empty = [], doc.isEmpty()
+    for f in frags:
+        n0 = doc.blockCount()
+        if at_start:
+            cur.insertHtml(f)
+            if not empty: cur.insertBlock(QTextBlockFormat(), QTextCharFormat())
+        else:
+            if not empty: cur.insertBlock(QTextBlockFormat(), QTextCharFormat())
+            cur.insertHtml(f)
+        counts.append(doc.blockCount() - n0 + (1 if empty else 0)); empty = False
+    cur.endEditBlock()
+    return counts
+
+# --- 画面ログの退避ファイル (ConsoleLog) ---
+class ConsoleLog:
+    """画面ログ1件 (HTML断片) を1レコードとして追記するファイルと、レコード先頭位置の索引"""
+    def __init__(self, path):
+        self.path, self.offs, self.gen = path, array('Q', [0]), 0 # gen: clear() のたびに増える (検索キャッシュの無効化用)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.wf = open(path, "wb"); self.rf = None
+
+    def __len__(self): return len(self.offs) - 1
+
+    def append(self, frags):
+        pos, offs = self.offs[-1], []
+        for f in frags:
+            b = f.encode('utf-8'); self.wf.write(b); pos += len(b); offs.append(pos)
+        self.wf.flush(); self.offs.extend(offs) # 書き出してから索引に載せる (検索スレッドが未書き込み分を読まないように)
+
+    def read(self, i, j, fh=None):
+        """レコード i..j-1 を返す (別スレッドから読む場合は専用のファイルハンドル fh を渡す)"""
+        i, j = max(0, i), min(j, len(self))
+        if i >= j: return []
+        if fh is None:
+            if self.rf is None: self.rf = open(self.path, "rb")
+            fh = self.rf
+        base = self.offs[i]; fh.seek(base); data = fh.read(self.offs[j] - base)
+        return [data[self.offs[k] - base:self.offs[k + 1] - base].decode('utf-8', 'replace') for k in range(i, j)]
+
+    @staticmethod
+    def plain(frag):
+        return html_unescape(re.sub(r"<[^>]+>", "", frag.replace("<br>", "\n")))
+
+    def find(self, text, start=0, chunk=2000):
+        """text を含むレコード番号を start から探す (末尾で先頭へ折り返し)。無ければ -1"""
+        n, t = len(self), text.lower()
+        if not n or not t: return -1
+        start = start if 0 <= start < n else 0
+        for a, b in ((start, n), (0, start)):
+            for c in range(a, b, chunk):
+                for k, f in enumerate(self.read(c, min(c + chunk, b))):
+                    if t in self.plain(f).lower(): return c + k
+        return -1
+
+    def clear(self):
+        self.wf.seek(0); self.wf.truncate(); self.offs = array('Q', [0]); self.gen += 1
+
+    def close(self):
+        for f in (self.wf, self.rf):
+            if f: f.close()
+
+# --- 画面ログの検索索引 (ConsoleSearchIndex) ---
+class ConsoleSearchIndex:
+    """検索語ごとに「一致したレコード番号と件数」を保持し、次回は追記分だけを走査する
+    入力途中で語が伸びた場合は、短い語の一致レコードだけを候補として絞り込む"""
+    def __init__(self, log, keep=8):
+        self.log, self.keep, self.cache, self.gen = log, keep, OrderedDict(), log.gen
+        self.lock, self.fh = threading.Lock(), None
+
+    def _scan(self, ids, t, ent, cancelled, chunk=2000):
+        # ids: 連続区間 (range) またはレコード番号の列
+        if isinstance(ids, range):
+            for c in range(ids.start, ids.stop, chunk):
+                if cancelled(): return False
+                for k, f in enumerate(self.log.read(c, min(c + chunk, ids.stop), self.fh)):
+                    n = ConsoleLog.plain(f).lower().count(t)
+                    if n: ent['recs'].append(c + k); ent['total'] += n
+        else:
+            for k, i in enumerate(ids):
+                if k % chunk == 0 and cancelled(): return False
+                n = ConsoleLog.plain(self.log.read(i, i + 1, self.fh)[0]).lower().count(t)
+                if n: ent['recs'].append(i); ent['total'] += n
+        return True
+
+    def search(self, text, cancelled=lambda: False):
+        """(一致件数, 一致レコード数) を返す。中断された場合は None"""
+        t = text.lower()
+        with self.lock:
+            if self.fh is None: self.fh = open(self.log.path, "rb")
+            if self.gen != self.log.gen: self.cache.clear(); self.gen = self.log.gen
+            n, ent = len(self.log), self.cache.get(t)
+            if ent is None:
+                ent = {'upto': 0, 'recs': array('Q'), 'total': 0}
+                base = max((q for q in self.cache if q in t), key=len, default=None)
+                if base is not None:
+                    b = self.cache[base]
+                    if not self._scan(b['recs'], t, ent, cancelled): return None
+                    ent['upto'] = b['upto']
+            if ent['upto'] < n:
+                if not self._scan(range(ent['upto'], n), t, ent, cancelled): return None
+                ent['upto'] = n
+            self.cache[t] = ent; self.cache.move_to_end(t)
+            while len(self.cache) > self.keep: self.cache.popitem(last=False)
+            return ent['total'], len(ent['recs'])
+
+    def next_hit(self, text, start):
+        """キャッシュ済みの一致レコードから start 以降 (折り返しあり) の最初を返す。未検索なら None"""
+        ent = self.cache.get(text.lower())
+        if ent is None or self.gen != self.log.gen or ent['upto'] < len(self.log): return None
+        recs = ent['recs']
+        if not recs: return -1
+        k = bisect.bisect_left(recs, start)
+        return recs[k] if k < len(recs) else recs[0]
+
+    def close(self):
+        with self.lock:
+            if self.fh: self.fh.close(); self.fh = None
+
+class SearchWorker(QThread):
+    result_signal = Signal(object, str, object) # (対象コンソール, 検索語, (件数, レコード数))
+    def __init__(self, con, text):
+        super().__init__(); self.con, self.text, self._is_cancelled = con, text, False
+    def cancel(self): self._is_cancelled = True
+    def run(self):
+        res = self.con.index.search(self.text, lambda: self._is_cancelled)
+        if res is not None and not self._is_cancelled: self.result_signal.emit(self.con, self.text, res)
 
-    def parse_cisco_hex_dump(self, text):
-        data = bytearray()
-        for line in text.splitlines():
-            parts = line.split()
-            if not parts: continue
-            for p in parts:
-                if re.match(r"^[0-9A-Fa-f]{4}$", p):
-                    try: data.extend(binascii.unhexlify(p))
-                    except: pass
-        return data
-
-    def parse_tcpdump_hex(self, text):
-        data = bytearray()
-        for line in text.splitlines():
-            parts = line.split()
-            for p in parts:
-                if re.match(r"^[0-9A-Fa-f]{4}$", p):
-                     try: data.extend(binascii.unhexlify(p))
-                     except: pass
-        return data
+# --- カスタムTextEdit ---
+class ZoomableTextEdit(QTextEdit):
+    def wheelEvent(self, event: QWheelEvent):
+        if event.modifiers() & Qt.ControlModifier:
+            if event.angleDelta().y() > 0: self.zoomIn(1)
+            else: self.zoomOut(1)
+            event.accept()
+        else: super().wheelEvent(event)
+
+# --- ファイル退避つきコンソール ---
+class DiskConsole(ZoomableTextEdit):
+    """全件は ConsoleLog に書き、画面には [lo, hi) の最大 cap 件だけを置く。端までスクロールすると前後を読み込む"""
+    seq, session_dir = 0, os.path.join(CONSOLE_DIR, f"{os.getpid()}_{datetime.now():%Y%m%d_%H%M%S}")
+    def __init__(self, name, cap=CONSOLE_MAX_RECORDS, parent=None):
+        super().__init__(parent); self.setReadOnly(True)
+        DiskConsole.seq += 1
+        self.log = ConsoleLog(os.path.join(DiskConsole.session_dir, f"{DiskConsole.seq:04d}_{sanitize_filename(name)}.rec"))
+        self.index = ConsoleSearchIndex(self.log)
+        self.cap, self.lo, self.blocks, self._busy = max(cap, CONSOLE_PAGE), 0, deque(), False
+        self.verticalScrollBar().valueChanged.connect(self._on_scroll)
+
+    @property
+    def hi(self): return self.lo + len(self.blocks)
+
+    def append_records(self, frags):
+        """新しいログを追記する。末尾を表示中の場合だけ画面にも反映する"""
+        live = self.hi == len(self.log)
+        self.log.append(frags)
+        if not live: return
+        sb = self.verticalScrollBar(); at_end = sb.value() >= sb.maximum() - 4
+        self._busy = True
+        try:
+            self.blocks.extend(bulk_insert(self, frags))
+            over = len(self.blocks) - self.cap
+            if over > 0: self._drop(over, top=True)
+        finally: self._busy = False
+        if at_end: sb.setValue(sb.maximum())
+
+    def _drop(self, k, top):
+        # 先頭(top) または末尾から k 件分のブロックを画面から外す
+        n = sum(self.blocks.popleft() if top else self.blocks.pop() for _ in range(min(k, len(self.blocks))))
+        doc = self.document(); cur = QTextCursor(doc)
+        if top:
+            if n >= doc.blockCount(): cur.select(QTextCursor.Document)
+            else: cur.setPosition(doc.findBlockByNumber(n).position(), QTextCursor.KeepAnchor)
+            self.lo += k
+        else:
+            keep = doc.blockCount() - n
+            cur.movePosition(QTextCursor.End)
+            if keep <= 0: cur.select(QTextCursor.Document)
+            else: cur.setPosition(doc.findBlockByNumber(keep).position() - 1, QTextCursor.KeepAnchor)
+        cur.removeSelectedText()
+
+    def _on_scroll(self, v):
+        if self._busy: return
+        sb = self.verticalScrollBar()
+        if v == sb.minimum() and self.lo > 0: self._load_older()
+        elif v == sb.maximum() and self.hi < len(self.log): self._load_newer()
+
+    def _load_older(self, count=CONSOLE_PAGE):
+        sb = self.verticalScrollBar(); self._busy = True
+        try:
+            lo = max(0, self.lo - count); recs = self.log.read(lo, self.lo)
+            old_max = sb.maximum()
+            self.blocks.extendleft(reversed(bulk_insert(self, recs, at_start=True))); self.lo = lo
+            over = len(self.blocks) - self.cap
+            if over > 0: self._drop(over, top=False)
+            sb.setValue(sb.value() + sb.maximum() - old_max) # 表示位置を保つ
+        finally: self._busy = False
+
+    def _load_newer(self, count=CONSOLE_PAGE):
+        sb = self.verticalScrollBar(); self._busy = True
+        try:
+            recs = self.log.read(self.hi, self.hi + count)
+            self.blocks.extend(bulk_insert(self, recs))
+            over = len(self.blocks) - self.cap
+            if over > 0:
+                old_max = sb.maximum(); self._drop(over, top=True); sb.setValue(sb.value() - (old_max - sb.maximum()))
+        finally: self._busy = False
+
+    def show_record(self, i):
+        """レコード i を含む範囲を読み込み、その行を表示位置へ移動してカーソルを置く"""
+        if not (self.lo <= i < self.hi):
+            self._busy = True
+            try:
+                super().clear(); self.blocks.clear()
+                self.lo = max(0, min(i - self.cap // 2, len(self.log) - self.cap))
+                self.blocks.extend(bulk_insert(self, self.log.read(self.lo, self.lo + self.cap)))
+            finally: self._busy = False
+        cur = QTextCursor(self.document().findBlockByNumber(sum(list(self.blocks)[:i - self.lo])))
+        self.setTextCursor(cur); self.ensureCursorVisible()
+
+    def find_text(self, text):
+        """F3: 表示中の範囲で次を探し、無ければファイル側で次のレコードを探して読み込む"""
+        if self.find(text): return True
+        cur = self.textCursor(); block_no = cur.blockNumber(); acc, rec = 0, self.lo
+        for n in self.blocks:
+            if acc + n > block_no: break
+            acc += n; rec += 1
+        i = self.index.next_hit(text, rec + 1)
+        if i is None: i = self.log.find(text, rec + 1)
+        if i < 0: return False
+        self.show_record(i); return self.find(text)
+
+    def clear(self):
+        super().clear(); self.log.clear(); self.blocks.clear(); self.lo = 0
+
+    def close_log(self):
+        self.index.close(); self.log.close()
+
+def highlight_visible(con, text):
+    # 表示範囲のブロックだけを対象に一致箇所を強調する (スクロールのたびに再計算)
+    if not text: con.setExtraSelections([]); return
+    vp = con.viewport(); doc = con.document()
+    first, last = con.cursorForPosition(vp.rect().topLeft()).block(), con.cursorForPosition(vp.rect().bottomRight()).block()
+    end = last.position() + last.length()
+    extra, cursor = [], QTextCursor(doc); cursor.setPosition(first.position())
+    while True:
+        cursor = doc.find(text, cursor)
+        if cursor.isNull() or cursor.selectionStart() >= end: break
+        sel = QTextEdit.ExtraSelection(); sel.format.setBackground(QColor(144, 238, 144, 150)); sel.format.setForeground(Qt.black); sel.cursor = cursor; extra.append(sel)
+    con.setExtraSelections(extra)
+
+# --- 機器一覧 (モデル/ビュー) ---
+def host_tags(h):
+    # タグ列 ("tags" / "tag"、カンマや空白区切り)
+    v = h.get('tags', h.get('tag'))
+    return " ".join(str(x) for x in v) if isinstance(v, (list, tuple)) else str(v or "")
+
+class HostTableModel(QAbstractTableModel):
+    """機器一覧のモデル。チェック状態は「既定値 + 既定値と逆になっている機器の集合」で持つため、全選択/解除は台数によらず一定時間
+    行の並び (ソート) は order、各機器は hosts の添字で表す"""
+    FIELDS = [("ホスト名", "name"), ("IPアドレス", "ip"), ("ベンダー", "vendor"), ("サイト", "site"), ("タグ", "tags")]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.hosts, self.order, self.fields, self.vals, self.low = [], [], [], [], []
+        self.default, self.flipped = True, set()
+
+    def set_hosts(self, hosts):
+        self.beginResetModel()
+        self.hosts, self.order, self.default, self.flipped = hosts, list(range(len(hosts))), True, set()
+        # タグ列はインベントリにタグがあるときだけ出す
+        self.fields = [f for f in self.FIELDS if f[1] != "tags" or any(host_tags(h) for h in hosts)]
+        self.vals = [tuple(host_tags(h) if k == "tags" else str(h.get(k) or "") for _, k in self.fields) for h in hosts]
+        self.low = [tuple(v.lower() for v in row) for row in self.vals] # 絞り込み用
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()): return 0 if parent.isValid() else len(self.order)
+    def columnCount(self, parent=QModelIndex()): return 0 if parent.isValid() else len(self.fields) + 1
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole: return "選択" if section == 0 else self.fields[section - 1][0]
+        return None
 
+    def flags(self, index):
+        f = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        return f | Qt.ItemIsUserCheckable if index.column() == 0 else f
+
+    def data(self, index, role=Qt.DisplayRole):
+        h, c = self.order[index.row()], index.column()
+        if c == 0: return (Qt.Checked if self.is_checked(h) else Qt.Unchecked) if role == Qt.CheckStateRole else None
+        return self.vals[h][c - 1] if role in (Qt.DisplayRole, Qt.ToolTipRole) else None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if index.column() != 0 or role != Qt.CheckStateRole: return False
+        self.set_checked([self.order[index.row()]], Qt.CheckState(value) == Qt.Checked); return True
+
+    def is_checked(self, h): return self.default != (h in self.flipped)
+
+    def set_checked(self, hs, state):
+        """機器 (hosts の添字) のチェックをまとめて変える"""
+        for h in hs:
+            if state == self.default: self.flipped.discard(h)
+            else: self.flipped.add(h)
+        self._check_changed()
+
+    def check_all(self, state):
+        self.default = state; self.flipped = set(); self._check_changed()
+
+    def _check_changed(self):
+        if self.order: self.dataChanged.emit(self.index(0, 0), self.index(len(self.order) - 1, 0), [Qt.CheckStateRole])
+
+    def checked_count(self): return len(self.hosts) - len(self.flipped) if self.default else len(self.flipped)
+
+    def checked_hosts(self):
+        """チェックした機器 (インベントリの並び順)"""
+        if not self.default: return [self.hosts[h] for h in sorted(self.flipped)]
+        return [h for i, h in enumerate(self.hosts) if i not in self.flipped]
+
+    def matches(self, row, terms):
+        # terms = [(列番号 or None, 文字列)] をすべて含むか。列番号 None はどの列でもよい
+        low = self.low[self.order[row]]
+        return all(any(t in v for v in low) if c is None else t in low[c] for c, t in terms)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column < 0 or not self.hosts: return
+        if column == 0: key = lambda h: not self.is_checked(h)
+        elif self.fields[column - 1][1] == "ip":
+            def key(h):
+                try: return (0, ip_to_int(self.vals[h][column - 1]))
+                except ValueError: return (1, self.vals[h][column - 1])
+        else: key = lambda h: self.low[h][column - 1]
+        self.layoutAboutToBeChanged.emit()
+        old = self.persistentIndexList(); moved = [self.order[i.row()] for i in old]
+        self.order.sort(key=key, reverse=order == Qt.DescendingOrder)
+        pos = {h: r for r, h in enumerate(self.order)}
+        self.changePersistentIndexList(old, [self.index(pos[h], i.column()) for h, i in zip(moved, old)])
+        self.layoutChanged.emit()
+
+class HostFilterProxy(QSortFilterProxyModel):
+    """機器一覧の絞り込み。"cisco 東京" はどの列でも、"vendor:cisco site:東京 tag:core" は列を指定して部分一致 (すべて AND)
+    並べ替えはモデル側で行う (行ごとの比較を Qt から呼ばない)"""
+    KEYS = {"name": "name", "host": "name", "ip": "ip", "vendor": "vendor", "site": "site", "tag": "tags", "tags": "tags"}
+
+    def __init__(self, parent=None):
+        super().__init__(parent); self.terms = []
+
+    def set_filter(self, text):
+        src = self.sourceModel(); cols = {k: n for n, (_, k) in enumerate(src.fields)}; self.terms = []
+        for tok in text.lower().split():
+            key, sep, val = tok.partition(":")
+            if sep and key in self.KEYS and val:
+                if self.KEYS[key] not in cols: self.terms.append((None, "\0")); continue # 無い列を指定したら一致なし
+                self.terms.append((cols[self.KEYS[key]], val))
+            else: self.terms.append((None, tok))
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, row, parent):
+        return not self.terms or self.sourceModel().matches(row, self.terms)
+
+    def sort(self, column, order=Qt.AscendingOrder): self.sourceModel().sort(column, order)
+
+    def visible_hosts(self):
+        """表示中の行の機器 (hosts の添字)"""
+        src = self.sourceModel()
+        return [src.order[self.mapToSource(self.index(r, 0)).row()] for r in range(self.rowCount())]
 
 # --- GUI ---
 class NetVerifyGUI(QMainWindow):
     def __init__(self):
         super().__init__(); self.setWindowTitle("NetVerify Pro - Professional Final Edition"); self.resize(1550, 950)
-        self.hosts_data, self.active_workers, self.current_report_html, self.host_consoles, self.full_mesh_matrix = [], [], [], {}, {}
-        self.ghost_x, self.ghost_in, self.ghost_out = [], [], []
-        self.canvas = None
+        self.hosts_data, self.active_workers, self.report, self.host_consoles, self.full_mesh_matrix = [], [], ReportSpool(), {}, {}
+        self.monitor = None # モード7のグラフ (TrafficMonitorPlot)
         self.teraterm_path = None 
+        self.scheduler = None # モード0-5の同時実行制御
+        self.log_bus = LogBus() # ワーカーのログはここへ積み、タイマーでまとめて画面へ反映する
         
         self.setup_ui(); self.load_excel(); self.setup_shortcuts()
+        # アイドルセッションの定期切断 (切断処理で画面を止めないよう別スレッドで)
+        self.pool_timer = QTimer(self); self.pool_timer.timeout.connect(lambda: threading.Thread(target=SESSION_POOL.reap, daemon=True).start()); self.pool_timer.start(60_000)
+        self.log_timer = QTimer(self); self.log_timer.timeout.connect(self.flush_logs); self.log_timer.start(LOG_FLUSH_MS)
+        self.mon_timer = QTimer(self); self.mon_timer.timeout.connect(lambda: self.monitor and self.monitor.refresh())
+        # 異常終了などで残った古い画面ログ退避フォルダ・レポート断片 (1日以上前) を片付ける
+        for root in (CONSOLE_DIR, REPORT_SPOOL_DIR):
+            for d in (os.listdir(root) if os.path.isdir(root) else []):
+                p = os.path.join(root, d)
+                if p != DiskConsole.session_dir and time.time() - os.path.getmtime(p) > 86400: shutil.rmtree(p, ignore_errors=True)
+
+    def closeEvent(self, event):
+        SESSION_POOL.close_all()
+        for con in [self.global_console, *self.host_consoles.values()]:
+            if isinstance(con, DiskConsole): con.close_log()
+        shutil.rmtree(DiskConsole.session_dir, ignore_errors=True); self.report.close()
+        super().closeEvent(event)
 
     def setup_ui(self):
         cw = QWidget(); self.setCentralWidget(cw); main_layout = QHBoxLayout(cw); left_panel = QVBoxLayout()
         g_hosts = QGroupBox("機器選択"); ghl = QVBoxLayout(); g_hosts.setLayout(ghl)
-        self.btn_all = QPushButton("全選択/解除"); self.btn_all.setFixedHeight(35); self.btn_all.clicked.connect(self.toggle_all)
-        ghl.addWidget(self.btn_all); self.table = QTableWidget(0, 3)
-        self.table.setHorizontalHeaderLabels(["選択", "ホスト名", "IPアドレス"]); self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        ghl.addWidget(self.table); left_panel.addWidget(g_hosts); main_layout.addLayout(left_panel, 1)
+        self.btn_all = QPushButton("全選択/解除"); self.btn_all.setFixedHeight(35); self.btn_all.setToolTip("絞り込み中は表示中の機器だけ"); self.btn_all.clicked.connect(self.toggle_all)
+        self.host_filter = QLineEdit(); self.host_filter.setPlaceholderText("絞り込み (例: cisco  vendor:juniper  site:東京  tag:core)"); self.host_filter.setFixedHeight(30)
+        self.host_filter_timer = QTimer(self); self.host_filter_timer.setSingleShot(True); self.host_filter_timer.setInterval(200)
+        self.host_filter_timer.timeout.connect(lambda: (self.host_proxy.set_filter(self.host_filter.text()), self.update_host_count())); self.host_filter.textChanged.connect(self.host_filter_timer.start)
+        self.host_model = HostTableModel(self); self.host_proxy = HostFilterProxy(self); self.host_proxy.setSourceModel(self.host_model)
+        self.table = QTableView(); self.table.setModel(self.host_proxy); self.table.setSortingEnabled(True); self.table.sortByColumn(-1, Qt.AscendingOrder)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows); self.table.verticalHeader().setVisible(False); self.table.verticalHeader().setDefaultSectionSize(24)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive); self.table.horizontalHeader().setStretchLastSection(True); self.table.setColumnWidth(0, 48)
+        self.table.setContextMenuPolicy(Qt.ActionsContextMenu)
+        for text, state in (("選択行をチェック", True), ("選択行のチェックを外す", False)):
+            act = QAction(text, self.table); act.triggered.connect(lambda _=False, s=state: self.check_selected_rows(s)); self.table.addAction(act)
+        self.host_model.dataChanged.connect(lambda *_: self.update_host_count())
+        self.lbl_hosts = QLabel(""); self.lbl_hosts.setStyleSheet("color:#AAAAAA;")
+        ghl.addWidget(self.btn_all); ghl.addWidget(self.host_filter); ghl.addWidget(self.table); ghl.addWidget(self.lbl_hosts); left_panel.addWidget(g_hosts); main_layout.addLayout(left_panel, 1)
 
         right_panel = QVBoxLayout(); g_cfg = QGroupBox("実行コントロール"); gcl = QHBoxLayout(); g_cfg.setLayout(gcl)
         self.combo = QComboBox(); self.combo.setMinimumWidth(180); self.combo.setFixedHeight(35)
         
         # === モード ===
-        self.combo.addItems([
-            "0: Ping", "0t: Trace", "1: Login", "2: ログ取得", "3: 解析・比較", "4: ログ+比較", 
-            "5: フルメッシュPing", "6: 自動診断 (Auto-Tshoot)", "7: 帯域モニター",
-            "8: トポロジー自動描画 (Crawler)", "9: 仮想ワイヤータップ"
-        ])
+        self.combo.addItems(MODES)
         
         self.combo.currentIndexChanged.connect(self.on_mode_changed)
         self.search_input = QLineEdit(); self.search_input.setPlaceholderText("ログから検索 (F3で次へ)..."); self.search_input.setFixedHeight(35); self.search_input.setStyleSheet("background:#333; color:white; border: 1px solid #555; padding-left:10px;")
-        self.search_input.textChanged.connect(self.search_all_highlight); self.search_input.returnPressed.connect(self.find_next_match)
+        self.search_timer = QTimer(self); self.search_timer.setSingleShot(True); self.search_timer.setInterval(SEARCH_DEBOUNCE_MS); self.search_timer.timeout.connect(self.search_all_highlight)
+        self.search_input.textChanged.connect(self.search_timer.start); self.search_input.returnPressed.connect(self.find_next_match)
+        self.lbl_search = QLabel(""); self.lbl_search.setMinimumWidth(90); self.lbl_search.setStyleSheet("color:#AAAAAA;")
+        self.search_worker, self.search_threads = None, set() # 中断したスレッドも終了までは参照を保持する
         
         btn_style = "QPushButton {{ font-weight: bold; font-size: 10pt; border-radius: 4px; color: white; background-color: {0}; }}"
         self.btn_run = QPushButton(" 実行開始 "); self.btn_run.setFixedSize(110, 40); self.btn_run.setStyleSheet(btn_style.format("#1a4d1a")); self.btn_run.clicked.connect(self.run_process)
         self.btn_cancel = QPushButton("キャンセル"); self.btn_cancel.setFixedSize(110, 40); self.btn_cancel.setEnabled(False); self.btn_cancel.setStyleSheet(btn_style.format("#4d1a1a")); self.btn_cancel.clicked.connect(self.stop_workers)
         self.btn_report = QPushButton("レポート保存"); self.btn_report.setFixedSize(110, 40); self.btn_report.setEnabled(False); self.btn_report.setStyleSheet(btn_style.format("#004d4d")); self.btn_report.clicked.connect(self.save_report)
         self.btn_clear = QPushButton("ログクリア"); self.btn_clear.setFixedSize(110, 40); self.btn_clear.setStyleSheet(btn_style.format("#333") + "border: 1px solid #666;"); self.btn_clear.clicked.connect(self.reset_all_logs_and_tabs)
+        self.spin_parallel = QSpinBox(); self.spin_parallel.setRange(1, 256); self.spin_parallel.setValue(MAX_PARALLEL_DEVICES); self.spin_parallel.setFixedHeight(35); self.spin_parallel.setToolTip("モード0-5で同時に接続する機器数の上限")
         
-        gcl.addWidget(QLabel("モード:")); gcl.addWidget(self.combo); gcl.addSpacing(10); gcl.addWidget(self.search_input); gcl.addSpacing(10); gcl.addWidget(self.btn_run); gcl.addWidget(self.btn_cancel); gcl.addWidget(self.btn_report); gcl.addWidget(self.btn_clear); right_panel.addWidget(g_cfg)
+        gcl.addWidget(QLabel("モード:")); gcl.addWidget(self.combo); gcl.addSpacing(10); gcl.addWidget(self.search_input); gcl.addWidget(self.lbl_search); gcl.addSpacing(10); gcl.addWidget(QLabel("同時接続:")); gcl.addWidget(self.spin_parallel); gcl.addSpacing(10); gcl.addWidget(self.btn_run); gcl.addWidget(self.btn_cancel); gcl.addWidget(self.btn_report); gcl.addWidget(self.btn_clear); right_panel.addWidget(g_cfg)
 
         option_layout = QHBoxLayout(); self.chk_show_log = QCheckBox("取得内容を画面に表示する"); self.chk_show_log.setVisible(False); self.chk_show_log.setChecked(True)
         self.chk_keyword_scan = QCheckBox("search.txt のキーワードを検知する"); self.chk_keyword_scan.setVisible(False); self.chk_keyword_scan.setChecked(True)
         self.chk_compare_master = QCheckBox("Masterと比較する"); self.chk_compare_master.setVisible(False); self.chk_compare_master.setStyleSheet("color: white; font-weight: bold;")
         self.chk_save_master = QCheckBox("Masterとして保存（更新）する"); self.chk_save_master.setVisible(False); self.chk_save_master.setStyleSheet("color: white; font-weight: bold;")
-        option_layout.addWidget(self.chk_show_log); option_layout.addWidget(self.chk_keyword_scan); option_layout.addWidget(self.chk_compare_master); option_layout.addWidget(self.chk_save_master); option_layout.addStretch(); right_panel.addLayout(option_layout)
+        self.lbl_progress = QLabel(""); self.lbl_progress.setStyleSheet("color:#00AAFF; font-family:Consolas, monospace;")
+        self.lbl_logbus = QLabel(""); self.lbl_logbus.setStyleSheet("color:#888888; font-family:Consolas, monospace;") # ログ反映待ち/破棄件数
+        self.btn_history = QPushButton("帯域履歴を表示"); self.btn_history.setVisible(False); self.btn_history.clicked.connect(self.show_traffic_history)
+        self.chk_offline_diag = QCheckBox("収集済みのルーティングテーブルで診断する (オフライン)"); self.chk_offline_diag.setVisible(False); self.chk_offline_diag.setStyleSheet("color: white; font-weight: bold;")
+        option_layout.addWidget(self.chk_show_log); option_layout.addWidget(self.chk_keyword_scan); option_layout.addWidget(self.btn_history); option_layout.addWidget(self.chk_offline_diag); option_layout.addWidget(self.chk_compare_master); option_layout.addWidget(self.chk_save_master); option_layout.addStretch(); option_layout.addWidget(self.lbl_progress); option_layout.addWidget(self.lbl_logbus); right_panel.addLayout(option_layout)
         
-        self.tabs = QTabWidget(); self.tabs.setTabsClosable(True); self.tabs.tabCloseRequested.connect(lambda i: self.tabs.removeTab(i) if i != 0 else None)
-        self.global_console = ZoomableTextEdit(); self.global_console.setReadOnly(True); self.global_console.setStyleSheet("background-color:#1E1E1E; color:#FFFFFF; font-family:Consolas, monospace; border:2px solid #333;")
+        self.tabs = QTabWidget(); self.tabs.currentChanged.connect(lambda _: self.search_input.text() and self.search_timer.start()); self.tabs.setTabsClosable(True); self.tabs.tabCloseRequested.connect(lambda i: self.tabs.removeTab(i) if i != 0 else None)
+        self.global_console = DiskConsole("GLOBAL"); self.global_console.setStyleSheet("background-color:#1E1E1E; color:#FFFFFF; font-family:Consolas, monospace; border:2px solid #333;")
         self.tabs.addTab(self.global_console, "全体ログ"); right_panel.addWidget(self.tabs); main_layout.addLayout(right_panel, 4)
 
     def setup_shortcuts(self):
         QShortcut(QKeySequence("F3"), self).activated.connect(self.find_next_match); QShortcut(QKeySequence("Ctrl+F"), self).activated.connect(self.search_input.setFocus)
 
     def search_all_highlight(self):
+        # 入力が止まってから呼ばれる。件数は別スレッドで索引から数え、強調は表示範囲のみ
         text = self.search_input.text(); cur = self.tabs.currentWidget()
-        if not isinstance(cur, ZoomableTextEdit): return
-        if not text: cur.setExtraSelections([]); return
-        extra = []; doc = cur.document(); cursor = QTextCursor(doc)
-        while True:
-            cursor = doc.find(text, cursor)
-            if cursor.isNull(): break
-            sel = QTextEdit.ExtraSelection(); sel.format.setBackground(QColor(144, 238, 144, 150)); sel.format.setForeground(Qt.black); sel.cursor = cursor; extra.append(sel)
-        cur.setExtraSelections(extra)
+        if self.search_worker: self.search_worker.cancel(); self.search_worker = None
+        if not isinstance(cur, ZoomableTextEdit): self.lbl_search.setText(""); return
+        if cur.property("search_hooked") is None: # スクロールしたら表示範囲を強調し直す
+            cur.verticalScrollBar().valueChanged.connect(lambda _, c=cur: c is self.tabs.currentWidget() and highlight_visible(c, self.search_input.text()))
+            cur.setProperty("search_hooked", True)
+        highlight_visible(cur, text)
+        if not text: self.lbl_search.setText(""); return
+        if isinstance(cur, DiskConsole):
+            self.lbl_search.setText("検索中...")
+            w = self.search_worker = SearchWorker(cur, text)
+            self.search_threads.add(w); w.result_signal.connect(self.on_search_result); w.finished.connect(lambda w=w: self.search_threads.discard(w)); w.start()
+        else: self.lbl_search.setText(f"{cur.toPlainText().lower().count(text.lower())} 件")
+
+    def on_search_result(self, con, text, res):
+        if con is not self.tabs.currentWidget() or text != self.search_input.text(): return
+        total, recs = res
+        self.lbl_search.setText(f"{total} 件" if total else "一致なし")
 
     def find_next_match(self):
         text = self.search_input.text(); cur = self.tabs.currentWidget()
         if not isinstance(cur, ZoomableTextEdit) or not text: return
+        if isinstance(cur, DiskConsole): cur.find_text(text); return
         if not cur.find(text): cur.moveCursor(QTextCursor.Start); cur.find(text)
 
     def on_mode_changed(self, index):
@@ -1032,22 +3654,27 @@ class NetVerifyGUI(QMainWindow):
         is_master_mode = "3:" in mode or "4:" in mode
         self.chk_compare_master.setVisible(is_master_mode)
         self.chk_save_master.setVisible(is_master_mode)
+        self.btn_history.setVisible("7:" in mode)
+        self.chk_offline_diag.setVisible("6:" in mode)
 
     def load_excel(self):
-        xlsx_path = os.path.join(BASE_DIR, "inventory.xlsx")
-        if not os.path.exists(xlsx_path): return
-        wb = openpyxl.load_workbook(xlsx_path, data_only=True); ws = wb.active; headers = [str(c.value).strip().lower() if c.value else "" for c in ws[1]]
-        for i, row in enumerate(ws.iter_rows(min_row=2, values_only=True)):
-            if not row or row[0] is None: continue
-            h = {headers[j]: row[j] for j, n in enumerate(headers) if n and j < len(row)}
-            h['en_pw'] = row[6] if len(row)>6 else ""; h['command_list'] = [c.strip() for c in str(row[7]).split('\n') if c.strip()] if len(row)>7 else []
-            self.hosts_data.append(h); self.table.insertRow(i); chk = QCheckBox(); chk.setChecked(True); w = QWidget(); l = QHBoxLayout(w); l.addWidget(chk); l.setAlignment(Qt.AlignCenter); l.setContentsMargins(0,0,0,0)
-            self.table.setCellWidget(i, 0, w); self.table.setItem(i, 1, QTableWidgetItem(str(h.get('name','')))); self.table.setItem(i, 2, QTableWidgetItem(str(h.get('ip',''))))
+        self.hosts_data = load_inventory()
+        self.host_model.set_hosts(self.hosts_data); self.host_proxy.set_filter(self.host_filter.text()); self.update_host_count()
 
     def toggle_all(self):
-        if self.table.rowCount() == 0: return
-        cur = self.table.cellWidget(0,0).layout().itemAt(0).widget().isChecked()
-        for i in range(self.table.rowCount()): self.table.cellWidget(i,0).layout().itemAt(0).widget().setChecked(not cur)
+        # 先頭行の逆にそろえる。絞り込み中は表示中の機器だけ
+        if self.host_proxy.rowCount() == 0: return
+        cur = self.host_proxy.index(0, 0).data(Qt.CheckStateRole) == Qt.Checked
+        if self.host_proxy.terms: self.host_model.set_checked(self.host_proxy.visible_hosts(), not cur)
+        else: self.host_model.check_all(not cur)
+
+    def check_selected_rows(self, state):
+        rows = {self.host_proxy.mapToSource(i).row() for i in self.table.selectionModel().selectedRows()}
+        self.host_model.set_checked([self.host_model.order[r] for r in rows], state)
+
+    def update_host_count(self):
+        m = self.host_model
+        self.lbl_hosts.setText(f"チェック: {m.checked_count()} / {len(m.hosts)}台" + (f"  (表示 {self.host_proxy.rowCount()}台)" if self.host_proxy.terms else ""))
 
     def reset_all_logs_and_tabs(self):
         self.global_console.clear()
@@ -1055,13 +3682,13 @@ class NetVerifyGUI(QMainWindow):
             if isinstance(widget, QTextEdit): widget.clear()
 
     def run_process(self):
-        selected = [self.hosts_data[i] for i in range(self.table.rowCount()) if self.table.cellWidget(i,0).layout().itemAt(0).widget().isChecked()]
+        selected = self.host_model.checked_hosts()
         if not selected: return
         mode = self.combo.currentText()
         
         # Helper to set up common worker connections
         def start_worker(worker_obj):
-            worker_obj.log_signal.connect(self.append_log)
+            worker_obj.log_signal.connect(self.log_bus.push_log, Qt.DirectConnection) # GUIスレッドを経由せずワーカー側で積む
             worker_obj.finished_signal.connect(self.on_worker_finished) # Data processing
             worker_obj.finished.connect(self.on_thread_finished) # Thread lifecycle & button reset
             self.active_workers.append(worker_obj)
@@ -1074,37 +3701,32 @@ class NetVerifyGUI(QMainWindow):
             if not ok or not target_ip: return
             
             self.btn_run.setEnabled(False); self.btn_cancel.setEnabled(True)
-            worker = DiagnosticWorker(selected[0], target_ip, self.hosts_data)
+            worker = DiagnosticWorker(selected[0], target_ip, self.hosts_data, RouteSimulator(self.hosts_data) if self.chk_offline_diag.isChecked() else None)
             worker.path_data_signal.connect(self.visualize_path) # 経路図描画シグナル
             start_worker(worker); return
 
-        # === モード7: 帯域モニター ===
+        # === モード7: 帯域モニター (複数機器・複数IF) ===
         if "7:" in mode:
-            if len(selected) != 1: return QMessageBox.warning(self, "エラー", "帯域モニターは1台のみ選択してください。")
-            host = selected[0]
-            try:
-                # 簡易的なIF一覧取得
-                dev = {'device_type': str(host.get('vendor','cisco')), 'host': host['ip'], 'username': host['user'], 'password': host['pw'], 'secret': host['en_pw']}
-                with ConnectHandler(**dev) as net:
-                    if ">" in net.find_prompt(): net.enable()
-                    cmd = "show ip int brief"
-                    if "juniper" in dev['device_type']: cmd = "show interfaces terse"
-                    elif "huawei" in dev['device_type']: cmd = "display interface brief"
-                    elif "hp" in dev['device_type'] or "aruba" in dev['device_type']: cmd = "show ip interface brief"
-                    elif "arista" in dev['device_type']: cmd = "show ip interface brief"
-                    elif "nec" in dev['device_type']: cmd = "show ip interface brief"
-                    elif "allied" in dev['device_type']: cmd = "show ip interface brief"
-
-                    res = net.send_command(cmd)
-                ifaces = [l.split()[0] for l in res.splitlines() if l and not l.startswith(('Int', 'Name', ' ', 'PHY', 'Interface'))]
-                iface, ok = QInputDialog.getItem(self, "IF選択", f"【{host['name']}】監視対象:", ifaces, 0, False)
-                if not ok: return
-            except Exception as e: return QMessageBox.critical(self, "エラー", f"接続失敗: {str(e)}")
-
-            self.btn_run.setEnabled(False); self.btn_cancel.setEnabled(True); self.setup_ghost_tab(host['name'], iface)
-            worker = TrafficGhostWorker(host, iface)
-            worker.update_signal.connect(self.update_ghost_graph)
-            start_worker(worker); return
+            if len(selected) > MONITOR_MAX_DEVICES: return QMessageBox.warning(self, "エラー", f"帯域モニターは最大{MONITOR_MAX_DEVICES}台まで選択できます。")
+            # IF一覧は機器ごとに並行して取得
+            choices, errors = {}, []
+            with ThreadPoolExecutor(max_workers=min(len(selected), MAX_PARALLEL_DEVICES)) as ex:
+                futs = {ex.submit(list_interfaces, h): h['name'] for h in selected}
+                for f in as_completed(futs):
+                    try: choices[futs[f]] = f.result()
+                    except Exception as e: errors.append(f"{futs[f]}: {e}")
+            if not choices: return QMessageBox.critical(self, "エラー", "接続失敗:\n" + "\n".join(errors))
+            for e in errors: self.append_log("GLOBAL", f"[!] IF一覧取得失敗 {e}", "#FF5555")
+            picked = self.select_interfaces({h['name']: choices[h['name']] for h in selected if h['name'] in choices})
+            if not picked: return
+
+            self.btn_run.setEnabled(False); self.btn_cancel.setEnabled(True); self.setup_ghost_tab(picked)
+            for host in selected:
+                if host['name'] not in picked: continue
+                worker = TrafficGhostWorker(host, picked[host['name']])
+                worker.update_signal.connect(self.update_ghost_graph)
+                start_worker(worker)
+            return
 
         # === モード8: Crawler ===
         if "8:" in mode:
@@ -1114,39 +3736,25 @@ class NetVerifyGUI(QMainWindow):
             self.btn_run.setEnabled(False); self.btn_cancel.setEnabled(True)
             worker = CrawlerWorker(selected[0], self.hosts_data)
             worker.html_ready_signal.connect(self.open_topology_html)
+            worker.edge_signal.connect(lambda a, b, label, w=worker: self.lbl_progress.setText(f"発見: {w.G.number_of_nodes()}台  リンク: {w.G.number_of_edges()}"))
             start_worker(worker); return
 
-        # === モード9: Virtual Wiretap ===
+        # === モード9: Virtual Wiretap (複数機器を同時にキャプチャ) ===
         if "9:" in mode:
-            if len(selected) != 1: return QMessageBox.warning(self, "エラー", "Wiretap対象の機器を1台選択してください。")
-            host = selected[0]
-            
-            # --- インターフェース一覧を取得して選択させる ---
-            try:
-                dev = {'device_type': str(host.get('vendor','cisco')), 'host': host['ip'], 'username': host['user'], 'password': host['pw'], 'secret': host['en_pw']}
-                with ConnectHandler(**dev) as net:
-                    if ">" in net.find_prompt(): net.enable()
-                    cmd = "show ip int brief"
-                    if "juniper" in dev['device_type']: cmd = "show interfaces terse"
-                    elif "huawei" in dev['device_type']: cmd = "display interface brief"
-                    elif "linux" in dev['device_type']: cmd = "ip link show"
-                    elif "hp" in dev['device_type'] or "aruba" in dev['device_type']: cmd = "show ip interface brief"
-                    elif "arista" in dev['device_type']: cmd = "show ip interface brief"
-                    
-                    res = net.send_command(cmd)
-                
-                # パース
-                ifaces = []
-                for l in res.splitlines():
-                    if "linux" in dev['device_type']:
-                        m = re.match(r"\d+: ([^:@]+)", l)
-                        if m: ifaces.append(m.group(1))
-                    elif l and not l.startswith(('Int', 'Name', ' ', 'PHY', 'Interface')):
-                        ifaces.append(l.split()[0])
-                        
-                iface, ok = QInputDialog.getItem(self, "Wiretap設定", f"【{host['name']}】キャプチャ対象:", ifaces, 0, False)
-                if not ok: return
-            except Exception as e: return QMessageBox.critical(self, "エラー", f"接続失敗: {str(e)}")
+            if len(selected) > WIRETAP_MAX_DEVICES: return QMessageBox.warning(self, "エラー", f"Wiretapは最大{WIRETAP_MAX_DEVICES}台まで選択できます。")
+            # --- インターフェース一覧を機器ごとに並行して取得して選択させる ---
+            choices, errors = {}, []
+            with ThreadPoolExecutor(max_workers=min(len(selected), MAX_PARALLEL_DEVICES)) as ex:
+                futs = {ex.submit(list_interfaces, h): h['name'] for h in selected}
+                for f in as_completed(futs):
+                    try: choices[futs[f]] = f.result()
+                    except Exception as e: errors.append(f"{futs[f]}: {e}")
+            if not choices: return QMessageBox.critical(self, "エラー", "接続失敗:\n" + "\n".join(errors))
+            for e in errors: self.append_log("GLOBAL", f"[!] IF一覧取得失敗 {e}", "#FF5555")
+            picked = self.select_interfaces({h['name']: choices[h['name']] for h in selected if h['name'] in choices}, note="チェックした IF (未チェックなら選択行) をキャプチャします。1台につき1つ (複数選んだ場合は先頭)")
+            if not picked: return
+            for n, ifs in picked.items():
+                if len(ifs) > 1: self.append_log("GLOBAL", f"[!] {n}: {ifs[0]} のみキャプチャします", "#FFA500")
             # ------------------------------------------------------------------
 
             p_filter, ok = QInputDialog.getText(self, "Wiretap設定", "フィルタ (例: ip host 1.1.1.1):")
@@ -1155,18 +3763,16 @@ class NetVerifyGUI(QMainWindow):
             if not ok: return
             
             self.btn_run.setEnabled(False); self.btn_cancel.setEnabled(True)
-            worker = WiretapWorker(host, iface, p_filter, duration)
+            worker = WiretapWorker([(h, picked[h['name']][0]) for h in selected if h['name'] in picked], p_filter, duration)
             start_worker(worker); return
 
         # === 通常モード (0-5) ===
         self.btn_run.setEnabled(False); self.btn_cancel.setEnabled(True); self.btn_report.setEnabled(False)
-        self.current_report_html = []
+        self.report.close() # 前回分の断片を消す
         self.active_workers = []
         self.full_mesh_matrix = {}
 
-        if os.path.exists(SEARCH_FILE):
-            with open(SEARCH_FILE, "r", encoding='utf-8-sig') as f: self.search_keywords = [l.strip() for l in f if l.strip()]
-        else: self.search_keywords = []
+        self.keyword_scanner = KeywordScanner(load_search_keywords()) # 実行ごとに1回だけ構築し全ワーカーで共有
         
         for host in selected:
             name = host['name']
@@ -1174,77 +3780,119 @@ class NetVerifyGUI(QMainWindow):
                 con = self.host_consoles[name]
                 if self.tabs.indexOf(con) == -1: self.tabs.addTab(con, name)
             else:
-                con = ZoomableTextEdit(); con.setReadOnly(True)
+                con = DiskConsole(name)
                 con.setStyleSheet("background-color:#1E1E1E; color:#FFFFFF; font-family:Consolas, monospace;")
                 self.host_consoles[name] = con; self.tabs.addTab(con, name)
 
-            worker = NetworkWorker(self.combo.currentText(), host, self.chk_show_log.isChecked(), self.chk_keyword_scan.isChecked(), self.search_keywords, selected, self.chk_compare_master.isChecked(), self.chk_save_master.isChecked(), self.teraterm_path)
-            worker.log_signal.connect(self.append_log); worker.html_signal.connect(self.append_html); worker.finished_signal.connect(self.on_worker_finished); 
+        # 全台を一斉に起動せず、スケジューラが上限内で順次起動する (完了した枠はすぐ次の機器へ)
+        opts = (self.chk_show_log.isChecked(), self.chk_keyword_scan.isChecked(), self.keyword_scanner, selected, self.chk_compare_master.isChecked(), self.chk_save_master.isChecked(), self.teraterm_path, self.report)
+        def launch(host):
+            worker = NetworkWorker(mode, host, *opts)
+            worker.log_signal.connect(self.log_bus.push_log, Qt.DirectConnection); worker.html_signal.connect(self.log_bus.push, Qt.DirectConnection); worker.finished_signal.connect(self.on_worker_finished); 
+            worker.finished.connect(lambda w=worker: sched.release(w, w.error is not None)) # 枠の解放を先に行う
             worker.finished.connect(self.on_thread_finished) # Thread lifecycle
             worker.request_teraterm_path.connect(self.ask_teraterm_path)
             self.active_workers.append(worker); worker.start()
-
-    def setup_ghost_tab(self, name, iface):
-        t_title = f"MON: {name}"
+            return worker
+        sched = self.scheduler = DeviceScheduler(launch, self.spin_parallel.value(), on_progress=self.update_progress)
+        sched.submit(selected)
+
+    def update_progress(self, p):
+        self.lbl_progress.setText(f"進捗: {p['done']}/{p['total']}  実行中: {p['running']}  待機: {p['queued']}  失敗: {p['failed']}")
+
+    def select_interfaces(self, choices, note=None):
+        """choices = {機器名: [IF...]} から監視対象を複数選択する。戻り値 {機器名: [IF...]}"""
+        dlg = QDialog(self); dlg.setWindowTitle("IF選択 (複数可)"); dlg.resize(520, 620); lay = QVBoxLayout(dlg)
+        flt = QLineEdit(); flt.setPlaceholderText("絞り込み (機器名 / IF名)"); lay.addWidget(flt)
+        lst = QListWidget(); lst.setSelectionMode(QAbstractItemView.ExtendedSelection); lay.addWidget(lst)
+        for name, ifaces in choices.items():
+            for i in ifaces:
+                it = QListWidgetItem(f"{name}  {i}"); it.setData(Qt.UserRole, (name, i)); it.setFlags(it.flags() | Qt.ItemIsUserCheckable); it.setCheckState(Qt.Unchecked); lst.addItem(it)
+        flt.textChanged.connect(lambda t: [lst.item(k).setHidden(t.lower() not in lst.item(k).text().lower()) for k in range(lst.count())])
+        lay.addWidget(QLabel(note or f"チェックした IF (未チェックなら選択行) を監視します。最大 {MONITOR_MAX_SERIES} 本"))
+        bb = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel); bb.accepted.connect(dlg.accept); bb.rejected.connect(dlg.reject); lay.addWidget(bb)
+        if dlg.exec() != QDialog.Accepted: return {}
+        items = [lst.item(k) for k in range(lst.count()) if lst.item(k).checkState() == Qt.Checked] or lst.selectedItems()
+        picked = defaultdict(list)
+        for it in items[:MONITOR_MAX_SERIES]:
+            name, i = it.data(Qt.UserRole); picked[name].append(i)
+        return dict(picked)
+
+    def setup_ghost_tab(self, picked):
+        t_title = f"MON: {next(iter(picked))}" if len(picked) == 1 else f"MON: {len(picked)}台"
         for i in range(self.tabs.count()):
             if self.tabs.tabText(i) == t_title: self.tabs.removeTab(i); break
-        self.ghost_x, self.ghost_in, self.ghost_out = [], [], []
         scroll = QScrollArea(); scroll.setWidgetResizable(True); scroll.setStyleSheet("border: none; background-color: #1E1E1E;")
-        self.canvas = MplCanvas(self, width=12, height=7, dpi=100)
-        scroll.setWidget(self.canvas); self.tabs.addTab(scroll, t_title); self.tabs.setCurrentWidget(scroll)
-
-    @Slot(str, float, float)
-    def update_ghost_graph(self, time_str, in_m, out_m):
-        self.ghost_x.append(time_str); self.ghost_in.append(in_m); self.ghost_out.append(out_m)
-        if len(self.ghost_x) > 40: self.ghost_x.pop(0); self.ghost_in.pop(0); self.ghost_out.pop(0)
-        self.canvas.axes.clear()
-        self.canvas.axes.plot(self.ghost_x, self.ghost_in, label='Inbound (Mbps)', color='#00FF00', linewidth=2.5, alpha=0.8)
-        self.canvas.axes.plot(self.ghost_x, self.ghost_out, label='Outbound (Mbps)', color='#5555FF', linewidth=2.5, alpha=0.8)
-        self.canvas.axes.text(0.97, 0.95, f"NOW (Mbps)\nIN : {in_m:>7.2f}\nOUT: {out_m:>7.2f}", transform=self.canvas.axes.transAxes, color='white', fontsize=13, fontweight='bold', va='top', ha='right', family='Consolas', bbox=dict(facecolor='black', alpha=0.7, edgecolor='#555'))
-        self.canvas.axes.set_facecolor('#181818'); self.canvas.axes.grid(True, color='#333', linestyle='--', lw=0.5)
-        self.canvas.axes.set_xticks(range(len(self.ghost_x)))
-        if len(self.ghost_x) > 0:
-            step = max(1, len(self.ghost_x) // 8)
-            self.canvas.axes.set_xticklabels([self.ghost_x[i] if i % step == 0 or i == len(self.ghost_x)-1 else "" for i in range(len(self.ghost_x))], color='#AAA', fontsize=9, rotation=45)
-        self.canvas.axes.tick_params(axis='y', colors='#AAA', labelsize=9); self.canvas.axes.legend(loc='upper left', facecolor='#222', labelcolor='white')
-        self.canvas.axes.set_ylim(bottom=0); self.canvas.fig.tight_layout(); self.canvas.draw()
+        self.monitor = TrafficMonitorPlot(self)
+        for name, ifaces in picked.items():
+            for i in ifaces: self.monitor.add_series(name, i)
+        scroll.setWidget(self.monitor.widget); self.tabs.addTab(scroll, t_title); self.tabs.setCurrentWidget(scroll)
+        self.mon_timer.start(1000) # 受信の有無に関係なく1秒ごとに横へ流す
+
+    @Slot(str, float, object)
+    def update_ghost_graph(self, name, ts, rates):
+        if self.monitor: self.monitor.add_samples(name, ts, rates)
+
+    def show_traffic_history(self):
+        # 記録済みの帯域を期間指定で再生 (期間に応じて raw / 1分 / 1時間 の集約を使い分ける)
+        choices = TS_STORE.series()
+        if not choices: return QMessageBox.information(self, "帯域履歴", "記録がありません。モード7で監視すると記録されます。")
+        picked = self.select_interfaces(choices)
+        if not picked: return
+        spans = {"1時間": 3600, "6時間": 6 * 3600, "24時間": 86400, "7日": 7 * 86400, "30日": 30 * 86400}
+        span, ok = QInputDialog.getItem(self, "帯域履歴", "表示期間:", list(spans), 0, False)
+        if not ok: return
+        t1 = time.time(); t0 = t1 - spans[span]
+        t_title = f"HIST: {span}"
+        for i in range(self.tabs.count()):
+            if self.tabs.tabText(i) == t_title: self.tabs.removeTab(i); break
+        scroll = QScrollArea(); scroll.setWidgetResizable(True); scroll.setStyleSheet("border: none; background-color: #1E1E1E;")
+        canvas = make_canvas(self, width=12, height=7, dpi=100); ax = canvas.axes
+        colors, level = TrafficMonitorPlot.COLORS, "-"
+        for k, (name, i) in enumerate((n, i) for n, ifs in picked.items() for i in ifs):
+            ts, m_in, m_out, level = TS_STORE.read(name, i, t0, t1)
+            x = [datetime.fromtimestamp(t) for t in ts]; c = colors[k % len(colors)]
+            ax.plot(x, m_in, color=c, lw=1.5, label=f"{name} {i}"); ax.plot(x, m_out, color=c, lw=1.0, ls='--')
+        ax.set_facecolor('#181818'); ax.grid(True, color='#333', linestyle='--', lw=0.5); ax.set_ylim(bottom=0)
+        ax.set_title(f"{datetime.fromtimestamp(t0):%m/%d %H:%M} - {datetime.fromtimestamp(t1):%m/%d %H:%M} ({level})", color='#AAA'); ax.set_ylabel("Mbps (solid: IN / dashed: OUT)", color='#AAA')
+        ax.tick_params(axis='both', colors='#AAA', labelsize=9); ax.legend(loc='upper left', facecolor='#222', labelcolor='white', fontsize=8)
+        canvas.fig.autofmt_xdate(); canvas.fig.tight_layout(); canvas.draw()
+        scroll.setWidget(canvas); self.tabs.addTab(scroll, t_title); self.tabs.setCurrentWidget(scroll)
 
     @Slot(list)
     def visualize_path(self, path_data):
         if not HAS_NETWORKX: return
+        import networkx as nx
         t_title = "Path Visualizer"
         for i in range(self.tabs.count()):
             if self.tabs.tabText(i) == t_title: self.tabs.removeTab(i); break
         
         scroll = QScrollArea(); scroll.setWidgetResizable(True); scroll.setStyleSheet("border: none; background-color: #1E1E1E;")
-        canvas = MplCanvas(self, width=12, height=7, dpi=100)
+        canvas = make_canvas(self, width=12, height=7, dpi=100)
         scroll.setWidget(canvas); self.tabs.addTab(scroll, t_title); self.tabs.setCurrentWidget(scroll)
 
+        # ECMP で分岐・合流する DAG。from (手前の機器) で辺を張り、ホップ数ごとに列を分けて左から右へ並べる
         G = nx.DiGraph()
-        labels = {}; node_colors = []; edge_colors = []
-        
+        labels = {}; colors = {}
         for i, p in enumerate(path_data):
             node_name = p['node']
-            G.add_node(node_name)
-            
+            G.add_node(node_name, layer=p.get('hop', i))
+
             lbl = node_name
             if p.get('reason'):
                 lbl += f"\n[{p['reason']}]"
             labels[node_name] = lbl
-            
-            color = "#00FF00" if p.get('status') == "OK" else "#FF0000"
-            node_colors.append(color)
-            
-            if i > 0:
-                prev = path_data[i-1]['node']
-                curr = node_name
-                G.add_edge(prev, curr)
-                edge_colors.append(color)
+            colors[node_name] = {"OK": "#00FF00", "DEGRADED": "#FFA500"}.get(p.get('status'), "#FF0000")
 
-        pos = nx.spring_layout(G, seed=42) if len(path_data) > 2 else nx.planar_layout(G)
-        
-        nx.draw_networkx_nodes(G, pos, ax=canvas.axes, node_color=node_colors, node_size=2000)
-        nx.draw_networkx_edges(G, pos, ax=canvas.axes, edge_color=edge_colors, width=2, arrows=True)
+        for i, p in enumerate(path_data):
+            for prev in p.get('from', [path_data[i-1]['node']] if i > 0 else []):
+                if prev in G: G.add_edge(prev, p['node'])
+
+        pos = nx.multipartite_layout(G, subset_key="layer") if len(G) > 1 else {n: (0, 0) for n in G}
+        size = 2000 if len(G) <= 12 else max(300, 24000 // len(G))
+
+        nx.draw_networkx_nodes(G, pos, ax=canvas.axes, node_color=[colors[n] for n in G], node_size=size)
+        nx.draw_networkx_edges(G, pos, ax=canvas.axes, edge_color=[colors[v] for _, v in G.edges()], width=2, arrows=True, node_size=size)
         nx.draw_networkx_labels(G, pos, ax=canvas.axes, labels=labels, font_color='white', font_weight='bold', font_size=9)
         canvas.axes.set_axis_off(); canvas.draw()
 
@@ -1257,11 +3905,10 @@ class NetVerifyGUI(QMainWindow):
             QDesktopServices.openUrl(QUrl.fromLocalFile(path))
 
     def stop_workers(self):
+        if self.scheduler: self.scheduler.cancel(); self.scheduler = None # 待機中の機器は起動しない
         for w in self.active_workers:
-            if isinstance(w, TrafficGhostWorker): w.stop()
-            
             # [Fix] 安全な停止手順
-            if isinstance(w, NetworkWorker):
+            if isinstance(w, (NetworkWorker, TrafficGhostWorker, CrawlerWorker, WiretapWorker, DiagnosticWorker)):
                 w.stop() # フラグを立ててプロセスを停止
                 
                 # スレッドが自然に終わるのを最大2秒待つ
@@ -1286,7 +3933,7 @@ class NetVerifyGUI(QMainWindow):
 
     @Slot(str, list, dict)
     def on_worker_finished(self, name, report, mesh):
-        if report: self.current_report_html.extend(report)
+        for html in report: self.report.add(name, html)
         if mesh: self.full_mesh_matrix[name] = mesh
         # NOTE: cleanup moved to on_thread_finished to avoid race conditions
 
@@ -1295,7 +3942,8 @@ class NetVerifyGUI(QMainWindow):
         # Filter out threads that are actually finished
         self.active_workers = [w for w in self.active_workers if w.isRunning()]
         
-        if not self.active_workers:
+        if not self.active_workers and not (self.scheduler and self.scheduler.pending()):
+            self.mon_timer.stop()
             self.btn_run.setEnabled(True)
             self.btn_cancel.setEnabled(False)
             
@@ -1303,39 +3951,40 @@ class NetVerifyGUI(QMainWindow):
                 self.generate_mesh_report()
             
             self.append_log("GLOBAL", "\n--- 全ての処理が完了しました ---", "#00FF00")
-            self.btn_report.setEnabled(True if self.current_report_html else False)
+            self.btn_report.setEnabled(bool(self.report))
 
     def generate_mesh_report(self):
-        hosts = sorted(self.full_mesh_matrix.keys()); t_name = "疎通マトリックス"
+        t_name = "疎通マトリックス"
         for i in range(self.tabs.count()):
             if self.tabs.tabText(i) == t_name: self.tabs.removeTab(i); break
-        html = f'<div style="text-align: left; margin-left: 0; margin-top: 20px;">'
-        html += f'<div style="color:#FFFF00; font-weight:bold; margin-bottom: 10px; font-family:sans-serif;">疎通マトリックス結果</div>'
-        html += '<table border="1" style="border-collapse:collapse; margin-left:0; color:#eee; background:#222; text-align:center; width: auto; font-family:Consolas, monospace;">'
-        html += '<tr style="background:#444;"><th>FROM \\ TO</th>' + "".join([f'<th style="padding:5px 10px;">{h}</th>' for h in hosts]) + '</tr>'
-        for src in hosts:
-            row = f'<tr><td style="background:#444; padding:5px 10px;"><b>{src}</b></td>'
-            for dst in hosts:
-                st = self.full_mesh_matrix[src].get(dst, "-"); color = "#00FF00" if st == "OK" else "#FF5555" if st == "NG" else "#888"
-                row += f'<td style="color:{color}; font-weight:bold; padding:5px 10px;">{st}</td>'
-            html += row + '</tr>'
-        html += '</table></div>'
-        con = ZoomableTextEdit(); con.setReadOnly(True); con.setStyleSheet("background-color:#1E1E1E; color:#FFFFFF; font-family:Consolas, monospace;"); con.append(html); self.tabs.addTab(con, t_name); self.tabs.setCurrentWidget(con); self.current_report_html.append(html)
+        html = build_mesh_html(self.full_mesh_matrix)
+        con = ZoomableTextEdit(); con.setReadOnly(True); con.setStyleSheet("background-color:#1E1E1E; color:#FFFFFF; font-family:Consolas, monospace;"); con.append(html); self.tabs.addTab(con, t_name); self.tabs.setCurrentWidget(con); self.report.add(t_name, html)
 
     def save_report(self):
         f_p, _ = QFileDialog.getSaveFileName(self, "レポート保存", os.path.join(REPORT_DIR, f"Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"), "HTML Files (*.html)")
-        if f_p:
-            with open(f_p, "w", encoding='utf-8') as f: f.write(f'<html><body style="background:#111; color:#eee; padding:30px; font-family:sans-serif;">{"".join(self.current_report_html)}</body></html>')
+        if f_p: self.append_log("GLOBAL", f"[Report Saved] {self.report.export(f_p)} (+ {os.path.basename(os.path.splitext(f_p)[0])}_data)", "#00FF00")
 
     @Slot(str, str, str)
     def append_log(self, name, text, color):
-        l = f'<span style="color:{color}; white-space:pre-wrap;">{text}</span>'; self.global_console.append(l)
-        if name in self.host_consoles: self.host_consoles[name].append(l)
+        self.log_bus.push_log(name, text, color) # ワーカー分と順序を揃えるため同じキューを通す
 
     @Slot(str, str)
     def append_html(self, name, html):
-        self.global_console.append(html)
-        if name in self.host_consoles: self.host_consoles[name].append(html)
+        self.log_bus.push(name, html)
+
+    def flush_logs(self):
+        items = self.log_bus.drain()
+        if items:
+            per_host = defaultdict(list)
+            for name, html in items:
+                if name in self.host_consoles: per_host[name].append(html)
+            self.global_console.append_records([h for _, h in items])
+            for name, frags in per_host.items(): self.host_consoles[name].append_records(frags)
+            cur = self.tabs.currentWidget() # 検索中のコンソールに追記があれば件数を更新 (追記分だけ走査される)
+            if self.search_input.text() and (cur is self.global_console or cur in [self.host_consoles.get(n) for n in per_host]) and not self.search_timer.isActive(): self.search_timer.start()
+        st = self.log_bus.stats()
+        txt = f"ログ待ち: {st['depth']}  破棄: {st['dropped']}" if st['depth'] > LOG_FLUSH_BATCH or st['dropped'] else ""
+        if txt != self.lbl_logbus.text(): self.lbl_logbus.setText(txt)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv); app.setStyle("Fusion"); window = NetVerifyGUI(); window.show(); sys.exit(app.exec())
@@ -0,0 +1,161 @@
+# NetVerify.py の純粋なロジック部分 (差分エンジンなど) の回帰テスト
+import os, random, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_argv, sys.argv = sys.argv, ["NetVerify.py", "--headless"] # Qt を読み込まずに import する
+try: import NetVerify as nv
+finally: sys.argv = _argv
+
+
+# --- 差分エンジン (diff_ops_fast) ---
+def _lcs_len(a, b):
+    prev = [0] * (len(b) + 1)
+    for x in a:
+        cur = [0]
+        for j, y in enumerate(b): cur.append(prev[j] + 1 if x == y else max(prev[j + 1], cur[j]))
+        prev = cur
+    return prev[-1]
+
+def _check_ops(a, b, ops):
+    assert [l for t, l in ops if t in " -"] == a
+    assert [l for t, l in ops if t in " +"] == b
+    assert sum(t == " " for t, _ in ops) == _lcs_len(a, b)
+
+def _config(rnd, n):
+    # 設定ファイル風: 大半は一意な行、"!" や " exit" などの重複行が混ざる
+    return [rnd.choice(["!", " exit", " shutdown"]) if rnd.random() < 0.2 else f"line {rnd.randrange(10 ** 6)}" for _ in range(n)]
+
+def _edit(rnd, lines, ratio):
+    out = []
+    for l in lines:
+        r = rnd.random()
+        if r < ratio / 3: continue
+        if r < ratio * 2 / 3: out.append(f"changed {rnd.randrange(10 ** 6)}"); continue
+        out.append(l)
+        if r < ratio: out.append(rnd.choice(["!", f"added {rnd.randrange(10 ** 6)}"]))
+    return out
+
+@pytest.mark.parametrize("seed", range(200))
+def test_diff_small_random(seed):
+    rnd = random.Random(seed)
+    a = [rnd.choice("abcde") for _ in range(rnd.randrange(40))]
+    b = [rnd.choice("abcde") for _ in range(rnd.randrange(40))]
+    _check_ops(a, b, nv.diff_ops_fast(a, b))
+
+@pytest.mark.parametrize("seed", range(10))
+def test_diff_config_like(seed):
+    # 合計 400 行を超えるので patience による分割を通る
+    rnd = random.Random(seed); a = _config(rnd, 600)
+    b = _edit(rnd, a, 0.05)
+    _check_ops(a, b, nv.diff_ops_fast(a, b))
+
+@pytest.mark.parametrize("a, b", [([], []), ([], ["x"]), (["x"], []), (["x", "y"], ["x", "y"]), (["x"] * 5, ["x"] * 3)])
+def test_diff_edge_cases(a, b):
+    _check_ops(a, b, nv.diff_ops_fast(a, b))
+
+def test_diff_edit_limit(monkeypatch):
+    # 編集距離の上限を超えた区間は削除 + 追加になるが、両側の復元はできること
+    monkeypatch.setattr(nv, "DIFF_MAX_EDIT", 3)
+    rnd = random.Random(1); a = _config(rnd, 100); b = _edit(rnd, a, 0.3)
+    ops = nv.diff_ops_fast(a, b)
+    assert [l for t, l in ops if t in " -"] == a and [l for t, l in ops if t in " +"] == b
+
+
+# --- キーワード検索 (KeywordScanner) ---
+def _naive_scan(keywords, text):
+    kws = list(dict.fromkeys(k.strip() for k in keywords if k.strip()))
+    pats = []
+    for kw in kws:
+        low = kw.lower()
+        if low.startswith(("regex:", "re:")): pats.append(nv.re.compile(kw.split(":", 1)[1], nv.re.I))
+        elif low.startswith("word:"): pats.append(nv.re.compile(r"\b" + nv.re.escape(kw[5:].strip()) + r"(?!\w)", nv.re.I) if kw[5:].strip() else None)
+        else: pats.append(nv.re.compile(nv.re.escape(kw), nv.re.I))
+    return [(kw, ln, line) for ln, line in enumerate(text.split("\n"), 1) for kw, p in zip(kws, pats) if p and p.search(line)]
+
+@pytest.mark.parametrize("seed", range(200))
+def test_keyword_scan_matches_naive(seed):
+    rnd = random.Random(seed)
+    word = lambda: "".join(rnd.choice("abAB_ -") for _ in range(rnd.randint(1, 4)))
+    keywords = []
+    for _ in range(rnd.randint(1, 8)):
+        kind, body = rnd.choice(["", "", "word:", "re:"]), word().strip(" ")
+        if kind == "word:": body = body.strip("-") or "a" # 単語一致は前後が英数字/_ のキーワードで使う
+        if kind == "re:": body = nv.re.escape(body).replace("a", "a.?")
+        keywords.append(kind + body)
+    text = "\n".join(" ".join(word() for _ in range(rnd.randint(0, 6))) for _ in range(rnd.randint(0, 12)))
+    assert nv.KeywordScanner(keywords).scan(text) == _naive_scan(keywords, text)
+
+def test_keyword_scan_examples():
+    sc = nv.KeywordScanner(["err", "error", "word:down", "re:crc\\s*=\\s*[1-9]", "err"])
+    text = "%LINK-3-UPDOWN: Interface Gi0/1, changed state to down\nerrdisable\nInput ERRORS crc = 5\nshutdown"
+    assert sc.scan(text) == [("word:down", 1, "%LINK-3-UPDOWN: Interface Gi0/1, changed state to down"), ("err", 2, "errdisable"),
+                             ("err", 3, "Input ERRORS crc = 5"), ("error", 3, "Input ERRORS crc = 5"), ("re:crc\\s*=\\s*[1-9]", 3, "Input ERRORS crc = 5")]
+
+
+# --- 最長一致検索 (PrefixTrie) ---
+def _brute_lookup(prefixes, addr):
+    best = None
+    for (p, n), v in prefixes.items():
+        if (addr ^ p) >> (32 - n) == 0 and (best is None or n > best[0]): best = (n, v)
+    return best
+
+@pytest.mark.parametrize("seed", range(50))
+def test_prefix_trie_matches_brute_force(seed):
+    rnd = random.Random(seed); trie, prefixes = nv.PrefixTrie(), {}
+    bases = [rnd.getrandbits(32) for _ in range(4)] # 近いプレフィックスが重なるように少数の基点から作る
+    for k in range(rnd.randint(1, 200)):
+        n = rnd.choice([0, 1, 8, 16, 23, 24, 25, 30, 31, 32, rnd.randint(0, 32)])
+        p = (rnd.choice(bases) ^ rnd.getrandbits(8)) & nv.PrefixTrie._mask(n)
+        trie.insert(p, n, k); prefixes[(p, n)] = k # 同じプレフィックスは後から入れた値で上書き
+        assert len(trie) == len(prefixes)
+    probes = [rnd.getrandbits(32) for _ in range(200)] + [p for p, _ in prefixes] + [p | (~nv.PrefixTrie._mask(n) & 0xFFFFFFFF) for p, n in prefixes]
+    for addr in probes: assert trie.lookup(addr) == _brute_lookup(prefixes, addr)
+
+def test_prefix_trie_basic():
+    trie = nv.PrefixTrie(); ip = nv.ip_to_int
+    assert trie.lookup(ip("10.0.0.1")) is None
+    trie.insert(ip("10.0.0.0"), 8, "a"); trie.insert(ip("10.1.0.0"), 16, "b"); trie.insert(ip("10.1.2.3"), 32, "c"); trie.insert(0, 0, "default")
+    assert trie.lookup(ip("10.1.2.3")) == (32, "c") and trie.lookup(ip("10.1.2.4")) == (16, "b")
+    assert trie.lookup(ip("10.2.0.0")) == (8, "a") and trie.lookup(ip("192.168.0.1")) == (0, "default")
+
+
+# --- HEXダンプ -> pcap (HexDumpParser / PcapWriter / iter_pcap) ---
+def _packets(rnd, n):
+    return [bytes(rnd.getrandbits(8) for _ in range(rnd.choice((1, 15, 16, 17, 60, 64, 1500)))) for _ in range(n)]
+
+def _parse_in_chunks(rnd, dump, base):
+    # 出力が任意の位置 (行の途中を含む) で区切られて届く想定
+    parser, got, k = nv.HexDumpParser(base), [], 0
+    while k < len(dump):
+        step = rnd.randint(1, 300); got += parser.feed(dump[k:k + step]); k += step
+    return got + parser.close()
+
+@pytest.mark.parametrize("fmt", ["epc", "tcpdump"])
+@pytest.mark.parametrize("pcap_fmt", ["pcap", "pcapng"])
+def test_hex_dump_pcap_round_trip(tmp_path, fmt, pcap_fmt):
+    rnd = random.Random(f"{fmt}{pcap_fmt}"); base = 1700000000.0; pkts = _packets(rnd, 50)
+    got = _parse_in_chunks(rnd, nv.synthetic_hex_dump(pkts, fmt, base), base)
+    assert [p for _, p in got] == pkts
+    for k, (ts, _) in enumerate(got): assert abs(ts - (base + k * 0.001)) < 1e-3
+    path = str(tmp_path / f"cap.{pcap_fmt}")
+    with nv.PcapWriter(path, pcap_fmt) as pw:
+        for ts, p in got: pw.write(ts, p)
+    back = list(nv.iter_pcap(path))
+    assert [p for _, _, p in back] == pkts and pw.count == len(pkts)
+    for (ts, _), (ts2, _, _) in zip(got, back): assert abs(ts - ts2) < 1e-6
+
+def test_merge_pcaps_orders_by_time(tmp_path):
+    rnd = random.Random(3); sources, expect = [], []
+    for i, fmt in enumerate(["pcap", "pcapng", "pcap"]):
+        path = str(tmp_path / f"in{i}.{fmt}")
+        with nv.PcapWriter(path, fmt) as pw:
+            t = 100.0 + i * 0.0003
+            for p in _packets(rnd, 20): t += rnd.random() * 0.01; pw.write(t, p); expect.append((t, i, p))
+        sources.append((f"dev{i}", path))
+    out = str(tmp_path / "merged.pcapng")
+    assert nv.merge_pcaps(sources, out) == len(expect)
+    back = list(nv.iter_pcap(out)); expect.sort(key=lambda r: r[0])
+    assert [p for _, _, p in back] == [p for _, _, p in expect]
+    assert all(abs(a[0] - b[0]) < 1e-6 for a, b in zip(back, expect))